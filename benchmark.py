@@ -0,0 +1,584 @@
+"""POS 系統效能測試
+
+用法：
+    python benchmark.py employee-sales [--lines 10000000] [--steps 4]
+    python benchmark.py load [--mix pos] [--concurrency 8] [--duration 30] [--baseline baseline.json]
+
+employee-sales：在獨立的測試資料庫（預設 pos_benchmark）中分階段灌入訂單明細，
+量測員工銷售統計在各資料量下的耗時，並檢查結果正確與耗時是否隨明細列數線性成長。
+
+load：灌入指定數量的員工、商品與訂單後，以多個執行緒依比例呼叫結帳、商品目錄、訂單記錄與三個管理員統計 API，
+回報吞吐量、p50/p95/p99 與每個請求的 SQL 次數；可存成基準檔，之後與基準比較判斷效能是否退步。
+預設在本行程內以 Flask 測試用戶端呼叫（不經網路），指定 --url 時改以 HTTP 呼叫執行中的服務。
+"""
+from decimal import Decimal
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+import argparse
+import http.client
+import json
+import random
+import re
+import statistics
+import sys
+import threading
+import time
+
+import main
+
+# 灌資料的批次大小（每批訂單數）
+SEED_BATCH_ORDERS = 5000
+# 測試資料：員工數、商品數、訂單分佈天數、每張訂單明細列數範圍
+SEED_USERS = 50
+SEED_PRODUCTS = 200
+SEED_DAYS = 365
+LINES_PER_ORDER = (1, 7)
+# 測試員工的密碼（--url 模式以此登入）
+BENCH_PASSWORD = 'benchmark'
+
+# 修正前的員工銷售查詢：訂單連接明細後 SUM(o.total)，金額會乘上明細列數
+LEGACY_EMPLOYEE_SALES_SQL = """
+    SELECT
+        u.id,
+        COALESCE(SUM(o.total), 0) as total_sales,
+        COALESCE(SUM(oi.quantity), 0) as total_items_sold
+    FROM users u
+    LEFT JOIN orders o ON u.id = o.user_id
+    LEFT JOIN order_items oi ON o.id = oi.order_id
+    WHERE u.role = 'user' OR (u.role = 'admin' AND EXISTS(SELECT 1 FROM orders WHERE user_id = u.id))
+    GROUP BY u.id
+"""
+
+def seed_reference_data(cursor, users=SEED_USERS, products=SEED_PRODUCTS):
+    """建立測試用的員工與商品，回傳 (員工ID清單, {商品ID: 單價})"""
+    cursor.execute("SELECT COUNT(*) FROM users WHERE username LIKE 'bench_user_%'")
+    if cursor.fetchone()[0] < users:
+        # KDF 雜湊很慢，所有測試員工共用同一個
+        password = main.hash_password(BENCH_PASSWORD)
+        cursor.executemany("""
+            INSERT IGNORE INTO users (username, password, name, role)
+            VALUES (%s, %s, %s, 'user')
+        """, [(f'bench_user_{i}', password, f'測試員工{i}') for i in range(users)])
+    cursor.execute("SELECT COUNT(*) FROM products")
+    missing = products - cursor.fetchone()[0]
+    if missing > 0:
+        cursor.executemany("""
+            INSERT INTO products (name, price, stock, description)
+            VALUES (%s, %s, %s, %s)
+        """, [(f'測試商品{i}', Decimal(random.randint(10, 500)), 1000000, '效能測試') for i in range(missing)])
+    cursor.execute("SELECT id FROM users WHERE username LIKE 'bench_user_%' ORDER BY id LIMIT %s", (users,))
+    user_ids = [row[0] for row in cursor.fetchall()]
+    cursor.execute("SELECT id, price FROM products WHERE is_active = 1 ORDER BY id LIMIT %s", (products,))
+    prices = dict(cursor.fetchall())
+    return user_ids, prices
+
+def count_lines(cursor):
+    """目前的訂單明細列數"""
+    cursor.execute("SELECT COUNT(*) FROM order_items")
+    return cursor.fetchone()[0]
+
+def seed_orders(connection, target_lines, user_ids, prices):
+    """以明確的訂單ID分批寫入隨機訂單，直到明細列數達到 target_lines"""
+    cursor = connection.cursor()
+    lines = count_lines(cursor)
+    cursor.execute("SELECT COALESCE(MAX(id), 0) FROM orders")
+    next_id = cursor.fetchone()[0] + 1
+    product_ids = list(prices)
+    now = datetime.now().replace(microsecond=0)
+
+    while lines < target_lines:
+        orders, items = [], []
+        for order_id in range(next_id, next_id + SEED_BATCH_ORDERS):
+            subtotal = Decimal('0')
+            for product_id in random.sample(product_ids, random.randint(*LINES_PER_ORDER)):
+                quantity = random.randint(1, 5)
+                items.append((order_id, product_id, quantity, prices[product_id]))
+                subtotal += prices[product_id] * quantity
+            tax = (subtotal * main.TAX_RATE).quantize(main.CENT)
+            created_at = now - timedelta(seconds=random.randint(0, SEED_DAYS * 86400))
+            orders.append((order_id, random.choice(user_ids), subtotal, tax, subtotal + tax, created_at))
+        cursor.executemany("""
+            INSERT INTO orders (id, user_id, subtotal, tax, total, created_at)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """, orders)
+        cursor.executemany("""
+            INSERT INTO order_items (order_id, product_id, quantity, price)
+            VALUES (%s, %s, %s, %s)
+        """, items)
+        connection.commit()
+        next_id += SEED_BATCH_ORDERS
+        lines += len(items)
+    return lines
+
+def time_query(cursor, sql, repeat):
+    """執行查詢 repeat 次，回傳 (耗時中位數秒數, 最後一次結果)"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        cursor.execute(sql)
+        rows = cursor.fetchall()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), rows
+
+def time_endpoint(client, path, repeat):
+    """以測試用戶端呼叫 API repeat 次，回傳 (耗時中位數秒數, 最後一次 JSON)"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        response = client.get(path)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), response.get_json()
+
+def admin_client(cursor):
+    """以預設管理員登入的 Flask 測試用戶端（權限以資料庫中的角色為準）"""
+    cursor.execute("SELECT id FROM users WHERE username = 'admin'")
+    admin_id = cursor.fetchone()[0]
+    client = main.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = admin_id
+        session['username'] = 'admin'
+    return client
+
+def bench_employee_sales(args):
+    """分階段量測員工銷售統計：逐單預先彙總的訂單查詢、彙總表 API，以及（選用）修正前的查詢"""
+    if not main.migrate_database():
+        return 1
+
+    scales = [args.lines // 10 ** (args.steps - 1 - step) for step in range(args.steps)]
+    results = []
+    ok = True
+
+    with main.db_connection() as connection:
+        if not connection:
+            return 1
+        connection.autocommit = False
+        cursor = connection.cursor()
+        user_ids, prices = seed_reference_data(cursor)
+        connection.commit()
+        client = admin_client(cursor)
+
+        cursor.execute(f"EXPLAIN {main.user_sales_query()}")
+        columns = [column[0] for column in cursor.description]
+        print("執行計畫：")
+        for row in cursor.fetchall():
+            print("  " + ", ".join(f"{name}={value}" for name, value in zip(columns, row) if value is not None))
+
+        for target in scales:
+            print(f"\n灌入訂單明細至 {target:,} 列...")
+            lines = seed_orders(connection, target, user_ids, prices)
+            cursor.execute("ANALYZE TABLE orders, order_items")
+            cursor.fetchall()
+            connection.commit()
+
+            query_seconds, rows = time_query(cursor, main.user_sales_query(), args.repeat)
+            connection.commit()
+
+            # 正確性：各員工加總必須等於訂單與明細的直接加總
+            cursor.execute("SELECT COUNT(*), COALESCE(SUM(total), 0) FROM orders WHERE user_id IS NOT NULL")
+            expected_orders, expected_sales = cursor.fetchone()
+            cursor.execute("""
+                SELECT COALESCE(SUM(oi.quantity), 0) FROM order_items oi
+                JOIN orders o ON o.id = oi.order_id WHERE o.user_id IS NOT NULL
+            """)
+            expected_items = cursor.fetchone()[0]
+            connection.commit()
+            actual = (sum(row[1] for row in rows), sum(row[2] for row in rows), sum(row[3] for row in rows))
+            correct = actual == (expected_orders, expected_sales, expected_items)
+            ok = ok and correct
+
+            main.rebuild_rollups()
+            endpoint_seconds, payload = time_endpoint(client, '/api/admin/stats/employee-sales', args.repeat)
+            rollup_sales = sum(Decimal(str(row['total_sales'])) for row in payload)
+            rollup_correct = abs(rollup_sales - expected_sales) < Decimal('1')
+            ok = ok and rollup_correct
+
+            line = {
+                'lines': lines,
+                'query': query_seconds,
+                'endpoint': endpoint_seconds,
+                'correct': correct and rollup_correct,
+            }
+            if args.legacy:
+                line['legacy'], legacy_rows = time_query(cursor, LEGACY_EMPLOYEE_SALES_SQL, 1)
+                connection.commit()
+                legacy_sales = sum(row[1] for row in legacy_rows)
+                line['inflation'] = legacy_sales / expected_sales if expected_sales else 0
+            results.append(line)
+
+            print(f"  明細 {lines:,} 列：訂單查詢 {query_seconds * 1000:.1f} ms"
+                  f"（{query_seconds / lines * 1e9:.1f} ns/列），彙總表 API {endpoint_seconds * 1000:.1f} ms，"
+                  f"結果{'正確' if line['correct'] else '錯誤'}")
+            if args.legacy:
+                print(f"  修正前查詢 {line['legacy'] * 1000:.1f} ms，總金額為正確值的 {line['inflation']:.2f} 倍")
+
+    # 線性檢查：最大與最小資料量的每列耗時比值不得超過容許倍數
+    per_line = [line['query'] / line['lines'] for line in results]
+    ratio = per_line[-1] / per_line[0] if per_line[0] else 0
+    linear = ratio <= args.tolerance
+    print(f"\n每列耗時比（最大/最小資料量）：{ratio:.2f}（容許 {args.tolerance}）→ {'線性' if linear else '超出'}")
+    return 0 if ok and linear else 1
+
+# 負載測試
+
+class InProcessClient:
+    """以 Flask 測試用戶端直接呼叫應用（不經網路，量測應用與資料庫本身）"""
+
+    def __init__(self, user_id, username):
+        self.client = main.app.test_client()
+        with self.client.session_transaction() as session:
+            session['user_id'] = user_id
+            session['username'] = username
+
+    def request(self, method, path, body=None):
+        """送出請求，回傳 (狀態碼, 內容)"""
+        # buffered=True：讀完回應才算完成，與真實伺服器一樣觸發指標記錄
+        response = self.client.open(path, method=method, json=body, buffered=True)
+        return response.status_code, response.get_data()
+
+class HttpClient:
+    """以 HTTP 呼叫執行中的服務（keep-alive，自行保存 session cookie）"""
+
+    def __init__(self, url, username, password):
+        parts = urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+        self.cookie = None
+        status, _ = self.request('POST', '/api/auth/login', {'username': username, 'password': password})
+        if status != 200:
+            raise RuntimeError(f'{username} 登入失敗（HTTP {status}）')
+
+    def request(self, method, path, body=None):
+        """送出請求，回傳 (狀態碼, 內容)"""
+        headers = {}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        try:
+            self.connection.request(method, path, payload, headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            # 下一次請求會自動重新連線
+            self.connection.close()
+            raise
+        cookie = response.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';', 1)[0]
+        return response.status, data
+
+class LoadContext:
+    """負載測試共用的資料：商品ID、員工清單與建立用戶端的方式"""
+
+    def __init__(self, args, users, product_ids, admin_id):
+        self.args = args
+        self.users = users  # [(員工ID, 帳號)]
+        self.product_ids = product_ids
+        self.admin_id = admin_id
+
+    def client(self, user_id, username, password):
+        if self.args.url:
+            return HttpClient(self.args.url, username, password)
+        return InProcessClient(user_id, username)
+
+def op_checkout(client, rng, context):
+    """結帳：1～5 種商品，每種 1～3 件"""
+    items = [{'product_id': product_id, 'quantity': rng.randint(1, 3)}
+             for product_id in rng.sample(context.product_ids, rng.randint(1, 5))]
+    return client.request('POST', '/api/orders', {'items': items})
+
+def op_catalog(client, rng, context):
+    """商品目錄：第一頁、游標翻頁或名稱搜尋"""
+    kind = rng.random()
+    if kind < 0.6:
+        path = '/api/products?limit=50'
+    elif kind < 0.85:
+        path = f'/api/products?limit=50&after={rng.choice(context.product_ids)}'
+    else:
+        path = f'/api/products?q=測試商品{rng.randint(0, len(context.product_ids) - 1)}'
+    return client.request('GET', path)
+
+def op_history(client, rng, context):
+    """個人訂單記錄第一頁"""
+    return client.request('GET', '/api/orders?limit=50')
+
+def op_employee_sales(client, rng, context):
+    return client.request('GET', '/api/admin/stats/employee-sales')
+
+def op_daily_product_sales(client, rng, context):
+    return client.request('GET', '/api/admin/stats/daily-product-sales')
+
+def op_employee_average(client, rng, context):
+    return client.request('GET', '/api/admin/stats/employee-average')
+
+# 操作名稱 -> (函式, 路由樣板, HTTP 方法, 是否以管理員身分呼叫)；路由與方法用來對應 /api/metrics 的 SQL 次數
+OPERATIONS = {
+    'checkout': (op_checkout, '/api/orders', 'POST', False),
+    'catalog': (op_catalog, '/api/products', 'GET', False),
+    'history': (op_history, '/api/orders', 'GET', False),
+    'employee_sales': (op_employee_sales, '/api/admin/stats/employee-sales', 'GET', True),
+    'daily_product_sales': (op_daily_product_sales, '/api/admin/stats/daily-product-sales', 'GET', True),
+    'employee_average': (op_employee_average, '/api/admin/stats/employee-average', 'GET', True)
+}
+
+# 請求組合：操作名稱 -> 權重
+MIXES = {
+    # 營業時段：以結帳與查商品為主，偶爾查訂單記錄與看報表
+    'pos': {'checkout': 30, 'catalog': 50, 'history': 15,
+            'employee_sales': 2, 'daily_product_sales': 2, 'employee_average': 1},
+    'checkout': {'checkout': 1},
+    'catalog': {'catalog': 1},
+    'history': {'history': 1},
+    'reports': {'employee_sales': 1, 'daily_product_sales': 1, 'employee_average': 1}
+}
+
+METRIC_LINE = re.compile(r'^(pos_db_queries_total|pos_http_requests_total)\{route="([^"]*)",method="([^"]*)"[^}]*\} (\S+)$')
+
+def scrape_query_counts(admin_client):
+    """讀取 /api/metrics，回傳 {(路由, 方法): [請求數, SQL 數]}"""
+    if admin_client is None:
+        text = main.metrics.render()
+    else:
+        status, data = admin_client.request('GET', '/api/metrics')
+        if status != 200:
+            return {}
+        text = data.decode()
+    counts = {}
+    for line in text.splitlines():
+        match = METRIC_LINE.match(line)
+        if match:
+            name, route, method, value = match.groups()
+            entry = counts.setdefault((route, method), [0, 0])
+            entry[0 if name == 'pos_http_requests_total' else 1] += float(value)
+    return counts
+
+def percentile(sorted_values, fraction):
+    """最近排名法百分位數"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def run_load(args, context, weights):
+    """依權重在 concurrency 個執行緒上送出請求，回傳 (各操作 [(延遲秒數, 是否成功)], 量測秒數, 無法開始的執行緒錯誤)"""
+    names = list(weights)
+    samples = {name: [] for name in names}
+    setup_errors = []
+    aborted = threading.Event()
+    lock = threading.Lock()
+    admin = ('admin', args.admin_password)
+    started = time.perf_counter()
+    measure_from = started + args.warmup
+    deadline = measure_from + args.duration
+
+    def worker(index):
+        rng = random.Random(args.seed * 1000 + index)
+        user_id, username = context.users[index % len(context.users)]
+        try:
+            employee = context.client(user_id, username, BENCH_PASSWORD) if any(
+                not OPERATIONS[name][3] for name in names) else None
+            admin_client = context.client(context.admin_id, *admin) if any(OPERATIONS[name][3] for name in names) else None
+        except Exception as e:
+            # 登入失敗或無法連線：少了這個執行緒的結果會讓吞吐量偏低卻沒有錯誤，整次測試作廢
+            with lock:
+                setup_errors.append(f"執行緒 {index}（{username}）: {e}")
+            aborted.set()
+            return
+        local = {name: [] for name in names}
+        while not aborted.is_set():
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            name = rng.choices(names, [weights[name] for name in names])[0]
+            function, _, _, as_admin = OPERATIONS[name]
+            request_started = time.perf_counter()
+            try:
+                status, _ = function(admin_client if as_admin else employee, rng, context)
+                ok = status < 400
+            except Exception:
+                ok = False
+            finished = time.perf_counter()
+            if request_started >= measure_from:
+                local[name].append((finished - request_started, ok))
+        with lock:
+            for name, values in local.items():
+                samples[name].extend(values)
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, args.duration, setup_errors
+
+def summarize(samples, seconds, before, after):
+    """各操作的吞吐量、延遲百分位數、錯誤數與每個請求的 SQL 次數"""
+    results = {}
+    for name, values in samples.items():
+        latencies = sorted(latency for latency, _ in values)
+        _, route, method, _ = OPERATIONS[name]
+        requests_before, queries_before = before.get((route, method), (0, 0))
+        requests_after, queries_after = after.get((route, method), (0, 0))
+        requests = requests_after - requests_before
+        results[name] = {
+            'count': len(values),
+            'errors': sum(1 for _, ok in values if not ok),
+            'rps': round(len(values) / seconds, 2) if seconds else 0.0,
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'queries_per_request': round((queries_after - queries_before) / requests, 2) if requests else None
+        }
+    return results
+
+def print_results(report):
+    print(f"\n組合 {report['mix']}，{report['concurrency']} 個執行緒，量測 {report['duration']} 秒，"
+          f"總吞吐量 {report['throughput']} req/s")
+    print(f"{'操作':<22}{'次數':>8}{'錯誤':>6}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'SQL/請求':>10}")
+    for name, result in report['operations'].items():
+        queries = '-' if result['queries_per_request'] is None else result['queries_per_request']
+        print(f"{name:<22}{result['count']:>8}{result['errors']:>6}{result['rps']:>10}"
+              f"{result['p50_ms']:>10}{result['p95_ms']:>10}{result['p99_ms']:>10}{queries:>10}")
+
+def compare_baseline(report, baseline, threshold):
+    """與基準比較：p95 變慢、吞吐量下降超過 threshold 或 SQL 次數增加即視為退步，回傳退步項目"""
+    regressions = []
+    print(f"\n與基準比較（容許 {threshold:.0%}）：")
+    for name, result in report['operations'].items():
+        base = baseline['operations'].get(name)
+        if not base or not base['count'] or not result['count']:
+            continue
+        checks = [
+            ('p95', result['p95_ms'], base['p95_ms'], result['p95_ms'] > base['p95_ms'] * (1 + threshold)),
+            ('吞吐量', result['rps'], base['rps'], result['rps'] < base['rps'] * (1 - threshold))
+        ]
+        if result['queries_per_request'] is not None and base['queries_per_request'] is not None:
+            # SQL 次數幾乎不受機器負載影響，增加超過 0.5 次就是程式行為改變
+            checks.append(('SQL/請求', result['queries_per_request'], base['queries_per_request'],
+                           result['queries_per_request'] > base['queries_per_request'] + 0.5))
+        for label, current, previous, regressed in checks:
+            change = (current - previous) / previous if previous else 0.0
+            print(f"  {name:<22}{label:<8}{previous:>10} → {current:<10}（{change:+.1%}）{' 退步' if regressed else ''}")
+            if regressed:
+                regressions.append(f'{name} {label}')
+    return regressions
+
+def bench_load(args):
+    """灌入測試資料後執行負載測試，輸出報表並（選用）與基準比較"""
+    weights = MIXES[args.mix]
+    if not args.url:
+        main.METRICS_CONFIG['dir'] = ''
+        main.metrics.directory = ''
+    main.METRICS_CONFIG['slow_request_ms'] = 10 ** 9  # 負載測試時不輸出慢請求記錄
+    if not main.migrate_database():
+        return 1
+
+    with main.db_connection() as connection:
+        if not connection:
+            return 1
+        connection.autocommit = False
+        cursor = connection.cursor()
+        user_ids, prices = seed_reference_data(cursor, args.users, args.products)
+        connection.commit()
+        cursor.execute("SELECT id, username FROM users WHERE username LIKE 'bench_user_%' ORDER BY id LIMIT %s",
+                       (args.users,))
+        users = cursor.fetchall()
+        cursor.execute("SELECT id FROM users WHERE username = 'admin'")
+        admin_id = cursor.fetchone()[0]
+        connection.commit()
+        before_lines = count_lines(cursor)
+        connection.commit()
+        if before_lines < args.lines:
+            print(f"灌入訂單明細至 {args.lines:,} 列...")
+            seed_orders(connection, args.lines, user_ids, prices)
+            cursor.execute("ANALYZE TABLE orders, order_items")
+            cursor.fetchall()
+            connection.commit()
+    if before_lines < args.lines:
+        main.rebuild_rollups()
+
+    context = LoadContext(args, users, list(prices), admin_id)
+    scraper = HttpClient(args.url, 'admin', args.admin_password) if args.url else None
+    print(f"執行負載測試：組合 {args.mix}，{args.concurrency} 個執行緒，暖機 {args.warmup} 秒，量測 {args.duration} 秒...")
+    before = scrape_query_counts(scraper)
+    samples, seconds, setup_errors = run_load(args, context, weights)
+    if setup_errors:
+        print(f"負載測試中止：{len(setup_errors)} 個執行緒無法開始")
+        for error in setup_errors:
+            print(f"  {error}")
+        return 1
+    after = scrape_query_counts(scraper)
+
+    operations = summarize(samples, seconds, before, after)
+    report = {
+        'mix': args.mix,
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'target': args.url or 'in-process',
+        'lines': max(before_lines, args.lines),
+        'throughput': round(sum(result['count'] for result in operations.values()) / seconds, 2),
+        'operations': operations
+    }
+    print_results(report)
+
+    failed = False
+    for name, result in operations.items():
+        if result['count'] and result['errors'] / result['count'] > 0.01:
+            print(f"錯誤率過高：{name} {result['errors']}/{result['count']}")
+            failed = True
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n已儲存基準：{args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if (baseline['mix'], baseline['concurrency']) != (report['mix'], report['concurrency']):
+            print("注意：基準的組合或執行緒數與本次不同，比較結果僅供參考")
+        regressions = compare_baseline(report, baseline, args.threshold)
+        if regressions:
+            print(f"效能退步：{', '.join(regressions)}")
+            failed = True
+        else:
+            print("未發現效能退步")
+    return 1 if failed else 0
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='POS 系統效能測試')
+    parser.add_argument('--database', default='pos_benchmark', help='測試用資料庫（會寫入大量資料，請勿使用正式資料庫）')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    employee_sales = subparsers.add_parser('employee-sales', help='員工銷售統計的正確性與線性成長測試')
+    employee_sales.add_argument('--lines', type=int, default=10_000_000, help='最終的訂單明細列數')
+    employee_sales.add_argument('--steps', type=int, default=4, help='量測階段數（每階段資料量 ×10）')
+    employee_sales.add_argument('--repeat', type=int, default=3, help='每個查詢重複次數（取中位數）')
+    employee_sales.add_argument('--tolerance', type=float, default=2.0, help='每列耗時比的容許倍數')
+    employee_sales.add_argument('--legacy', action='store_true', help='一併量測修正前的扇出查詢')
+
+    load = subparsers.add_parser('load', help='API 負載測試（吞吐量、延遲百分位數、每個請求的 SQL 次數）')
+    load.add_argument('--mix', choices=sorted(MIXES), default='pos', help='請求組合')
+    load.add_argument('--concurrency', type=int, default=8, help='同時送出請求的執行緒數')
+    load.add_argument('--duration', type=float, default=30, help='量測秒數')
+    load.add_argument('--warmup', type=float, default=5, help='暖機秒數（不計入結果）')
+    load.add_argument('--users', type=int, default=SEED_USERS, help='測試員工數')
+    load.add_argument('--products', type=int, default=SEED_PRODUCTS, help='商品數')
+    load.add_argument('--lines', type=int, default=100_000, help='訂單明細列數（不足時補灌）')
+    load.add_argument('--seed', type=int, default=1, help='亂數種子（相同種子產生相同的請求序列）')
+    load.add_argument('--url', help='改以 HTTP 呼叫執行中的服務（例如 http://localhost:5000），服務須使用同一個資料庫')
+    load.add_argument('--admin-password', default='admin123', help='--url 模式登入 admin 的密碼')
+    load.add_argument('--save-baseline', metavar='FILE', help='把結果存成基準檔')
+    load.add_argument('--baseline', metavar='FILE', help='與基準檔比較，退步時結束碼為 1')
+    load.add_argument('--threshold', type=float, default=0.10, help='p95 與吞吐量的容許變動比例')
+
+    args = parser.parse_args()
+    # 與 main.py 相同的設定來源（POS_CONFIG 設定檔與 POS_* 環境變數），資料庫名稱以 --database 為準
+    main.create_app()
+    main.DB_CONFIG['database'] = args.database
+    if args.command == 'employee-sales':
+        return bench_employee_sales(args)
+    if args.command == 'load':
+        return bench_load(args)
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
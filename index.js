@@ -6,6 +6,26 @@ let cart = [];
 let products = [];
 let currentUser = null;
 
+// 商品分頁與搜尋
+const PRODUCT_PAGE_SIZE = 50;
+const PRODUCT_FIELDS = 'id,name,price,stock,description';
+const SEARCH_DEBOUNCE_MS = 300;
+let productSearchTerm = '';
+let productCursor = null;
+let productRequestSeq = 0;
+let productSearchTimer = null;
+let productListItems = [];
+let productListCursor = null;
+
+// ETag 驗證快取：伺服器回 304 時直接沿用本地資料
+const ETAG_CACHE_LIMIT = 100;
+const etagCache = new Map();
+
+// 訂單記錄分頁
+const ORDER_PAGE_SIZE = 20;
+let orderHistoryOrders = [];
+let orderHistoryCursor = null;
+
 // 初始化
 document.addEventListener('DOMContentLoaded', () => {
     checkAuthStatus();
@@ -17,8 +37,10 @@ function setupEventListeners() {
     // 搜尋功能
     const searchInput = document.getElementById('searchInput');
     if (searchInput) {
+        // 輸入停止一段時間後才向伺服器搜尋
         searchInput.addEventListener('input', (e) => {
-            filterProducts(e.target.value);
+            clearTimeout(productSearchTimer);
+            productSearchTimer = setTimeout(() => filterProducts(e.target.value), SEARCH_DEBOUNCE_MS);
         });
     }
 
@@ -395,12 +417,24 @@ async function handleProfileUpdate(e) {
     }
 }
 
-// 載入商品列表
-async function loadProducts() {
+// 載入商品列表（append 為 true 時載入下一頁）
+async function loadProducts(append = false) {
+    const params = new URLSearchParams({ limit: PRODUCT_PAGE_SIZE, fields: PRODUCT_FIELDS });
+    if (productSearchTerm) {
+        params.set('q', productSearchTerm);
+    }
+    if (append && productCursor) {
+        params.set('after', productCursor);
+    }
+    // 只採用最後一次請求的結果，避免較慢的舊搜尋覆蓋新結果
+    const requestSeq = ++productRequestSeq;
+
     try {
-        const response = await fetch(`${API_BASE_URL}/products`);
-        if (response.ok) {
-            products = await response.json();
+        const result = await fetchJsonWithEtag(`${API_BASE_URL}/products?${params}`);
+        if (requestSeq !== productRequestSeq) return;
+        if (result.ok) {
+            products = append ? products.concat(result.data) : result.data;
+            productCursor = result.nextCursor;
             displayProducts(products);
         } else {
             console.error('載入商品失敗');
@@ -431,15 +465,17 @@ function displayProducts(productsToShow) {
             </div>
             ${product.description ? `<p style="font-size: 12px; color: #666; margin-top: 8px;">${escapeHtml(product.description)}</p>` : ''}
         </div>
-    `).join('');
+    `).join('') + (productCursor ? `
+        <div style="grid-column: 1/-1; text-align: center;">
+            <button class="btn btn-secondary" onclick="loadProducts(true)">載入更多</button>
+        </div>
+    ` : '');
 }
 
-// 過濾商品
+// 過濾商品（伺服器端搜尋）
 function filterProducts(searchTerm) {
-    const filtered = products.filter(product =>
-        product.name.toLowerCase().includes(searchTerm.toLowerCase())
-    );
-    displayProducts(filtered);
+    productSearchTerm = searchTerm.trim();
+    loadProducts();
 }
 
 // 添加到購物車
@@ -565,18 +601,15 @@ async function checkout() {
     if (!confirm('確定要結帳嗎？')) return;
 
     try {
+        // 金額由伺服器依目前售價計算，只需傳送商品與數量
         const orderData = {
             items: cart.map(item => ({
                 product_id: item.id,
-                quantity: item.quantity,
-                price: item.price
-            })),
-            subtotal: cart.reduce((sum, item) => sum + (item.price * item.quantity), 0),
-            tax: cart.reduce((sum, item) => sum + (item.price * item.quantity), 0) * 0.05,
-            total: cart.reduce((sum, item) => sum + (item.price * item.quantity), 0) * 1.05
+                quantity: item.quantity
+            }))
         };
 
-        const response = await fetch(`${API_BASE_URL}/orders`, {
+        const response = await fetchIdempotent(`${API_BASE_URL}/orders`, {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
@@ -585,9 +618,23 @@ async function checkout() {
             body: JSON.stringify(orderData)
         });
 
-        if (response.ok) {
+        if (response.status === 202) {
+            // 非同步結帳：庫存已扣除，訂單稍後寫入；短暫等待以便顯示訂單編號
+            const result = await response.json();
+            const queued = await waitForQueuedOrder(result.token);
+            if (queued && queued.status === 'failed') {
+                alert(`結帳失敗: ${queued.error || '訂單無法寫入'}`);
+            } else if (queued && queued.status === 'committed') {
+                alert(`結帳成功！訂單編號: ${queued.order_id}\n總計: NT$ ${result.total.toFixed(2)}`);
+            } else {
+                alert(`結帳成功！訂單處理中（代碼: ${result.token.slice(0, 8)}）\n總計: NT$ ${result.total.toFixed(2)}`);
+            }
+            cart = [];
+            updateCart();
+            loadProducts(); // 重新載入商品以更新庫存
+        } else if (response.ok) {
             const result = await response.json();
-            alert(`結帳成功！訂單編號: ${result.order_id}`);
+            alert(`結帳成功！訂單編號: ${result.order_id}\n總計: NT$ ${result.total.toFixed(2)}`);
             cart = [];
             updateCart();
             loadProducts(); // 重新載入商品以更新庫存
@@ -601,6 +648,47 @@ async function checkout() {
     }
 }
 
+// 產生冪等鍵（同一次結帳或更改的重送都沿用同一個鍵）
+function newIdempotencyKey() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+}
+
+// 送出訂單寫入請求：網路錯誤、相同請求處理中（409）或服務忙碌（503）時以同一個冪等鍵重送，伺服器不會重複執行
+async function fetchIdempotent(url, options, attempts = 4) {
+    const headers = { ...(options.headers || {}), 'Idempotency-Key': newIdempotencyKey() };
+    for (let attempt = 1; ; attempt++) {
+        try {
+            const response = await fetch(url, { ...options, headers });
+            if ((response.status !== 409 && response.status !== 503) || attempt >= attempts) {
+                return response;
+            }
+        } catch (error) {
+            if (attempt >= attempts) throw error;
+        }
+        await new Promise(resolve => setTimeout(resolve, 500 * attempt));
+    }
+}
+
+// 查詢非同步結帳的狀態，最多等待約 2 秒；仍在處理中或查詢失敗時回傳最後結果（或 null）
+async function waitForQueuedOrder(token) {
+    let queued = null;
+    for (let attempt = 0; attempt < 8; attempt++) {
+        await new Promise(resolve => setTimeout(resolve, 250));
+        try {
+            const response = await fetch(`${API_BASE_URL}/orders/queue/${token}`, { credentials: 'include' });
+            if (!response.ok) break;
+            queued = await response.json();
+            if (queued.status === 'committed' || queued.status === 'failed') break;
+        } catch (error) {
+            break;
+        }
+    }
+    return queued;
+}
+
 // 顯示商品管理模態框
 function showProductModal() {
     if (!currentUser) {
@@ -685,13 +773,19 @@ async function handleProductSubmit(e) {
     }
 }
 
-// 載入商品列表（用於管理）
-async function loadProductList() {
+// 載入商品列表（用於管理，append 為 true 時載入下一頁）
+async function loadProductList(append = false) {
+    const params = new URLSearchParams({ limit: PRODUCT_PAGE_SIZE, fields: PRODUCT_FIELDS });
+    if (append && productListCursor) {
+        params.set('after', productListCursor);
+    }
+
     try {
-        const response = await fetch(`${API_BASE_URL}/products`);
-        if (response.ok) {
-            const productList = await response.json();
-            displayProductList(productList);
+        const result = await fetchJsonWithEtag(`${API_BASE_URL}/products?${params}`);
+        if (result.ok) {
+            productListItems = append ? productListItems.concat(result.data) : result.data;
+            productListCursor = result.nextCursor;
+            displayProductList(productListItems);
         }
     } catch (error) {
         console.error('載入商品列表失敗:', error);
@@ -722,15 +816,19 @@ function displayProductList(products) {
                 <button class="btn-delete" onclick="deleteProduct(${product.id})">刪除</button>
             </div>
         </div>
-    `).join('');
+    `).join('') + (productListCursor ? `
+        <div style="text-align: center; padding: 10px;">
+            <button class="btn btn-secondary" onclick="loadProductList(true)">載入更多</button>
+        </div>
+    ` : '');
 }
 
 // 編輯商品
 async function editProduct(productId) {
     try {
-        const response = await fetch(`${API_BASE_URL}/products/${productId}`);
-        if (response.ok) {
-            const product = await response.json();
+        const result = await fetchJsonWithEtag(`${API_BASE_URL}/products/${productId}`);
+        if (result.ok) {
+            const product = result.data;
             document.getElementById('productId').value = product.id;
             document.getElementById('productName').value = product.name;
             document.getElementById('productPrice').value = product.price;
@@ -810,22 +908,33 @@ function closeOrderModal() {
     }
 }
 
-// 載入訂單記錄
-async function loadOrderHistory() {
+// 載入訂單記錄（append 為 true 時載入下一頁）
+async function loadOrderHistory(append = false) {
     const orderHistory = document.getElementById('orderHistory');
     if (!orderHistory) return;
     
-    // 顯示載入中
-    orderHistory.innerHTML = '<p style="text-align: center; color: #999; padding: 20px;">載入中...</p>';
+    if (!append) {
+        // 顯示載入中
+        orderHistory.innerHTML = '<p style="text-align: center; color: #999; padding: 20px;">載入中...</p>';
+        orderHistoryOrders = [];
+        orderHistoryCursor = null;
+    }
+    
+    const params = new URLSearchParams({ limit: ORDER_PAGE_SIZE });
+    if (append && orderHistoryCursor) {
+        params.set('after', orderHistoryCursor);
+    }
     
     try {
-        const response = await fetch(`${API_BASE_URL}/orders`, {
+        const response = await fetch(`${API_BASE_URL}/orders?${params}`, {
             credentials: 'include'
         });
         
         if (response.ok) {
             const orders = await response.json();
-            displayOrderHistory(orders);
+            orderHistoryOrders = orderHistoryOrders.concat(orders);
+            orderHistoryCursor = response.headers.get('X-Next-Cursor');
+            displayOrderHistory(orderHistoryOrders);
         } else if (response.status === 401) {
             // 如果收到 401，關閉模態框並提示登入
             closeOrderModal();
@@ -843,6 +952,15 @@ async function loadOrderHistory() {
     }
 }
 
+// 載入更多訂單記錄
+function loadMoreOrderHistory(button) {
+    if (button) {
+        button.disabled = true;
+        button.textContent = '載入中...';
+    }
+    loadOrderHistory(true);
+}
+
 // 顯示訂單記錄
 function displayOrderHistory(orders) {
     const orderHistory = document.getElementById('orderHistory');
@@ -867,7 +985,11 @@ function displayOrderHistory(orders) {
                 <button class="btn btn-delete" onclick="deleteOrder(${order.id})" style="padding: 5px 15px; font-size: 14px; background-color: #e74c3c;">刪除</button>
             </div>
         </div>
-    `).join('');
+    `).join('') + (orderHistoryCursor ? `
+        <div style="text-align: center; padding: 10px;">
+            <button class="btn btn-secondary" onclick="loadMoreOrderHistory(this)">載入更多</button>
+        </div>
+    ` : '');
 }
 
 // 刪除訂單
@@ -897,18 +1019,8 @@ async function deleteOrder(orderId) {
 // 編輯訂單
 async function editOrder(orderId) {
     try {
-        // 獲取訂單詳情
-        const response = await fetch(`${API_BASE_URL}/orders`, {
-            credentials: 'include'
-        });
-        
-        if (!response.ok) {
-            alert('無法載入訂單資訊');
-            return;
-        }
-        
-        const orders = await response.json();
-        const order = orders.find(o => o.id === orderId);
+        // 從已載入的訂單記錄中取得訂單詳情
+        const order = orderHistoryOrders.find(o => o.id === orderId);
         
         if (!order) {
             alert('找不到訂單');
@@ -1289,14 +1401,12 @@ async function handleEditOrderSubmit(e) {
     
     for (const input of quantityInputs) {
         const productId = parseInt(input.dataset.productId);
-        const price = parseFloat(input.dataset.price);
         const quantity = parseInt(input.value);
         
         if (quantity > 0) {
             items.push({
                 product_id: productId,
-                quantity: quantity,
-                price: price
+                quantity: quantity
             });
         }
     }
@@ -1306,23 +1416,16 @@ async function handleEditOrderSubmit(e) {
         return;
     }
     
-    // 計算總額
-    const subtotal = items.reduce((sum, item) => sum + (item.price * item.quantity), 0);
-    const tax = subtotal * 0.05;
-    const total = subtotal + tax;
-    
+    // 總額由伺服器重新計算
     try {
-        const response = await fetch(`${API_BASE_URL}/orders/${orderId}`, {
+        const response = await fetchIdempotent(`${API_BASE_URL}/orders/${orderId}`, {
             method: 'PUT',
             headers: {
                 'Content-Type': 'application/json'
             },
             credentials: 'include',
             body: JSON.stringify({
-                items: items,
-                subtotal: subtotal,
-                tax: tax,
-                total: total
+                items: items
             })
         });
         
@@ -1341,6 +1444,37 @@ async function handleEditOrderSubmit(e) {
     }
 }
 
+// 工具函數：帶 If-None-Match 的 GET 請求，回傳 { ok, status, data, nextCursor }
+async function fetchJsonWithEtag(url, options = {}) {
+    const cached = etagCache.get(url);
+    const headers = Object.assign({}, options.headers);
+    if (cached) {
+        headers['If-None-Match'] = cached.etag;
+    }
+
+    const response = await fetch(url, Object.assign({}, options, { headers, cache: 'no-store' }));
+    if (response.status === 304 && cached) {
+        return { ok: true, status: 200, data: cached.data, nextCursor: cached.nextCursor };
+    }
+    if (!response.ok) {
+        const error = await response.json().catch(() => ({ error: '未知錯誤' }));
+        return { ok: false, status: response.status, data: error, nextCursor: null };
+    }
+
+    const data = await response.json();
+    const nextCursor = response.headers.get('X-Next-Cursor');
+    const etag = response.headers.get('ETag');
+    if (etag) {
+        // Map 依插入順序迭代，超過上限時移除最舊的項目
+        etagCache.delete(url);
+        etagCache.set(url, { etag, data, nextCursor });
+        if (etagCache.size > ETAG_CACHE_LIMIT) {
+            etagCache.delete(etagCache.keys().next().value);
+        }
+    }
+    return { ok: true, status: response.status, data, nextCursor };
+}
+
 // 工具函數：轉義HTML
 function escapeHtml(text) {
     const div = document.createElement('div');
@@ -1420,12 +1554,12 @@ async function loadEmployeeSales() {
     tableBody.innerHTML = '<tr><td colspan="4" style="text-align: center; padding: 20px;">載入中...</td></tr>';
     
     try {
-        const response = await fetch(`${API_BASE_URL}/admin/stats/employee-sales`, {
+        const result = await fetchJsonWithEtag(`${API_BASE_URL}/admin/stats/employee-sales`, {
             credentials: 'include'
         });
         
-        if (response.ok) {
-            const data = await response.json();
+        if (result.ok) {
+            const data = result.data;
             if (data.length === 0) {
                 tableBody.innerHTML = '<tr><td colspan="4" style="text-align: center; padding: 20px; color: #999;">尚無員工銷售記錄</td></tr>';
             } else {
@@ -1439,7 +1573,7 @@ async function loadEmployeeSales() {
                 `).join('');
             }
         } else {
-            const error = await response.json().catch(() => ({ error: '未知錯誤' }));
+            const error = result.data;
             tableBody.innerHTML = `<tr><td colspan="4" style="text-align: center; padding: 20px; color: #e74c3c;">載入失敗: ${error.error || '未知錯誤'}</td></tr>`;
         }
     } catch (error) {
@@ -1456,12 +1590,12 @@ async function loadDailyProductSales() {
     tableBody.innerHTML = '<tr><td colspan="4" style="text-align: center; padding: 20px;">載入中...</td></tr>';
     
     try {
-        const response = await fetch(`${API_BASE_URL}/admin/stats/daily-product-sales`, {
+        const result = await fetchJsonWithEtag(`${API_BASE_URL}/admin/stats/daily-product-sales`, {
             credentials: 'include'
         });
         
-        if (response.ok) {
-            const data = await response.json();
+        if (result.ok) {
+            const data = result.data;
             if (data.length === 0) {
                 tableBody.innerHTML = '<tr><td colspan="4" style="text-align: center; padding: 20px; color: #999;">今日尚無產品銷售記錄</td></tr>';
             } else {
@@ -1475,7 +1609,7 @@ async function loadDailyProductSales() {
                 `).join('');
             }
         } else {
-            const error = await response.json().catch(() => ({ error: '未知錯誤' }));
+            const error = result.data;
             tableBody.innerHTML = `<tr><td colspan="4" style="text-align: center; padding: 20px; color: #e74c3c;">載入失敗: ${error.error || '未知錯誤'}</td></tr>`;
         }
     } catch (error) {
@@ -1492,12 +1626,12 @@ async function loadEmployeeAverage() {
     tableBody.innerHTML = '<tr><td colspan="5" style="text-align: center; padding: 20px;">載入中...</td></tr>';
     
     try {
-        const response = await fetch(`${API_BASE_URL}/admin/stats/employee-average`, {
+        const result = await fetchJsonWithEtag(`${API_BASE_URL}/admin/stats/employee-average`, {
             credentials: 'include'
         });
         
-        if (response.ok) {
-            const data = await response.json();
+        if (result.ok) {
+            const data = result.data;
             if (data.length === 0) {
                 tableBody.innerHTML = '<tr><td colspan="5" style="text-align: center; padding: 20px; color: #999;">尚無員工銷售記錄</td></tr>';
             } else {
@@ -1512,7 +1646,7 @@ async function loadEmployeeAverage() {
                 `).join('');
             }
         } else {
-            const error = await response.json().catch(() => ({ error: '未知錯誤' }));
+            const error = result.data;
             tableBody.innerHTML = `<tr><td colspan="5" style="text-align: center; padding: 20px; color: #e74c3c;">載入失敗: ${error.error || '未知錯誤'}</td></tr>`;
         }
     } catch (error) {
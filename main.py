@@ -1,298 +1,2046 @@
-from flask import Flask, request, jsonify, send_from_directory, session
+from flask import Flask, request, jsonify, send_from_directory, session, has_request_context, g
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
 from flask_cors import CORS
+from werkzeug.datastructures import CallbackDict
 import mysql.connector
-from mysql.connector import Error
+from mysql.connector import Error, IntegrityError, errorcode
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import atexit
+import base64
+import bisect
+import csv
+import gzip
 import hashlib
+import hmac
+import io
+import json
+import mimetypes
+import os
+import random
 import secrets
+import signal
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zlib
 
-app = Flask(__name__, static_folder='.', static_url_path='')
+# 靜態資源只經由 serve_static 的允許清單提供（Flask 內建的靜態路由會開放整個專案目錄）
+app = Flask(__name__, static_folder=None)
 app.secret_key = secrets.token_hex(16)  # 用於session管理
 # 配置 session cookie
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
-app.config['SESSION_COOKIE_SECURE'] = False  # 開發環境設為 False，生產環境應設為 True
+app.config['SESSION_COOKIE_SECURE'] = False  # 由 SERVER_CONFIG 的 cookie_secure 設定（create_app 套用）
 app.config['SESSION_COOKIE_HTTPONLY'] = True
-CORS(app, supports_credentials=True)  # 允許跨域請求並支持憑證
+CORS(app, supports_credentials=True, expose_headers=['X-Next-Cursor', 'ETag', 'Idempotent-Replayed', 'Location'])  # 允許跨域請求並支持憑證（分頁游標、ETag、冪等重送標記與非同步結帳的狀態網址放在回應標頭）
+
+# 以下各配置為程式內預設值，部署時以 JSON 設定檔或環境變數覆寫（見 load_config）
 
 # 資料庫配置（XAMPP預設設定）
 DB_CONFIG = {
     'host': 'localhost',
+    'port': 3306,
     'user': 'root',
     'password': '',  # XAMPP預設密碼為空
     'database': 'pos_system',  # 資料庫名稱：POS收銀系統資料庫
     'charset': 'utf8mb4'
 }
 
-def get_db_connection():
-    """建立資料庫連接"""
+# 連接池配置
+POOL_CONFIG = {
+    'pool_size': 10,        # 常駐連接數
+    'max_overflow': 10,     # 尖峰時可額外建立的連接數（歸還時關閉）
+    'timeout': 5,           # 連接池耗盡時最多等待的秒數
+    'recycle': 3600,        # 連接最長存活秒數，超過則重建
+    'idle_timeout': 600,    # 閒置超過此秒數的連接直接丟棄
+    'ping_interval': 30     # 閒置超過此秒數的連接在借出前先 ping 檢查
+}
+
+# 商品目錄快取配置
+CACHE_CONFIG = {
+    'ttl': 30,              # 快取存活秒數（多個行程之間最多延遲這麼久才看到彼此的更新）
+    'max_items': 10000,     # 單品 LRU 上限
+    'max_pages': 512        # 列表頁（搜尋/分頁結果）LRU 上限
+}
+
+# Session 配置（cookie 只存隨機 session id，資料存在伺服器端，多個 worker 行程共用）
+SESSION_CONFIG = {
+    'backend': 'mysql',                 # mysql：sessions 資料表；sqlite：本機檔案（單機多行程共用，開發或無 MySQL 時使用）
+    'sqlite_path': 'sessions.sqlite3',
+    'lifetime': 12 * 3600,              # 伺服器端有效秒數，剩不到一半時於下次請求自動延長
+    'cache_ttl': 5,                     # 行程內 session 快取秒數（其他行程的登出最多延遲這麼久生效）
+    'cache_size': 10000,
+    'user_cache_ttl': 10                # 登入者角色快取秒數（角色變更最多延遲這麼久生效）
+}
+
+# 密碼雜湊配置（調整成本參數後，舊雜湊會在用戶下次登入時自動以新參數重算）
+PASSWORD_CONFIG = {
+    'scheme': 'scrypt' if hasattr(hashlib, 'scrypt') else 'pbkdf2_sha256',
+    'scrypt_n': 2 ** 14,            # scrypt 成本（2 的次方），記憶體用量約 128 × n × r 位元組
+    'scrypt_r': 8,
+    'scrypt_p': 1,
+    'pbkdf2_iterations': 600000,    # 無 scrypt 時的 PBKDF2-SHA256 迭代次數
+    'workers': 4,                   # KDF 工作執行緒數（同時計算的上限，建議不超過 CPU 核心數）
+    'max_pending': 32,              # 排隊等待 KDF 的上限，超過時等待 timeout 秒後回 503
+    'timeout': 5,
+    'cache_ttl': 300,               # 已驗證憑證快取秒數（同一組帳密重複登入時略過 KDF）
+    'cache_size': 1024
+}
+
+# 服務配置（python main.py serve：多個 worker 行程 × 每個行程多個執行緒）
+SERVER_CONFIG = {
+    'host': '0.0.0.0',
+    'port': 5000,
+    'workers': os.cpu_count() or 1,  # worker 行程數（預設每個 CPU 核心一個）
+    'threads': 8,                   # 每個 worker 的執行緒數（不宜超過 POOL_CONFIG 的 pool_size）
+    'timeout': 60,                  # worker 超過此秒數沒有回報心跳即重啟
+    'graceful_timeout': 30,         # 重新載入或停止時等待進行中請求完成的秒數
+    'max_requests': 10000,          # 每個 worker 處理這麼多請求後輪替（另加最多 10% 隨機值，避免同時重啟）
+    'preload': False,               # True：主行程先載入程式再 fork（較省記憶體，但重新載入不會更新程式碼）
+    'pidfile': 'pos.pid',           # 主行程 PID 檔（python main.py reload 使用）
+    'cookie_secure': False,         # 經 HTTPS 提供服務時設為 True
+    'debug': False                  # 只影響 python main.py 的開發伺服器，切勿在對外服務時開啟
+}
+
+# 前端靜態資源配置（python main.py build-assets 產生 dist/；未建置時直接提供原始檔且每次重新驗證）
+ASSET_CONFIG = {
+    'source_dir': '.',
+    'dist_dir': 'dist',
+    'entry': 'index.html',                          # 頁面本身：網址固定，每次重新驗證
+    'files': ['index.html', 'index.css', 'index.js']  # 允許提供的檔案，其餘路徑一律 404
+}
+
+# 效能指標配置（/api/metrics 為 Prometheus 文字格式）
+METRICS_CONFIG = {
+    'token': '',                # /api/metrics 的 Bearer token（未設定時只有管理員能讀取）
+    'dir': '',                  # 多個 worker 共用的快照目錄（serve 未設定時自動建立暫存目錄）
+    'slow_request_ms': 1000,    # 超過此毫秒數的請求連同執行的 SQL 記入慢請求記錄
+    'slow_log_size': 100,       # 每個 worker 保留最近幾筆慢請求
+    'max_statements': 50        # 每個請求最多記錄幾條 SQL
+}
+
+# 就緒檢查配置（/api/health/ready，供負載平衡器判斷是否導入流量）
+HEALTH_CONFIG = {
+    'probe_interval': 2,            # 資料庫探測結果快取秒數（檢查再頻繁，每個 worker 最多每 2 秒一次 SELECT 1）
+    'probe_timeout': 1,             # 探測時向連接池借連接的等待上限秒數
+    'max_pool_utilisation': 0.9     # 借出連接數達上限的此比例（或已有請求在排隊）時回報未就緒，先把流量導走
+}
+
+# 非同步結帳配置（enabled 時結帳只在 MySQL 扣庫存並寫入本機佇列即回應，訂單由背景執行緒批次寫入）
+ORDER_QUEUE_CONFIG = {
+    'enabled': False,
+    'path': 'order_queue.sqlite3',  # 本機 SQLite 佇列檔（同一台機器上的 worker 共用）
+    'workers': 2,                   # 每個行程的寫入執行緒數
+    'batch_size': 100,              # 每個交易（group commit）最多寫入的訂單數
+    'poll_interval': 0.05,          # 佇列為空時的等待秒數
+    'max_depth': 5000,              # 尚未寫入的訂單達此數量時結帳回 503（背壓），就緒檢查也回報未就緒
+    'max_attempts': 5,              # 單筆訂單寫入失敗達此次數即放棄並歸還庫存
+    'retention': 86400              # 已寫入或失敗的記錄保留秒數（期間可用代碼查詢狀態）
+}
+
+# 冪等鍵配置（POST /api/orders 與 PUT /api/orders/<id> 帶 Idempotency-Key 時，重送直接回傳第一次的回應）
+IDEMPOTENCY_CONFIG = {
+    'ttl': 86400,   # 保存回應的秒數，超過後同一個鍵視為新的請求
+    'lease': 60     # 處理中的鍵超過此秒數未完成即視為中斷，重送時重新執行（應不小於 SERVER_CONFIG 的 timeout）
+}
+
+# 設定檔區段名稱 -> 配置字典（環境變數為 POS_<區段>_<項目>，例如 POS_DB_PASSWORD）
+CONFIG_SECTIONS = {
+    'db': DB_CONFIG,
+    'pool': POOL_CONFIG,
+    'cache': CACHE_CONFIG,
+    'session': SESSION_CONFIG,
+    'password': PASSWORD_CONFIG,
+    'server': SERVER_CONFIG,
+    'assets': ASSET_CONFIG,
+    'metrics': METRICS_CONFIG,
+    'health': HEALTH_CONFIG,
+    'queue': ORDER_QUEUE_CONFIG,
+    'idempotency': IDEMPOTENCY_CONFIG
+}
+
+class PoolTimeoutError(Error):
+    """連接池在等待時間內沒有可用連接"""
+
+class _PoolEntry:
+    """連接池內的一條實體連接及其時間戳"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.autocommit_changed = False
+
+class PooledConnection:
+    """借出的連接代理：close() 時歸還連接池而不是真正斷線"""
+
+    def __init__(self, pool, entry):
+        object.__setattr__(self, '_pool', pool)
+        object.__setattr__(self, '_entry', entry)
+
+    def __getattr__(self, name):
+        entry = self._entry
+        if entry is None:
+            raise Error(msg='連接已歸還連接池')
+        return getattr(entry.connection, name)
+
+    def __setattr__(self, name, value):
+        entry = self._entry
+        if entry is None:
+            raise Error(msg='連接已歸還連接池')
+        if name == 'autocommit':
+            entry.autocommit_changed = True
+        setattr(entry.connection, name, value)
+
+    def cursor(self, *args, **kwargs):
+        """建立游標（包上計時代理，SQL 次數與時間計入建立游標時所在的請求）"""
+        entry = self._entry
+        if entry is None:
+            raise Error(msg='連接已歸還連接池')
+        return InstrumentedCursor(entry.connection.cursor(*args, **kwargs), current_query_log())
+
+    def close(self):
+        """歸還連接（可重複呼叫）"""
+        entry = self._entry
+        if entry is not None:
+            object.__setattr__(self, '_entry', None)
+            self._pool.release(entry)
+
+class InstrumentedCursor:
+    """游標代理：execute / executemany 與讀取結果的時間計入建立游標時所在請求的 SQL 記錄"""
+    __slots__ = ('_cursor', '_query_log')
+
+    def __init__(self, cursor, query_log=None):
+        self._cursor = cursor
+        # 建立時取得，串流回應在請求結束後才讀取的結果也計入同一個請求
+        self._query_log = query_log
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, operation, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(operation, *args, **kwargs)
+        finally:
+            record_query(self._query_log, operation, time.perf_counter() - started)
+
+    def executemany(self, operation, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._cursor.executemany(operation, *args, **kwargs)
+        finally:
+            record_query(self._query_log, operation, time.perf_counter() - started)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return self._cursor.fetchone()
+        finally:
+            record_query(self._query_log, None, time.perf_counter() - started)
+
+    def fetchmany(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._cursor.fetchmany(*args, **kwargs)
+        finally:
+            record_query(self._query_log, None, time.perf_counter() - started)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return self._cursor.fetchall()
+        finally:
+            record_query(self._query_log, None, time.perf_counter() - started)
+
+class ConnectionPool:
+    """MySQL 連接池：固定大小 + 溢出、借出前健康檢查、存活/閒置回收、耗盡時限時等待"""
+
+    def __init__(self, db_config, pool_size=10, max_overflow=10, timeout=5,
+                 recycle=3600, idle_timeout=600, ping_interval=30):
+        self.db_config = dict(db_config, autocommit=True)
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.idle_timeout = idle_timeout
+        self.ping_interval = ping_interval
+        self._idle = deque()
+        self._size = 0  # 已建立的連接數（閒置 + 借出）
+        self._waiting = 0  # 正在等待連接的執行緒數
+        self._cond = threading.Condition()
+        self.pid = os.getpid()  # 建立連接池的行程（fork 後的子行程不可沿用）
+
+    def _is_usable(self, entry):
+        """檢查閒置連接是否仍可使用"""
+        now = time.monotonic()
+        if now - entry.created_at > self.recycle or now - entry.last_used > self.idle_timeout:
+            return False
+        if now - entry.last_used > self.ping_interval:
+            try:
+                entry.connection.ping(reconnect=False)
+            except Error:
+                return False
+        return True
+
+    @staticmethod
+    def _close_quietly(entry):
+        try:
+            if entry.connection.unread_result:
+                # 還有未讀完的結果列時 QUIT 會失敗，直接關閉 socket
+                entry.connection.shutdown()
+            else:
+                entry.connection.close()
+        except Error:
+            pass
+
+    def acquire(self, timeout=None):
+        """借出連接，池已滿時最多等待 timeout 秒（預設為連接池設定）"""
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        entry = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    # 後進先出：優先重用最近使用過的連接
+                    entry = self._idle.pop()
+                    break
+                if self._size < self.pool_size + self.max_overflow:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeoutError(msg=f'連接池已耗盡（等待 {timeout} 秒）')
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+        # 網路 I/O 在鎖外進行；失效的連接沿用原本的名額重建
+        if entry is not None:
+            if self._is_usable(entry):
+                return PooledConnection(self, entry)
+            self._close_quietly(entry)
+        try:
+            entry = _PoolEntry(mysql.connector.connect(**self.db_config))
+        except Error:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        return PooledConnection(self, entry)
+
+    def release(self, entry):
+        """歸還連接：回滾未提交的交易並恢復自動提交，溢出的連接直接關閉"""
+        connection = entry.connection
+        discard = False
+        try:
+            # 串流查詢中途中止（例如用戶端斷線）時結果未讀完，斷線比讀完剩下的資料便宜
+            if connection.unread_result:
+                discard = True
+            elif connection.in_transaction:
+                connection.rollback()
+            if not discard and entry.autocommit_changed:
+                connection.autocommit = True
+                entry.autocommit_changed = False
+        except Error:
+            discard = True
+
+        now = time.monotonic()
+        with self._cond:
+            if discard or now - entry.created_at > self.recycle or len(self._idle) >= self.pool_size:
+                self._size -= 1
+            else:
+                entry.last_used = now
+                self._idle.append(entry)
+                entry = None
+            self._cond.notify()
+        if entry is not None:
+            self._close_quietly(entry)
+
+    def close(self):
+        """關閉所有閒置連接（借出中的連接歸還時照常處理）"""
+        with self._cond:
+            entries = list(self._idle)
+            self._idle.clear()
+            self._size -= len(entries)
+            self._cond.notify_all()
+        for entry in entries:
+            self._close_quietly(entry)
+
+    def stats(self):
+        """連接池使用狀況"""
+        with self._cond:
+            idle = len(self._idle)
+            return {
+                'size': self._size,
+                'idle': idle,
+                'in_use': self._size - idle,
+                'waiting': self._waiting,
+                'max': self.pool_size + self.max_overflow
+            }
+
+class CatalogCache:
+    """商品目錄快取：單品 LRU + TTL，列表頁只快取商品 ID 順序，頁內商品失效即整頁未命中"""
+
+    def __init__(self, ttl=30, max_items=10000, max_pages=512):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.max_pages = max_pages
+        self._items = OrderedDict()  # product_id -> (到期時間, 商品)
+        self._pages = OrderedDict()  # 查詢鍵 -> (到期時間, (商品ID列表, 下一頁游標))
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, store, key, now):
+        entry = store.get(key)
+        if entry is None:
+            return None
+        if entry[0] < now:
+            del store[key]
+            return None
+        store.move_to_end(key)
+        return entry[1]
+
+    def _put(self, store, key, value, limit):
+        store[key] = (time.monotonic() + self.ttl, value)
+        store.move_to_end(key)
+        while len(store) > limit:
+            store.popitem(last=False)
+
+    def generation(self):
+        """讀取資料庫前取得世代號；期間若有失效，讀到的舊資料不會寫回快取"""
+        with self._lock:
+            return self._generation
+
+    def get_item(self, product_id):
+        """取得單一商品"""
+        with self._lock:
+            product = self._get(self._items, product_id, time.monotonic())
+            if product is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return product
+
+    def get_page(self, key):
+        """取得列表頁，回傳 (商品列表, 下一頁游標)"""
+        with self._lock:
+            now = time.monotonic()
+            page = self._get(self._pages, key, now)
+            if page is not None:
+                product_ids, next_cursor = page
+                products = [self._get(self._items, product_id, now) for product_id in product_ids]
+                if None not in products:
+                    self.hits += 1
+                    return products, next_cursor
+            self.misses += 1
+            return None
+
+    def put_item(self, product, generation):
+        """寫入單一商品"""
+        with self._lock:
+            if generation == self._generation:
+                self._put(self._items, product['id'], product, self.max_items)
+
+    def put_page(self, key, products, next_cursor, generation):
+        """寫入列表頁及頁內商品"""
+        with self._lock:
+            if generation != self._generation:
+                return
+            for product in products:
+                self._put(self._items, product['id'], product, self.max_items)
+            self._put(self._pages, key, ([product['id'] for product in products], next_cursor), self.max_pages)
+
+    def invalidate_items(self, product_ids):
+        """商品資料或庫存變更後失效；包含這些商品的列表頁也會隨之未命中"""
+        with self._lock:
+            self._generation += 1
+            for product_id in product_ids:
+                self._items.pop(product_id, None)
+
+    def invalidate_pages(self):
+        """新增、刪除或改名會改變列表成員，清除所有列表頁"""
+        with self._lock:
+            self._generation += 1
+            self._pages.clear()
+
+    def invalidate_all(self):
+        """大量商品變更（批次匯入）後清除整個快取"""
+        with self._lock:
+            self._generation += 1
+            self._items.clear()
+            self._pages.clear()
+
+    def stats(self):
+        """命中統計"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 4) if total else 0.0,
+                'items': len(self._items),
+                'pages': len(self._pages)
+            }
+
+catalog_cache = CatalogCache(**CACHE_CONFIG)
+
+class KdfBusyError(Exception):
+    """KDF 工作佇列已滿"""
+
+def _b64encode(data):
+    return base64.b64encode(data).decode('ascii')
+
+def _b64decode(text):
+    return base64.b64decode(text.encode('ascii'))
+
+class PasswordHasher:
+    """加鹽密碼雜湊（scrypt / PBKDF2）：KDF 在有上限的執行緒池中計算，並快取最近驗證成功的憑證"""
+    # hashlib 的 scrypt 與 pbkdf2_hmac 計算時會釋放 GIL，工作執行緒可以同時使用多個核心
+
+    def __init__(self, scheme='scrypt', scrypt_n=2 ** 14, scrypt_r=8, scrypt_p=1,
+                 pbkdf2_iterations=600000, workers=4, max_pending=32, timeout=5,
+                 cache_ttl=300, cache_size=1024):
+        self.scheme = scheme
+        self.scrypt_params = (scrypt_n, scrypt_r, scrypt_p)
+        self.pbkdf2_iterations = pbkdf2_iterations
+        self.workers = workers
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._verified = OrderedDict()  # HMAC(雜湊值, 密碼) -> 到期時間
+        self._cache_key = secrets.token_bytes(32)
+        self._dummy_hash = None
+
+    # 同步計算（供工作執行緒與初始化使用）
+
+    def hash_sync(self, password):
+        """以目前設定產生 "scheme$參數$salt$hash" 格式的雜湊"""
+        salt = secrets.token_bytes(16)
+        if self.scheme == 'scrypt':
+            n, r, p = self.scrypt_params
+            derived = self._scrypt(password, salt, n, r, p, 32)
+            return f"scrypt${n}${r}${p}${_b64encode(salt)}${_b64encode(derived)}"
+        derived = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, self.pbkdf2_iterations)
+        return f"pbkdf2_sha256${self.pbkdf2_iterations}${_b64encode(salt)}${_b64encode(derived)}"
+
+    def verify_sync(self, password, stored):
+        """驗證密碼，回傳 (是否正確, 是否應以目前設定重新雜湊)；資料庫中的雜湊格式錯誤時視為密碼錯誤"""
+        parts = stored.split('$')
+        try:
+            if parts[0] == 'scrypt' and len(parts) == 6:
+                n, r, p = (int(value) for value in parts[1:4])
+                expected = _b64decode(parts[5])
+                ok = hmac.compare_digest(self._scrypt(password, _b64decode(parts[4]), n, r, p, len(expected)), expected)
+                outdated = self.scheme != 'scrypt' or (n, r, p) != self.scrypt_params
+            elif parts[0] == 'pbkdf2_sha256' and len(parts) == 4:
+                iterations = int(parts[1])
+                expected = _b64decode(parts[3])
+                derived = hashlib.pbkdf2_hmac('sha256', password.encode(), _b64decode(parts[2]), iterations)
+                ok = hmac.compare_digest(derived, expected)
+                outdated = self.scheme != 'pbkdf2_sha256' or iterations != self.pbkdf2_iterations
+            else:
+                # 舊版未加鹽的 SHA256 十六進位雜湊
+                ok = hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+                outdated = True
+        except (ValueError, TypeError, OverflowError) as e:
+            # 參數不是整數、base64 損毀、KDF 參數無效等；不記錄雜湊內容
+            print(f"警告：密碼雜湊格式錯誤（{type(e).__name__}），視為密碼錯誤")
+            return False, False
+        return ok, ok and outdated
+
+    @staticmethod
+    def _scrypt(password, salt, n, r, p, dklen):
+        # OpenSSL 預設記憶體上限為 32MB，依參數放寬
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                              maxmem=128 * r * (n + p + 2) + 1024 * 1024, dklen=dklen)
+
+    # 經由工作執行緒池計算
+
+    def _run(self, func, *args):
+        """在 KDF 執行緒池中執行，回傳 (結果, 該次計算的 CPU 秒數)"""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise KdfBusyError('KDF 工作佇列已滿')
+        try:
+            with self._lock:
+                # fork 後繼承的執行緒池沒有工作執行緒，子行程需自行建立
+                if self._executor is None or self._executor_pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='kdf')
+                    self._executor_pid = os.getpid()
+                self._in_flight += 1
+            return self._executor.submit(self._timed, func, *args).result()
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._slots.release()
+
+    @staticmethod
+    def _timed(func, *args):
+        started = time.thread_time()
+        result = func(*args)
+        return result, time.thread_time() - started
+
+    def hash(self, password):
+        """產生新雜湊，回傳 (雜湊, CPU 秒數)"""
+        return self._run(self.hash_sync, password)
+
+    def verify(self, password, stored):
+        """驗證密碼，回傳 (是否正確, 是否需重新雜湊, CPU 秒數, 是否命中快取)；stored 為 None 時仍計算一次以免洩漏帳號是否存在"""
+        if stored is None:
+            if self._dummy_hash is None:
+                self._dummy_hash = self.hash_sync(secrets.token_hex(16))
+            _, cpu_seconds = self._run(self.verify_sync, password, self._dummy_hash)
+            return False, False, cpu_seconds, False
+        
+        cache_key = hmac.new(self._cache_key, f'{stored}\0{password}'.encode(), hashlib.sha256).digest()
+        now = time.monotonic()
+        with self._lock:
+            expires = self._verified.get(cache_key)
+            if expires is not None and expires > now:
+                self._verified.move_to_end(cache_key)
+                return True, False, 0.0, True
+        
+        (ok, needs_rehash), cpu_seconds = self._run(self.verify_sync, password, stored)
+        if ok and not needs_rehash:
+            with self._lock:
+                self._verified[cache_key] = now + self.cache_ttl
+                self._verified.move_to_end(cache_key)
+                while len(self._verified) > self.cache_size:
+                    self._verified.popitem(last=False)
+        return ok, needs_rehash, cpu_seconds, False
+
+    def stats(self):
+        """KDF 設定與目前負載"""
+        with self._lock:
+            return {
+                'scheme': self.scheme,
+                'cost': self.scrypt_params if self.scheme == 'scrypt' else self.pbkdf2_iterations,
+                'workers': self.workers,
+                'in_flight': self._in_flight,
+                'cached_credentials': len(self._verified)
+            }
+
+password_hasher = PasswordHasher(**PASSWORD_CONFIG)
+
+class LoginMetrics:
+    """登入次數、延遲與每次登入的 KDF CPU 時間（保留最近 window 次計算百分位數）"""
+
+    def __init__(self, window=1000):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self._cpu = deque(maxlen=window)
+        self.counts = {'success': 0, 'failure': 0, 'busy': 0, 'cache_hit': 0, 'rehashed': 0}
+
+    def record(self, outcome, latency, cpu_seconds=0.0, cache_hit=False, rehashed=False):
+        """記錄一次登入（outcome 為 success / failure / busy）"""
+        with self._lock:
+            self.counts[outcome] += 1
+            self.counts['cache_hit'] += cache_hit
+            self.counts['rehashed'] += rehashed
+            self._latencies.append(latency)
+            self._cpu.append(cpu_seconds)
+        metrics.inc('pos_logins_total', f'outcome="{outcome}"')
+        metrics.observe('pos_login_duration_seconds', '', latency)
+        metrics.inc('pos_kdf_cpu_seconds_total', '', cpu_seconds)
+        if cache_hit:
+            metrics.inc('pos_login_cache_hits_total')
+
+    @staticmethod
+    def _percentile(values, fraction):
+        return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+    def stats(self):
+        """登入統計（時間單位為毫秒）"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            cpu = list(self._cpu)
+            return {
+                **self.counts,
+                'latency_ms': {
+                    'p50': round(self._percentile(latencies, 0.5) * 1000, 2),
+                    'p95': round(self._percentile(latencies, 0.95) * 1000, 2),
+                    'max': round(latencies[-1] * 1000, 2) if latencies else 0.0
+                },
+                'cpu_ms_per_login': round(sum(cpu) / len(cpu) * 1000, 2) if cpu else 0.0
+            }
+
+login_metrics = LoginMetrics()
+
+# 直方圖區間上限（Prometheus 的 le 標籤）
+HISTOGRAM_BUCKETS = {
+    'pos_http_request_duration_seconds': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    'pos_http_response_bytes': (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304),
+    'pos_db_queries_per_request': (0, 1, 2, 5, 10, 20, 50, 100),
+    'pos_db_pool_wait_seconds': (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5),
+    'pos_login_duration_seconds': (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+    'pos_order_queue_batch_size': (1, 2, 5, 10, 20, 50, 100, 200),
+    'pos_order_queue_lag_seconds': (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+}
+
+METRIC_HELP = {
+    'pos_http_requests_total': ('counter', '請求數（依路由、方法與狀態碼）'),
+    'pos_http_request_duration_seconds': ('histogram', '請求延遲（含串流回應的傳送時間）'),
+    'pos_http_request_bytes_total': ('counter', '請求內容位元組數'),
+    'pos_http_response_bytes': ('histogram', '回應內容位元組數'),
+    'pos_db_queries_total': ('counter', '請求內執行的 SQL 數'),
+    'pos_db_seconds_total': ('counter', '請求內 SQL 執行與讀取結果的累計秒數'),
+    'pos_db_queries_per_request': ('histogram', '每個請求執行的 SQL 數'),
+    'pos_db_pool_wait_seconds': ('histogram', '向連接池借出連接的等待時間（含新建連接）'),
+    'pos_db_pool_errors_total': ('counter', '借出連接失敗次數（連接池耗盡或資料庫無法連線）'),
+    'pos_slow_requests_total': ('counter', '超過 slow_request_ms 的請求數'),
+    'pos_logins_total': ('counter', '登入次數（依結果）'),
+    'pos_login_duration_seconds': ('histogram', '登入延遲'),
+    'pos_login_cache_hits_total': ('counter', '命中憑證快取而略過 KDF 的登入次數'),
+    'pos_kdf_cpu_seconds_total': ('counter', '登入驗證密碼的 KDF CPU 秒數'),
+    'pos_order_queue_orders_total': ('counter', '非同步結帳佇列處理的訂單數（依結果）'),
+    'pos_order_queue_batch_size': ('histogram', '每個 group commit 交易寫入的訂單數'),
+    'pos_order_queue_lag_seconds': ('histogram', '訂單從受理到寫入 MySQL 的時間'),
+    'pos_order_queue_rejected_total': ('counter', '佇列已滿而拒絕的結帳數'),
+    'pos_workers': ('gauge', '回報指標的 worker 行程數'),
+    'pos_db_pool_connections': ('gauge', '連接池連接數（依狀態）'),
+    'pos_kdf_in_flight': ('gauge', '正在計算或排隊中的 KDF 工作'),
+    'pos_sessions_cached': ('gauge', '行程內快取的 session 數')
+}
+
+def format_metric(value):
+    """指標數值：整數不帶小數點，浮點數保留完整精度"""
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def escape_label(value):
+    """Prometheus 標籤值跳脫"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metrics:
+    """Prometheus 指標（計數器與直方圖）；設定 directory 時各 worker 定期寫出快照，抓取時加總所有 worker"""
+
+    def __init__(self, directory='', flush_interval=1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._counters = {}    # (名稱, 標籤) -> 值
+        self._histograms = {}  # (名稱, 標籤) -> [各區間次數..., 超過最大區間的次數, 總和]
+        self._flushed_at = 0.0
+
+    def _inc(self, name, labels, value):
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def _observe(self, name, labels, value):
+        buckets = HISTOGRAM_BUCKETS[name]
+        entry = self._histograms.get((name, labels))
+        if entry is None:
+            entry = self._histograms[(name, labels)] = [0] * (len(buckets) + 2)
+        entry[bisect.bisect_left(buckets, value)] += 1
+        entry[-1] += value
+
+    def inc(self, name, labels='', value=1):
+        with self._lock:
+            self._inc(name, labels, value)
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            self._observe(name, labels, value)
+
+    def record_request(self, route, method, status, seconds, request_bytes, response_bytes, query_log):
+        """記錄一個完成的請求（一次取鎖）"""
+        labels = f'route="{escape_label(route)}",method="{method}"'
+        queries = query_log.queries if query_log else 0
+        with self._lock:
+            self._inc('pos_http_requests_total', f'{labels},status="{status}"', 1)
+            self._observe('pos_http_request_duration_seconds', labels, seconds)
+            self._inc('pos_http_request_bytes_total', labels, request_bytes)
+            self._observe('pos_http_response_bytes', labels, response_bytes)
+            self._observe('pos_db_queries_per_request', labels, queries)
+            if query_log:
+                self._inc('pos_db_queries_total', labels, queries)
+                self._inc('pos_db_seconds_total', labels, query_log.seconds)
+
+    def snapshot(self):
+        """本行程的指標（可序列化為 JSON）"""
+        with self._lock:
+            counters = [[name, labels, value] for (name, labels), value in self._counters.items()]
+            histograms = [[name, labels, list(entry)] for (name, labels), entry in self._histograms.items()]
+        return {'counters': counters, 'histograms': histograms, 'gauges': collect_gauges()}
+
+    @staticmethod
+    def _merge(total, snapshot, gauges=True):
+        for name, labels, value in snapshot['counters']:
+            total['counters'][(name, labels)] = total['counters'].get((name, labels), 0) + value
+        for name, labels, entry in snapshot['histograms']:
+            merged = total['histograms'].get((name, labels))
+            if merged is None:
+                total['histograms'][(name, labels)] = list(entry)
+            elif len(merged) == len(entry):
+                for index, value in enumerate(entry):
+                    merged[index] += value
+        if gauges:
+            for name, labels, value in snapshot['gauges']:
+                total['gauges'][(name, labels)] = total['gauges'].get((name, labels), 0) + value
+
+    def flush(self, force=False):
+        """把本行程的快照寫到共用目錄（每 flush_interval 秒最多一次）"""
+        if not self.directory:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._flushed_at < self.flush_interval:
+                return
+            self._flushed_at = now
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        temp_path = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"寫入指標快照失敗: {e}")
+
+    @staticmethod
+    def _to_snapshot(total):
+        return {
+            'counters': [[name, labels, value] for (name, labels), value in total['counters'].items()],
+            'histograms': [[name, labels, entry] for (name, labels), entry in total['histograms'].items()],
+            'gauges': []
+        }
+
+    def _collect_directory(self, total):
+        """加總共用目錄中各 worker 的快照；已結束行程的計數併入 archive.json，避免檔案越積越多"""
+        self.flush(force=True)
+        try:
+            import fcntl
+        except ImportError:
+            fcntl = None  # 無檔案鎖（Windows）時不歸檔，只加總
+        archive_path = os.path.join(self.directory, 'archive.json')
+        archived = {'counters': {}, 'histograms': {}, 'gauges': {}}
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(archive_path, encoding='utf-8') as f:
+                    self._merge(archived, json.load(f), gauges=False)
+            except (OSError, ValueError):
+                pass
+            changed = False
+            for name in os.listdir(self.directory):
+                if not name.endswith('.json') or not name[:-5].isdigit():
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    with open(path, encoding='utf-8') as f:
+                        snapshot = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                pid = int(name[:-5])
+                if fcntl and pid != os.getpid() and not pid_alive(pid):
+                    self._merge(archived, snapshot, gauges=False)
+                    os.remove(path)
+                    changed = True
+                else:
+                    self._merge(total, snapshot)
+            if changed:
+                temp_path = archive_path + '.tmp'
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(self._to_snapshot(archived), f)
+                os.replace(temp_path, archive_path)
+        self._merge(total, self._to_snapshot(archived), gauges=False)
+
+    def render(self):
+        """所有 worker 加總後的 Prometheus 文字格式"""
+        total = {'counters': {}, 'histograms': {}, 'gauges': {}}
+        if self.directory:
+            self._collect_directory(total)
+        else:
+            self._merge(total, self.snapshot())
+        
+        # 每個指標名稱下依標籤排序；直方圖同一組標籤的各行保持產生順序（le 由小到大，接著 _sum、_count）
+        series = {}
+        for (name, labels), value in list(total['counters'].items()) + list(total['gauges'].items()):
+            series.setdefault(name, []).append((labels, [f"{name}{{{labels}}} {format_metric(value)}" if labels else f"{name} {format_metric(value)}"]))
+        for (name, labels), entry in total['histograms'].items():
+            lines = []
+            series.setdefault(name, []).append((labels, lines))
+            prefix = f"{labels}," if labels else ''
+            cumulative = 0
+            for bound, count in zip(HISTOGRAM_BUCKETS[name] + ('+Inf',), entry[:-1]):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            suffix = f"{{{labels}}}" if labels else ''
+            lines.append(f"{name}_sum{suffix} {format_metric(entry[-1])}")
+            lines.append(f"{name}_count{suffix} {cumulative}")
+        
+        output = []
+        for name in sorted(series):
+            kind, description = METRIC_HELP.get(name, ('untyped', ''))
+            output.append(f"# HELP {name} {description}")
+            output.append(f"# TYPE {name} {kind}")
+            for _, lines in sorted(series[name]):
+                output.extend(lines)
+        return '\n'.join(output) + '\n'
+
+def pid_alive(pid):
+    """行程是否仍存在（同一台機器）"""
     try:
-        connection = mysql.connector.connect(**DB_CONFIG)
-        return connection
-    except Error as e:
-        print(f"資料庫連接錯誤: {e}")
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+def collect_gauges():
+    """本行程目前的連接池、KDF 工作池與 session 快取狀態"""
+    gauges = [['pos_workers', '', 1]]
+    pool = _pool
+    if pool is not None and pool.pid == os.getpid():
+        for state, value in pool.stats().items():
+            gauges.append(['pos_db_pool_connections', f'state="{state}"', value])
+    gauges.append(['pos_kdf_in_flight', '', password_hasher.stats()['in_flight']])
+    if isinstance(app.session_interface, ServerSessionInterface):
+        gauges.append(['pos_sessions_cached', '', app.session_interface.stats()['cached_sessions']])
+    return gauges
+
+metrics = Metrics(METRICS_CONFIG['dir'])
+atexit.register(lambda: metrics.flush(force=True))
+
+class QueryLog:
+    """單一請求內執行的 SQL：次數、累計時間、借連接等待時間與前幾條語句（慢請求記錄用）"""
+    __slots__ = ('queries', 'seconds', 'pool_wait', 'statements')
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.pool_wait = 0.0
+        self.statements = []  # [SQL, 秒數]，讀取結果的時間計入前一條
+
+def current_query_log():
+    """目前請求的 SQL 記錄（請求以外的呼叫回傳 None）"""
+    if not has_request_context():
         return None
+    environ = request.environ
+    query_log = environ.get('pos.query_log')
+    if query_log is None:
+        query_log = environ['pos.query_log'] = QueryLog()
+    return query_log
+
+def record_query(query_log, sql, seconds):
+    """把一次 SQL 執行（sql 為 None 時為讀取結果）計入請求的 SQL 記錄；只記錄 SQL 樣板，不記錄參數"""
+    if query_log is None:
+        return
+    query_log.seconds += seconds
+    if sql is not None:
+        query_log.queries += 1
+        if len(query_log.statements) < METRICS_CONFIG['max_statements']:
+            query_log.statements.append([' '.join(str(sql).split())[:500], seconds])
+    elif query_log.statements:
+        query_log.statements[-1][1] += seconds
 
-def init_database():
-    """初始化資料庫和表格"""
+class SlowRequestLog:
+    """最近的慢請求（每個 worker 各自保留）"""
+
+    def __init__(self, size=100):
+        self._entries = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, entry):
+        with self._lock:
+            self._entries.append(entry)
+
+    def recent(self):
+        with self._lock:
+            return list(reversed(self._entries))
+
+slow_requests = SlowRequestLog(METRICS_CONFIG['slow_log_size'])
+
+def finish_request(environ, status, seconds, response_bytes):
+    """請求完成（回應已送出）時記錄指標，超過門檻時寫入慢請求記錄"""
+    route = environ.get('pos.route', 'unmatched')
+    method = environ.get('REQUEST_METHOD', '')
+    query_log = environ.get('pos.query_log')
     try:
-        # 先連接到MySQL（不指定資料庫）
-        connection = mysql.connector.connect(
-            host=DB_CONFIG['host'],
-            user=DB_CONFIG['user'],
-            password=DB_CONFIG['password']
-        )
-        cursor = connection.cursor()
+        request_bytes = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        request_bytes = 0
+    metrics.record_request(route, method, status, seconds, request_bytes, response_bytes, query_log)
+    
+    if seconds * 1000 >= METRICS_CONFIG['slow_request_ms']:
+        metrics.inc('pos_slow_requests_total', f'route="{escape_label(route)}"')
+        entry = {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'method': method,
+            'path': environ.get('PATH_INFO', ''),
+            'route': route,
+            'status': status,
+            'ms': round(seconds * 1000, 1),
+            'db_queries': query_log.queries if query_log else 0,
+            'db_ms': round(query_log.seconds * 1000, 1) if query_log else 0.0,
+            'pool_wait_ms': round(query_log.pool_wait * 1000, 1) if query_log else 0.0,
+            'sql': [{'sql': sql, 'ms': round(sql_seconds * 1000, 1)} for sql, sql_seconds in query_log.statements] if query_log else []
+        }
+        slow_requests.record(entry)
+        print(f"慢請求 {method} {entry['path']} {status} {entry['ms']} ms"
+              f"（SQL {entry['db_queries']} 次 {entry['db_ms']} ms，等待連接 {entry['pool_wait_ms']} ms）")
+        for statement in entry['sql']:
+            print(f"    {statement['ms']:>8} ms  {statement['sql'][:200]}")
+    metrics.flush()
+
+class MetricsBody:
+    """包裝 WSGI 回應內容：計算送出的位元組數，送完（close）時記錄請求"""
+
+    def __init__(self, body, environ, status, started):
+        self.body = body
+        self.environ = environ
+        self.status = status
+        self.started = started
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            status = int(self.status[-1].split(' ', 1)[0]) if self.status else 500
+            finish_request(self.environ, status, time.perf_counter() - self.started, self.size)
+
+class MetricsMiddleware:
+    """WSGI 中介層：量測每個請求從進入到回應送完的時間（包含 session 載入與串流回應）"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        status = []
         
-        # 創建資料庫（如果不存在）
-        cursor.execute(f"CREATE DATABASE IF NOT EXISTS {DB_CONFIG['database']} CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci")
-        cursor.execute(f"USE {DB_CONFIG['database']}")
+        def start(status_line, headers, exc_info=None):
+            status.append(status_line)
+            return start_response(status_line, headers, exc_info)
         
-        # 創建用戶表（系統使用者資料表）
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INT AUTO_INCREMENT PRIMARY KEY COMMENT '使用者唯一識別碼',
-                username VARCHAR(50) NOT NULL UNIQUE COMMENT '使用者登入帳號（唯一）',
-                password VARCHAR(255) NOT NULL COMMENT '使用者密碼（SHA256雜湊值）',
-                name VARCHAR(100) COMMENT '使用者真實姓名',
-                role VARCHAR(20) DEFAULT 'user' COMMENT '使用者角色：user（一般用戶）或 admin（管理員）',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '帳號建立時間',
-                INDEX idx_username (username)
-            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='系統使用者資料表'
-        """)
+        return MetricsBody(self.wsgi_app(environ, start), environ, status, started)
 
-        # 創建商品表（商品資料表）
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS products (
-                id INT AUTO_INCREMENT PRIMARY KEY COMMENT '商品唯一識別碼',
-                name VARCHAR(255) NOT NULL COMMENT '商品名稱',
-                price DECIMAL(10, 2) NOT NULL COMMENT '商品單價（新台幣）',
-                stock INT NOT NULL DEFAULT 0 COMMENT '商品庫存數量',
-                description TEXT COMMENT '商品詳細描述',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '商品建立時間',
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT '商品最後更新時間'
-            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='商品資料表'
-        """)
-        
-        # 創建訂單表（訂單主檔）
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS orders (
-                id INT AUTO_INCREMENT PRIMARY KEY COMMENT '訂單唯一識別碼（訂單編號）',
-                user_id INT COMMENT '下單使用者ID（關聯到users表）',
-                subtotal DECIMAL(10, 2) NOT NULL COMMENT '訂單小計金額（未含稅）',
-                tax DECIMAL(10, 2) NOT NULL COMMENT '訂單稅額（營業稅5%）',
-                total DECIMAL(10, 2) NOT NULL COMMENT '訂單總金額（含稅）',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '訂單建立時間',
-                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE SET NULL,
-                INDEX idx_user_id (user_id)
-            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='訂單主檔資料表'
-        """)
+class SqlSessionStore:
+    """Session 儲存區：MySQL sessions 資料表"""
+
+    def load(self, key, now):
+        """讀取未過期的 session，回傳 (資料, 到期時間) 或 None"""
+        with db_connection() as connection:
+            if not connection:
+                return None
+            try:
+                cursor = connection.cursor()
+                cursor.execute("SELECT data, expires_at FROM sessions WHERE id = %s AND expires_at > %s", (key, now))
+                return cursor.fetchone()
+            except Error as e:
+                print(f"讀取 session 失敗: {e}")
+                return None
+
+    def save(self, key, data, user_id, expires_at):
+        """寫入或更新 session"""
+        with db_connection() as connection:
+            if not connection:
+                return
+            try:
+                connection.cursor().execute("""
+                    INSERT INTO sessions (id, user_id, data, expires_at)
+                    VALUES (%s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE
+                        user_id = VALUES(user_id),
+                        data = VALUES(data),
+                        expires_at = VALUES(expires_at)
+                """, (key, user_id, data, expires_at))
+            except Error as e:
+                print(f"寫入 session 失敗: {e}")
+
+    def delete(self, key):
+        """刪除 session"""
+        with db_connection() as connection:
+            if not connection:
+                return
+            try:
+                connection.cursor().execute("DELETE FROM sessions WHERE id = %s", (key,))
+            except Error as e:
+                print(f"刪除 session 失敗: {e}")
+
+    def purge(self, now):
+        """清除過期的 session（每次最多 1000 筆，避免長時間鎖表）"""
+        with db_connection() as connection:
+            if not connection:
+                return
+            try:
+                connection.cursor().execute("DELETE FROM sessions WHERE expires_at <= %s LIMIT 1000", (now,))
+            except Error as e:
+                print(f"清除過期 session 失敗: {e}")
+
+class SqliteSessionStore:
+    """Session 儲存區：本機 SQLite 檔案（WAL 模式，同一台機器上的多個行程可共用）"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        # sqlite3 連接不能跨執行緒或跨 fork 共用，依執行緒與行程各自建立
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id TEXT PRIMARY KEY,
+                    user_id INTEGER,
+                    data TEXT NOT NULL,
+                    expires_at INTEGER NOT NULL
+                )
+            """)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def load(self, key, now):
+        return self._connection().execute(
+            "SELECT data, expires_at FROM sessions WHERE id = ? AND expires_at > ?", (key, now)
+        ).fetchone()
+
+    def save(self, key, data, user_id, expires_at):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO sessions (id, user_id, data, expires_at) VALUES (?, ?, ?, ?)",
+            (key, user_id, data, expires_at)
+        )
+
+    def delete(self, key):
+        self._connection().execute("DELETE FROM sessions WHERE id = ?", (key,))
+
+    def purge(self, now):
+        self._connection().execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+
+class ServerSession(CallbackDict, SessionMixin):
+    """伺服器端 session：內容存在 session 儲存區，cookie 只帶 session id"""
+
+    def __init__(self, initial=None, sid=None, expires_at=0):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.loaded_user_id = self.get('user_id')  # 登入者改變（登入/登出）時換發新的 session id
+        self.modified = False
+
+class ServerSessionInterface(SessionInterface):
+    """以 session id 為鍵的伺服器端 session，前面加一層短 TTL 的行程內 LRU 快取"""
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, lifetime=12 * 3600, cache_ttl=5, cache_size=10000):
+        self.store = store
+        self.lifetime = lifetime
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # session id 雜湊 -> (快取到期, 資料, 伺服器端到期時間)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(sid):
+        # 儲存區只保存 session id 的雜湊，資料庫外洩也無法直接冒用 cookie
+        return hashlib.sha256(sid.encode()).hexdigest()
+
+    def _remember(self, key, data, expires_at):
+        with self._lock:
+            self._cache[key] = (time.monotonic() + self.cache_ttl, data, expires_at)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _forget(self, key):
+        with self._lock:
+            self._cache.pop(key, None)
+
+    def _load(self, key, now):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._cache.move_to_end(key)
+                return (dict(entry[1]), entry[2]) if entry[2] > now else None
+        record = self.store.load(key, now)
+        if record is None:
+            self._forget(key)
+            return None
+        data = self.serializer.loads(record[0])
+        self._remember(key, data, record[1])
+        return dict(data), record[1]
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            record = self._load(self._key(sid), int(time.time()))
+            if record is not None:
+                return ServerSession(record[0], sid, record[1])
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
         
-        # 創建訂單項目表（訂單明細檔）
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS order_items (
-                id INT AUTO_INCREMENT PRIMARY KEY COMMENT '訂單項目唯一識別碼',
-                order_id INT NOT NULL COMMENT '所屬訂單ID（關聯到orders表）',
-                product_id INT NOT NULL COMMENT '商品ID（關聯到products表）',
-                quantity INT NOT NULL COMMENT '購買數量',
-                price DECIMAL(10, 2) NOT NULL COMMENT '購買時的商品單價（保留歷史價格）',
-                FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE CASCADE,
-                FOREIGN KEY (product_id) REFERENCES products(id),
-                INDEX idx_order_id (order_id),
-                INDEX idx_product_id (product_id)
-            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='訂單明細檔資料表'
-        """)
+        # 清空（登出）時刪除伺服器端資料與 cookie
+        if not session:
+            if session.sid:
+                key = self._key(session.sid)
+                self.store.delete(key)
+                self._forget(key)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
         
+        now = int(time.time())
+        rotate = session.sid is None or session.get('user_id') != session.loaded_user_id
+        refresh = session.expires_at - now < self.lifetime / 2
+        # 內容未變且有效期還長時不寫入，一般請求不會產生資料庫寫入
+        if not (rotate or session.modified or refresh):
+            return
         
+        if rotate:
+            # 登入身分改變時換發新 id，避免 session fixation
+            if session.sid:
+                old_key = self._key(session.sid)
+                self.store.delete(old_key)
+                self._forget(old_key)
+            session.sid = secrets.token_urlsafe(32)
         
-        connection.commit()
-        cursor.close()
-        connection.close()
+        key = self._key(session.sid)
+        data = dict(session)
+        session.expires_at = now + self.lifetime
+        self.store.save(key, self.serializer.dumps(data), data.get('user_id'), session.expires_at)
+        self._remember(key, data, session.expires_at)
+        if random.random() < 0.01:
+            self.store.purge(now)
         
-        # 資料庫遷移：更新現有表結構和註釋
-        connection = get_db_connection()
-        if connection:
-            cursor = connection.cursor()
-            
-            # 檢查並添加 orders 表的 user_id 欄位（如果不存在）
-            try:
-                cursor.execute("""
-                    SELECT COUNT(*) FROM information_schema.COLUMNS 
-                    WHERE TABLE_SCHEMA = %s 
-                    AND TABLE_NAME = 'orders' 
-                    AND COLUMN_NAME = 'user_id'
-                """, (DB_CONFIG['database'],))
-                
-                if cursor.fetchone()[0] == 0:
-                    print("正在更新 orders 表結構，添加 user_id 欄位...")
-                    # 先檢查 users 表是否存在
-                    cursor.execute("""
-                        SELECT COUNT(*) FROM information_schema.TABLES 
-                        WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'users'
-                    """, (DB_CONFIG['database'],))
-                    
-                    users_exists = cursor.fetchone()[0] > 0
-                    
-                    if users_exists:
-                        # 添加 user_id 欄位和索引
-                        cursor.execute("""
-                            ALTER TABLE orders 
-                            ADD COLUMN user_id INT NULL AFTER id,
-                            ADD INDEX idx_user_id (user_id)
-                        """)
-                        connection.commit()
-                        
-                        # 嘗試添加外鍵約束
-                        try:
-                            # 先檢查外鍵是否已存在
-                            cursor.execute("""
-                                SELECT COUNT(*) FROM information_schema.KEY_COLUMN_USAGE 
-                                WHERE TABLE_SCHEMA = %s 
-                                AND TABLE_NAME = 'orders' 
-                                AND CONSTRAINT_NAME = 'fk_orders_user'
-                            """, (DB_CONFIG['database'],))
-                            
-                            if cursor.fetchone()[0] == 0:
-                                cursor.execute("""
-                                    ALTER TABLE orders 
-                                    ADD CONSTRAINT fk_orders_user 
-                                    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE SET NULL
-                                """)
-                                connection.commit()
-                        except Error as fk_error:
-                            # 如果外鍵創建失敗（可能是因為已有數據不符合約束），只記錄但不中斷
-                            print(f"注意: 無法添加外鍵約束: {fk_error}")
-                            print("user_id 欄位已添加，但外鍵約束未創建（這不影響功能）")
-                        
-                        print("orders 表結構更新成功！")
-                    else:
-                        print("警告: users 表不存在，無法添加 user_id 欄位")
-            except Error as e:
-                print(f"更新表結構時發生錯誤: {e}")
-                # 繼續執行，不中斷初始化
-            
-            cursor.close()
-            connection.close()
+        response.set_cookie(
+            name, session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app)
+        )
+
+    def stats(self):
+        """行程內 session 快取筆數"""
+        with self._lock:
+            return {'cached_sessions': len(self._cache)}
+
+def make_session_interface(config):
+    """依設定建立 session 儲存區與前端快取"""
+    if config['backend'] == 'sqlite':
+        store = SqliteSessionStore(config['sqlite_path'])
+    else:
+        store = SqlSessionStore()
+    return ServerSessionInterface(
+        store,
+        lifetime=config['lifetime'],
+        cache_ttl=config['cache_ttl'],
+        cache_size=config['cache_size']
+    )
+
+app.session_interface = make_session_interface(SESSION_CONFIG)
+
+class UserCache:
+    """登入者資料（id、username、name、role）的短 TTL 快取，帳號不存在也會快取"""
+
+    def __init__(self, ttl=10, max_items=10000):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._users = OrderedDict()  # user_id -> (到期時間, 用戶或 None)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """取得用戶，快取過期時才查詢資料庫；資料庫無法使用時回傳 None 且不快取"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._users.move_to_end(user_id)
+                return entry[1]
         
-        # 更新現有表的註釋（如果表已存在）
-        connection = get_db_connection()
-        if connection:
-            cursor = connection.cursor()
+        with db_connection() as connection:
+            if not connection:
+                return None
             try:
-                # 更新 users 表註釋
-                cursor.execute("ALTER TABLE users COMMENT='系統使用者資料表'")
-                cursor.execute("ALTER TABLE users MODIFY COLUMN id INT AUTO_INCREMENT PRIMARY KEY COMMENT '使用者唯一識別碼'")
-                cursor.execute("ALTER TABLE users MODIFY COLUMN username VARCHAR(50) NOT NULL UNIQUE COMMENT '使用者登入帳號（唯一）'")
-                cursor.execute("ALTER TABLE users MODIFY COLUMN password VARCHAR(255) NOT NULL COMMENT '使用者密碼（SHA256雜湊值）'")
-                cursor.execute("ALTER TABLE users MODIFY COLUMN name VARCHAR(100) COMMENT '使用者真實姓名'")
-                cursor.execute("ALTER TABLE users MODIFY COLUMN role VARCHAR(20) DEFAULT 'user' COMMENT '使用者角色：user（一般用戶）或 admin（管理員）'")
-                cursor.execute("ALTER TABLE users MODIFY COLUMN created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '帳號建立時間'")
-                
-                # 更新 products 表註釋
-                cursor.execute("ALTER TABLE products COMMENT='商品資料表'")
-                cursor.execute("ALTER TABLE products MODIFY COLUMN id INT AUTO_INCREMENT PRIMARY KEY COMMENT '商品唯一識別碼'")
-                cursor.execute("ALTER TABLE products MODIFY COLUMN name VARCHAR(255) NOT NULL COMMENT '商品名稱'")
-                cursor.execute("ALTER TABLE products MODIFY COLUMN price DECIMAL(10, 2) NOT NULL COMMENT '商品單價（新台幣）'")
-                cursor.execute("ALTER TABLE products MODIFY COLUMN stock INT NOT NULL DEFAULT 0 COMMENT '商品庫存數量'")
-                cursor.execute("ALTER TABLE products MODIFY COLUMN description TEXT COMMENT '商品詳細描述'")
-                cursor.execute("ALTER TABLE products MODIFY COLUMN created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '商品建立時間'")
-                cursor.execute("ALTER TABLE products MODIFY COLUMN updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT '商品最後更新時間'")
-                
-                # 更新 orders 表註釋
-                cursor.execute("ALTER TABLE orders COMMENT='訂單主檔資料表'")
-                cursor.execute("ALTER TABLE orders MODIFY COLUMN id INT AUTO_INCREMENT PRIMARY KEY COMMENT '訂單唯一識別碼（訂單編號）'")
-                cursor.execute("ALTER TABLE orders MODIFY COLUMN user_id INT COMMENT '下單使用者ID（關聯到users表）'")
-                cursor.execute("ALTER TABLE orders MODIFY COLUMN subtotal DECIMAL(10, 2) NOT NULL COMMENT '訂單小計金額（未含稅）'")
-                cursor.execute("ALTER TABLE orders MODIFY COLUMN tax DECIMAL(10, 2) NOT NULL COMMENT '訂單稅額（營業稅5%）'")
-                cursor.execute("ALTER TABLE orders MODIFY COLUMN total DECIMAL(10, 2) NOT NULL COMMENT '訂單總金額（含稅）'")
-                cursor.execute("ALTER TABLE orders MODIFY COLUMN created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '訂單建立時間'")
-                
-                # 更新 order_items 表註釋
-                cursor.execute("ALTER TABLE order_items COMMENT='訂單明細檔資料表'")
-                cursor.execute("ALTER TABLE order_items MODIFY COLUMN id INT AUTO_INCREMENT PRIMARY KEY COMMENT '訂單項目唯一識別碼'")
-                cursor.execute("ALTER TABLE order_items MODIFY COLUMN order_id INT NOT NULL COMMENT '所屬訂單ID（關聯到orders表）'")
-                cursor.execute("ALTER TABLE order_items MODIFY COLUMN product_id INT NOT NULL COMMENT '商品ID（關聯到products表）'")
-                cursor.execute("ALTER TABLE order_items MODIFY COLUMN quantity INT NOT NULL COMMENT '購買數量'")
-                cursor.execute("ALTER TABLE order_items MODIFY COLUMN price DECIMAL(10, 2) NOT NULL COMMENT '購買時的商品單價（保留歷史價格）'")
-                
-                connection.commit()
-                print("資料表註釋更新成功！")
+                cursor = connection.cursor(dictionary=True)
+                cursor.execute("SELECT id, username, name, role FROM users WHERE id = %s", (user_id,))
+                user = cursor.fetchone()
             except Error as e:
-                # 如果更新註釋失敗（可能是因為表結構不同），只記錄但不中斷
-                print(f"更新表註釋時發生錯誤（不影響功能）: {e}")
-            finally:
-                cursor.close()
-                connection.close()
+                print(f"讀取用戶資料失敗: {e}")
+                return None
         
-        # 插入一些範例商品和默認用戶（如果表格是空的）
-        connection = get_db_connection()
+        with self._lock:
+            self._users[user_id] = (now + self.ttl, user)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_items:
+                self._users.popitem(last=False)
+        return user
+
+    def invalidate(self, user_id):
+        """用戶資料變更後立即失效（只影響本行程，其他行程在 ttl 內過期）"""
+        with self._lock:
+            self._users.pop(user_id, None)
+
+user_cache = UserCache(ttl=SESSION_CONFIG['user_cache_ttl'])
+
+_pool = None
+_pool_lock = threading.Lock()
+_inherited_pools = []  # fork 前父行程的連接池（保留參照，避免被回收時關閉與父行程共用的連接）
+
+def get_pool():
+    """取得（必要時建立）本行程的連接池"""
+    global _pool
+    pool = _pool
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                # fork 出的 worker 與父行程共用 socket，不能使用也不能送 QUIT 關閉，只能另建連接池
+                if _pool is not None:
+                    _inherited_pools.append(_pool)
+                _pool = ConnectionPool(DB_CONFIG, **POOL_CONFIG)
+            pool = _pool
+    return pool
+
+def close_pool():
+    """關閉本行程的連接池（主行程在 fork worker 前呼叫，子行程就不會繼承已連線的 socket）"""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None and pool.pid == os.getpid():
+        pool.close()
+
+def get_db_connection():
+    """從連接池借出資料庫連接（等待時間計入指標與目前請求）"""
+    started = time.perf_counter()
+    try:
+        connection = get_pool().acquire()
+    except Error as e:
+        metrics.inc('pos_db_pool_errors_total')
+        print(f"資料庫連接錯誤: {e}")
+        return None
+    waited = time.perf_counter() - started
+    metrics.observe('pos_db_pool_wait_seconds', '', waited)
+    query_log = current_query_log()
+    if query_log is not None:
+        query_log.pool_wait += waited
+    return connection
+
+@contextmanager
+def db_connection():
+    """借出連接，離開區塊時（包含錯誤路徑）自動歸還連接池"""
+    connection = get_db_connection()
+    try:
+        yield connection
+    finally:
         if connection:
-            cursor = connection.cursor()
-            
-            # 插入範例商品
-            cursor.execute("SELECT COUNT(*) FROM products")
-            count = cursor.fetchone()[0]
-            
-            if count == 0:
-                sample_products = [
-                    ('可樂', 30.00, 100, '經典可樂飲料'),
-                    ('薯片', 50.00, 80, '原味薯片'),
-                    ('巧克力', 45.00, 60, '牛奶巧克力'),
-                    ('礦泉水', 20.00, 150, '純淨礦泉水'),
-                    ('麵包', 35.00, 50, '新鮮麵包')
-                ]
-                cursor.executemany("""
-                    INSERT INTO products (name, price, stock, description)
-                    VALUES (%s, %s, %s, %s)
-                """, sample_products)
-                connection.commit()
-            
-            # 插入默認管理員帳號（如果不存在）
-            cursor.execute("SELECT COUNT(*) FROM users WHERE username = 'admin'")
-            admin_exists = cursor.fetchone()[0]
-            
-            if admin_exists == 0:
-                # 默認密碼: admin123 (使用SHA256哈希)
-                default_password = hashlib.sha256('admin123'.encode()).hexdigest()
-                cursor.execute("""
-                    INSERT INTO users (username, password, name, role)
-                    VALUES (%s, %s, %s, %s)
-                """, ('admin', default_password, '系統管理員', 'admin'))
-                connection.commit()
-                print("已創建默認管理員帳號: admin / admin123")
-            
-            cursor.close()
             connection.close()
-        
-        print("資料庫初始化成功！")
+
+def ensure_column(cursor, table, column, definition):
+    """若欄位不存在則新增（用於為既有資料表補欄位）"""
+    cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND COLUMN_NAME = %s
+    """, (DB_CONFIG['database'], table, column))
+    if cursor.fetchone()[0] == 0:
+        print(f"正在為 {table} 表新增欄位 {column}...")
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
         return True
+    return False
+
+def ensure_index(cursor, table, index_name, columns, index_type='INDEX'):
+    """若索引不存在則建立（用於為既有資料表補建索引）"""
+    cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND INDEX_NAME = %s
+    """, (DB_CONFIG['database'], table, index_name))
+    if cursor.fetchone()[0] == 0:
+        print(f"正在為 {table} 表建立索引 {index_name}...")
+        cursor.execute(f"ALTER TABLE {table} ADD {index_type} {index_name} {columns}")
+        return True
+    return False
+
+def create_database():
+    """建立資料庫（如果不存在）"""
+    # 先連接到MySQL（不指定資料庫）
+    connection = mysql.connector.connect(
+        host=DB_CONFIG['host'],
+        port=DB_CONFIG['port'],
+        user=DB_CONFIG['user'],
+        password=DB_CONFIG['password']
+    )
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f"CREATE DATABASE IF NOT EXISTS {DB_CONFIG['database']} CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci")
+        cursor.close()
+    finally:
+        connection.close()
+
+# 資料庫遷移步驟：每一步都可以重複執行（已完成的部分會略過），執行完畢後記錄在 schema_version 表
+
+def migrate_create_tables(cursor):
+    """建立資料表"""
+    # 創建用戶表（系統使用者資料表）
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INT AUTO_INCREMENT PRIMARY KEY COMMENT '使用者唯一識別碼',
+            username VARCHAR(50) NOT NULL UNIQUE COMMENT '使用者登入帳號（唯一）',
+            password VARCHAR(255) NOT NULL COMMENT '使用者密碼（scrypt/PBKDF2 加鹽雜湊，舊資料為 SHA256，登入時自動升級）',
+            name VARCHAR(100) COMMENT '使用者真實姓名',
+            role VARCHAR(20) DEFAULT 'user' COMMENT '使用者角色：user（一般用戶）或 admin（管理員）',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '帳號建立時間',
+            INDEX idx_username (username)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='系統使用者資料表'
+    """)
+
+    # 創建商品表（商品資料表）
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS products (
+            id INT AUTO_INCREMENT PRIMARY KEY COMMENT '商品唯一識別碼',
+            sku VARCHAR(64) NULL COMMENT '商品貨號或條碼（唯一，批次匯入時作為比對鍵）',
+            name VARCHAR(255) NOT NULL COMMENT '商品名稱',
+            price DECIMAL(10, 2) NOT NULL COMMENT '商品單價（新台幣）',
+            stock INT NOT NULL DEFAULT 0 COMMENT '商品庫存數量',
+            description TEXT COMMENT '商品詳細描述',
+            is_active TINYINT(1) NOT NULL DEFAULT 1 COMMENT '是否上架（0 表示已刪除，保留歷史訂單關聯）',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '商品建立時間',
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT '商品最後更新時間',
+            UNIQUE KEY uk_sku (sku),
+            INDEX idx_name (name),
+            INDEX idx_updated_at (updated_at)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='商品資料表'
+    """)
+    
+    # 創建訂單表（訂單主檔）
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS orders (
+            id INT AUTO_INCREMENT PRIMARY KEY COMMENT '訂單唯一識別碼（訂單編號）',
+            user_id INT COMMENT '下單使用者ID（關聯到users表）',
+            subtotal DECIMAL(10, 2) NOT NULL COMMENT '訂單小計金額（未含稅）',
+            tax DECIMAL(10, 2) NOT NULL COMMENT '訂單稅額（營業稅5%）',
+            total DECIMAL(10, 2) NOT NULL COMMENT '訂單總金額（含稅）',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '訂單建立時間',
+            updated_at TIMESTAMP(6) DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6) COMMENT '訂單最後更新時間（微秒，用於統計資料的 ETag）',
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE SET NULL,
+            INDEX idx_user_id (user_id),
+            INDEX idx_user_created (user_id, created_at, id),
+            INDEX idx_created_at (created_at),
+            INDEX idx_updated_at (updated_at)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='訂單主檔資料表'
+    """)
+    
+    # 創建伺服器端 session 表
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            id CHAR(64) NOT NULL PRIMARY KEY COMMENT 'session id 的 SHA256（cookie 內為原始 id）',
+            user_id INT NULL COMMENT '登入的使用者ID',
+            data TEXT NOT NULL COMMENT 'session 內容（JSON）',
+            expires_at BIGINT NOT NULL COMMENT '到期時間（Unix 秒）',
+            INDEX idx_expires_at (expires_at)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='伺服器端 session 資料表'
+    """)
+    
+    # 創建訂單項目表（訂單明細檔）
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS order_items (
+            id INT AUTO_INCREMENT PRIMARY KEY COMMENT '訂單項目唯一識別碼',
+            order_id INT NOT NULL COMMENT '所屬訂單ID（關聯到orders表）',
+            product_id INT NOT NULL COMMENT '商品ID（關聯到products表）',
+            quantity INT NOT NULL COMMENT '購買數量',
+            price DECIMAL(10, 2) NOT NULL COMMENT '購買時的商品單價（保留歷史價格）',
+            FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE CASCADE,
+            FOREIGN KEY (product_id) REFERENCES products(id),
+            INDEX idx_order_product_cover (order_id, product_id, quantity, price),
+            INDEX idx_product_id (product_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='訂單明細檔資料表'
+    """)
+
+def migrate_orders_user_id(cursor):
+    """舊版 orders 表補上 user_id 欄位與外鍵"""
+    if not ensure_column(cursor, 'orders', 'user_id', "INT NULL COMMENT '下單使用者ID（關聯到users表）' AFTER id"):
+        return
+    ensure_index(cursor, 'orders', 'idx_user_id', '(user_id)')
+    try:
+        cursor.execute("""
+            ALTER TABLE orders 
+            ADD CONSTRAINT fk_orders_user 
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE SET NULL
+        """)
+    except Error as fk_error:
+        # 如果外鍵創建失敗（可能是因為已有數據不符合約束），只記錄但不中斷
+        print(f"注意: 無法添加外鍵約束: {fk_error}")
+        print("user_id 欄位已添加，但外鍵約束未創建（這不影響功能）")
+
+def migrate_query_indexes(cursor):
+    """舊版資料表補建查詢所需的欄位與索引"""
+    # 訂單記錄依 (user_id, created_at, id) 做游標分頁
+    ensure_index(cursor, 'orders', 'idx_user_created', '(user_id, created_at, id)')
+    # 商品名稱前綴搜尋
+    ensure_index(cursor, 'products', 'idx_name', '(name)')
+    # ETag 驗證碼以 MAX(updated_at) 取得，需要索引
+    ensure_column(cursor, 'orders', 'updated_at',
+                  "TIMESTAMP(6) DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6) COMMENT '訂單最後更新時間（微秒，用於統計資料的 ETag）'")
+    ensure_index(cursor, 'orders', 'idx_updated_at', '(updated_at)')
+    # 商品改為軟刪除
+    ensure_column(cursor, 'products', 'is_active',
+                  "TINYINT(1) NOT NULL DEFAULT 1 COMMENT '是否上架（0 表示已刪除，保留歷史訂單關聯）'")
+    ensure_index(cursor, 'products', 'idx_updated_at', '(updated_at)')
+    # 彙總表重建與銷售報表依建立時間範圍掃描訂單
+    ensure_index(cursor, 'orders', 'idx_created_at', '(created_at)')
+    # 商品貨號/條碼：批次匯入以唯一鍵做 upsert
+    ensure_column(cursor, 'products', 'sku',
+                  "VARCHAR(64) NULL COMMENT '商品貨號或條碼（唯一，批次匯入時作為比對鍵）' AFTER id")
+    ensure_index(cursor, 'products', 'uk_sku', '(sku)', 'UNIQUE INDEX')
+    # 涵蓋索引：依訂單取明細的商品、數量與單價時不必回表
+    ensure_index(cursor, 'order_items', 'idx_order_product_cover', '(order_id, product_id, quantity, price)')
+
+def migrate_product_fulltext(cursor):
+    """商品名稱全文索引（ngram 支援中文）"""
+    try:
+        ensure_index(cursor, 'products', 'ft_name', '(name) WITH PARSER ngram', 'FULLTEXT INDEX')
+    except Error as e:
+        # MariaDB 等不支援 ngram 時退回前綴搜尋
+        print(f"注意: 無法建立商品全文索引，搜尋將使用名稱前綴比對: {e}")
+
+def migrate_sales_rollups(cursor):
+    """建立每日銷售彙總表，並由既有訂單回填"""
+    # 每日銷售彙總表不存在時，建立後需要由既有訂單回填
+    cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = %s AND TABLE_NAME IN ('sales_daily_product', 'sales_daily_user')
+    """, (DB_CONFIG['database'],))
+    needs_rollup_backfill = cursor.fetchone()[0] < 2
+
+    # 創建每日商品銷售彙總表（由訂單異動增量維護）
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sales_daily_product (
+            sale_date DATE NOT NULL COMMENT '銷售日期（訂單建立日）',
+            product_id INT NOT NULL COMMENT '商品ID',
+            quantity_sold INT NOT NULL DEFAULT 0 COMMENT '銷售數量',
+            revenue DECIMAL(14, 2) NOT NULL DEFAULT 0 COMMENT '銷售金額（數量 × 下單單價）',
+            PRIMARY KEY (sale_date, product_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='每日商品銷售彙總表'
+    """)
+
+    # 創建每日員工銷售彙總表（由訂單異動增量維護）
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sales_daily_user (
+            sale_date DATE NOT NULL COMMENT '銷售日期（訂單建立日）',
+            user_id INT NOT NULL COMMENT '下單使用者ID',
+            order_count INT NOT NULL DEFAULT 0 COMMENT '訂單數',
+            total_sales DECIMAL(14, 2) NOT NULL DEFAULT 0 COMMENT '訂單總金額（含稅）',
+            items_sold INT NOT NULL DEFAULT 0 COMMENT '銷售商品件數',
+            PRIMARY KEY (sale_date, user_id),
+            INDEX idx_user_id (user_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='每日員工銷售彙總表'
+    """)
+
+    if needs_rollup_backfill:
+        print("正在由既有訂單回填每日銷售彙總表...")
+        if not rebuild_rollups():
+            raise Error(msg='回填每日銷售彙總表失敗')
+
+# 早期版本建表時沒有註釋：資料表 -> (表註釋, [(欄位, 欄位定義, 欄位註釋)])
+SCHEMA_COMMENTS = {
+    'users': ('系統使用者資料表', [
+        ('id', 'INT NOT NULL AUTO_INCREMENT', '使用者唯一識別碼'),
+        ('username', 'VARCHAR(50) NOT NULL', '使用者登入帳號（唯一）'),
+        ('password', 'VARCHAR(255) NOT NULL', '使用者密碼（scrypt/PBKDF2 加鹽雜湊，舊資料為 SHA256，登入時自動升級）'),
+        ('name', 'VARCHAR(100)', '使用者真實姓名'),
+        ('role', "VARCHAR(20) DEFAULT 'user'", '使用者角色：user（一般用戶）或 admin（管理員）'),
+        ('created_at', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP', '帳號建立時間')
+    ]),
+    'products': ('商品資料表', [
+        ('id', 'INT NOT NULL AUTO_INCREMENT', '商品唯一識別碼'),
+        ('name', 'VARCHAR(255) NOT NULL', '商品名稱'),
+        ('price', 'DECIMAL(10, 2) NOT NULL', '商品單價（新台幣）'),
+        ('stock', 'INT NOT NULL DEFAULT 0', '商品庫存數量'),
+        ('description', 'TEXT', '商品詳細描述'),
+        ('created_at', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP', '商品建立時間'),
+        ('updated_at', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP', '商品最後更新時間')
+    ]),
+    'orders': ('訂單主檔資料表', [
+        ('id', 'INT NOT NULL AUTO_INCREMENT', '訂單唯一識別碼（訂單編號）'),
+        ('user_id', 'INT', '下單使用者ID（關聯到users表）'),
+        ('subtotal', 'DECIMAL(10, 2) NOT NULL', '訂單小計金額（未含稅）'),
+        ('tax', 'DECIMAL(10, 2) NOT NULL', '訂單稅額（營業稅5%）'),
+        ('total', 'DECIMAL(10, 2) NOT NULL', '訂單總金額（含稅）'),
+        ('created_at', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP', '訂單建立時間')
+    ]),
+    'order_items': ('訂單明細檔資料表', [
+        ('id', 'INT NOT NULL AUTO_INCREMENT', '訂單項目唯一識別碼'),
+        ('order_id', 'INT NOT NULL', '所屬訂單ID（關聯到orders表）'),
+        ('product_id', 'INT NOT NULL', '商品ID（關聯到products表）'),
+        ('quantity', 'INT NOT NULL', '購買數量'),
+        ('price', 'DECIMAL(10, 2) NOT NULL', '購買時的商品單價（保留歷史價格）')
+    ])
+}
+
+def migrate_comments(cursor):
+    """補上早期資料表缺少的表與欄位註釋（只改與預期不同的部分）"""
+    for table, (table_comment, columns) in SCHEMA_COMMENTS.items():
+        cursor.execute("""
+            SELECT TABLE_COMMENT FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s
+        """, (DB_CONFIG['database'], table))
+        row = cursor.fetchone()
+        if row is None:
+            continue
+        changes = [] if row[0] == table_comment else [f"COMMENT='{table_comment}'"]
+        cursor.execute("""
+            SELECT COLUMN_NAME, COLUMN_COMMENT FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s
+        """, (DB_CONFIG['database'], table))
+        current = dict(cursor.fetchall())
+        for column, definition, comment in columns:
+            if column in current and current[column] != comment:
+                changes.append(f"MODIFY COLUMN {column} {definition} COMMENT '{comment}'")
+        if not changes:
+            continue
+        try:
+            # 只改註釋是中繼資料變更；定義與實際欄位不同時 INPLACE 會直接失敗，不會重建資料表
+            cursor.execute(f"ALTER TABLE {table} {', '.join(changes)}, ALGORITHM=INPLACE, LOCK=NONE")
+            print(f"已更新 {table} 表註釋")
+        except Error as e:
+            print(f"注意: 無法更新 {table} 表註釋（不影響功能）: {e}")
+
+def migrate_seed_data(cursor):
+    """插入範例商品和默認管理員帳號（如果表格是空的）"""
+    # 插入範例商品
+    cursor.execute("SELECT COUNT(*) FROM products")
+    count = cursor.fetchone()[0]
+    
+    if count == 0:
+        sample_products = [
+            ('可樂', 30.00, 100, '經典可樂飲料'),
+            ('薯片', 50.00, 80, '原味薯片'),
+            ('巧克力', 45.00, 60, '牛奶巧克力'),
+            ('礦泉水', 20.00, 150, '純淨礦泉水'),
+            ('麵包', 35.00, 50, '新鮮麵包')
+        ]
+        cursor.executemany("""
+            INSERT INTO products (name, price, stock, description)
+            VALUES (%s, %s, %s, %s)
+        """, sample_products)
+    
+    # 插入默認管理員帳號（如果不存在）
+    cursor.execute("SELECT COUNT(*) FROM users WHERE username = 'admin'")
+    admin_exists = cursor.fetchone()[0]
+    
+    if admin_exists == 0:
+        # 默認密碼: admin123（加鹽 KDF 雜湊）
+        default_password = hash_password('admin123')
+        cursor.execute("""
+            INSERT INTO users (username, password, name, role)
+            VALUES (%s, %s, %s, %s)
+        """, ('admin', default_password, '系統管理員', 'admin'))
+        print("已創建默認管理員帳號: admin / admin123")
+
+def migrate_order_ingest_token(cursor):
+    """orders 表補上非同步結帳的訂單代碼（唯一索引）"""
+    ensure_column(cursor, 'orders', 'ingest_token',
+                  "CHAR(32) NULL COMMENT '非同步結帳的訂單代碼（唯一，佇列重送時避免重複寫入）'")
+    ensure_index(cursor, 'orders', 'uk_ingest_token', '(ingest_token)', 'UNIQUE INDEX')
+
+def migrate_idempotency_keys(cursor):
+    """建立冪等鍵資料表"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            user_id INT NOT NULL COMMENT '發出請求的使用者ID',
+            idempotency_key VARCHAR(64) NOT NULL COMMENT '用戶端產生的 Idempotency-Key',
+            fingerprint CHAR(64) NOT NULL COMMENT '請求方法、路徑與內容的 SHA256（同一個鍵不可用於不同請求）',
+            status_code SMALLINT NULL COMMENT '回應狀態碼（NULL 表示處理中）',
+            response_body MEDIUMTEXT NULL COMMENT '回應內容（JSON）',
+            locked_until BIGINT NOT NULL COMMENT '處理中的租約到期時間（Unix 秒），逾時未完成視為中斷',
+            expires_at BIGINT NOT NULL COMMENT '記錄到期時間（Unix 秒）',
+            PRIMARY KEY (user_id, idempotency_key),
+            INDEX idx_expires_at (expires_at)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='冪等鍵與其回應（重送的結帳與更改訂單請求直接回傳相同結果）'
+    """)
+
+def migrate_rollup_updated_at(cursor):
+    """每日銷售彙總表補上最後異動時間（統計資料的 ETag 以索引取 MAX，不必計算訂單筆數）"""
+    for table in ('sales_daily_product', 'sales_daily_user'):
+        ensure_column(cursor, table, 'updated_at',
+                      "TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6) "
+                      "COMMENT '最後異動時間（微秒，用於統計資料的 ETag）'")
+        ensure_index(cursor, table, 'idx_updated_at', '(updated_at)')
+
+def migrate_idempotency_response_headers(cursor):
+    """冪等鍵資料表補上回應標頭（重送時一併回傳 Location 等標頭）"""
+    ensure_column(cursor, 'idempotency_keys', 'response_headers',
+                  "TEXT NULL COMMENT '需重送的回應標頭（JSON 陣列 [[名稱, 值], ...]）' AFTER response_body")
+
+def migrate_idempotency_claim(cursor):
+    """冪等鍵資料表補上佔用代碼（租約被接手後，原請求不能再保存回應或提交）"""
+    ensure_column(cursor, 'idempotency_keys', 'claim',
+                  "CHAR(32) NULL COMMENT '目前處理此鍵的請求代碼（每次佔用或接手時重新產生）' AFTER fingerprint")
+
+def migrate_users_updated_at(cursor):
+    """users 表補上最後異動時間（統計資料的 ETag 涵蓋用戶名稱、姓名與角色變更）"""
+    ensure_column(cursor, 'users', 'updated_at',
+                  "TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6) "
+                  "COMMENT '最後異動時間（微秒，用於統計資料的 ETag）'")
+    ensure_index(cursor, 'users', 'idx_updated_at', '(updated_at)')
+
+def migrate_stock_reservations(cursor):
+    """建立非同步結帳的庫存預留表"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stock_reservations (
+            token CHAR(32) NOT NULL PRIMARY KEY COMMENT '非同步結帳的訂單代碼',
+            user_id INT NULL COMMENT '下單使用者ID',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '扣庫存時間',
+            INDEX idx_created_at (created_at)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='非同步結帳已扣庫存、訂單尚未寫入的預留（與扣庫存同一交易提交）'
+    """)
+
+# 依版本排序的遷移步驟；新的結構變更一律附加在最後，已發佈的步驟不可修改或重新編號
+MIGRATIONS = [
+    (1, '建立資料表', migrate_create_tables),
+    (2, 'orders 表補上 user_id 欄位', migrate_orders_user_id),
+    (3, '補建查詢用欄位與索引', migrate_query_indexes),
+    (4, '商品名稱全文索引', migrate_product_fulltext),
+    (5, '每日銷售彙總表', migrate_sales_rollups),
+    (6, '資料表與欄位註釋', migrate_comments),
+    (7, '範例商品與默認管理員', migrate_seed_data),
+    (8, 'orders 表補上非同步結帳的訂單代碼', migrate_order_ingest_token),
+    (9, '冪等鍵資料表', migrate_idempotency_keys),
+    (10, '每日銷售彙總表補上最後異動時間', migrate_rollup_updated_at),
+    (11, '冪等鍵資料表補上回應標頭', migrate_idempotency_response_headers),
+    (12, '冪等鍵資料表補上佔用代碼', migrate_idempotency_claim),
+    (13, 'users 表補上最後異動時間', migrate_users_updated_at),
+    (14, '非同步結帳的庫存預留表', migrate_stock_reservations)
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(cursor):
+    """資料庫目前的結構版本（尚未建立 schema_version 表時為 0）"""
+    try:
+        cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    except Error as e:
+        if e.errno == errorcode.ER_NO_SUCH_TABLE:
+            return 0
+        raise
+    return cursor.fetchone()[0]
+
+def check_schema():
+    """啟動時只檢查結構版本（一次查詢，不執行任何 DDL），版本落後時回傳 False"""
+    with db_connection() as connection:
+        if not connection:
+            return False
+        try:
+            version = get_schema_version(connection.cursor())
+        except Error as e:
+            print(f"讀取資料庫結構版本失敗: {e}")
+            return False
+    
+    if version < SCHEMA_VERSION:
+        print(f"資料庫結構版本為 {version}，程式需要 {SCHEMA_VERSION}，請先執行 python main.py migrate")
+        return False
+    if version > SCHEMA_VERSION:
+        # 滾動部署時舊程式可能先看到新結構，遷移步驟只做相容的新增，因此允許繼續執行
+        print(f"注意: 資料庫結構版本 {version} 比程式（{SCHEMA_VERSION}）新")
+    else:
+        print(f"資料庫結構版本: {version}")
+    return True
+
+def migrate_database():
+    """依序執行尚未套用的遷移步驟並記錄版本（python main.py migrate）"""
+    try:
+        create_database()
     except Error as e:
         print(f"資料庫初始化錯誤: {e}")
         return False
+    
+    with db_connection() as connection:
+        if not connection:
+            return False
+        cursor = connection.cursor()
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INT NOT NULL PRIMARY KEY COMMENT '遷移步驟版本',
+                    description VARCHAR(255) NOT NULL COMMENT '遷移步驟說明',
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '套用時間'
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='資料庫結構版本記錄'
+            """)
+            # 同一時間只允許一個遷移程序（多台機器同時部署時）
+            cursor.execute("SELECT GET_LOCK('pos_schema_migration', 0)")
+            if not cursor.fetchone()[0]:
+                print("另一個遷移程序正在執行中")
+                return False
+            try:
+                version = get_schema_version(cursor)
+                for step, description, migrate in MIGRATIONS:
+                    if step <= version:
+                        continue
+                    print(f"正在執行遷移 {step}：{description}...")
+                    started = time.monotonic()
+                    migrate(cursor)
+                    cursor.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", (step, description))
+                    print(f"遷移 {step} 完成（{time.monotonic() - started:.1f} 秒）")
+            finally:
+                cursor.execute("DO RELEASE_LOCK('pos_schema_migration')")
+        except Error as e:
+            print(f"資料庫遷移錯誤: {e}")
+            return False
+    
+    print(f"資料庫結構已是最新版本（{SCHEMA_VERSION}）")
+    return True
+
+# 預先壓縮的版本：(Content-Encoding, 副檔名)，依偏好順序
+ASSET_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+def write_asset(directory, name, content):
+    """寫入靜態資源與較小的預先壓縮版本（brotli 需另外安裝 brotli 套件）"""
+    variants = {'': content, '.gz': gzip.compress(content, 9, mtime=0)}
+    try:
+        import brotli
+        variants['.br'] = brotli.compress(content, quality=11)
+    except ImportError:
+        pass
+    for suffix, data in variants.items():
+        path = os.path.join(directory, name + suffix)
+        if suffix and len(data) >= len(content):
+            # 壓縮後沒有變小就不提供
+            if os.path.exists(path):
+                os.remove(path)
+            continue
+        with open(path, 'wb') as f:
+            f.write(data)
+
+def build_assets():
+    """產生內容雜湊檔名的 CSS/JS、改寫頁面引用並預先壓縮，寫入 dist/manifest.json（python main.py build-assets）"""
+    base = app.root_path
+    source = os.path.join(base, ASSET_CONFIG['source_dir'])
+    dist = os.path.join(base, ASSET_CONFIG['dist_dir'])
+    manifest_path = os.path.join(dist, 'manifest.json')
+    entry = ASSET_CONFIG['entry']
+    os.makedirs(dist, exist_ok=True)
+    try:
+        with open(manifest_path, encoding='utf-8') as f:
+            previous = json.load(f)['current']
+    except (OSError, ValueError, KeyError):
+        previous = []
+    
+    hashed_names = {}
+    for name in ASSET_CONFIG['files']:
+        if name == entry:
+            continue
+        with open(os.path.join(source, name), 'rb') as f:
+            content = f.read()
+        stem, extension = os.path.splitext(name)
+        hashed_names[name] = f"{stem}.{hashlib.sha256(content).hexdigest()[:12]}{extension}"
+        write_asset(dist, hashed_names[name], content)
+        print(f"{name} -> {hashed_names[name]}")
+    
+    with open(os.path.join(source, entry), encoding='utf-8') as f:
+        html = f.read()
+    for name, hashed in hashed_names.items():
+        html = html.replace(f'"{name}"', f'"{hashed}"')
+    write_asset(dist, entry, html.encode('utf-8'))
+    
+    # 保留上一版的雜湊檔案：部署期間仍開著舊頁面的終端機還能載入舊資源
+    current = [entry] + sorted(hashed_names.values())
+    servable = sorted(set(current) | set(previous))
+    for name in os.listdir(dist):
+        asset_name = name
+        for _, suffix in ASSET_ENCODINGS:
+            if name.endswith(suffix):
+                asset_name = name[:-len(suffix)]
+        if name != 'manifest.json' and asset_name not in servable:
+            os.remove(os.path.join(dist, name))
+    
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({'current': current, 'files': servable}, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, manifest_path)
+    print(f"已建置 {len(current)} 個靜態資源至 {dist}")
+    return True
+
+class StaticAssets:
+    """前端靜態資源：只提供允許清單內的檔案；已建置時將 dist/ 的內容與預先壓縮版本載入記憶體"""
+
+    def __init__(self, source_dir='.', dist_dir='dist', entry='index.html', files=()):
+        self.source_dir = os.path.join(app.root_path, source_dir)
+        self.dist_dir = os.path.join(app.root_path, dist_dir)
+        self.entry = entry
+        self.files = set(files)
+        self._assets = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def is_built(self):
+        return os.path.exists(os.path.join(self.dist_dir, 'manifest.json'))
+
+    def _load(self):
+        """讀取 manifest 列出的檔案，回傳 {檔名: (MIME 類型, 內容雜湊, {編碼: 內容})}；未建置時回傳 None"""
+        try:
+            with open(os.path.join(self.dist_dir, 'manifest.json'), encoding='utf-8') as f:
+                names = json.load(f)['files']
+        except FileNotFoundError:
+            return None
+        assets = {}
+        for name in names:
+            variants = {}
+            for encoding, suffix in (('identity', ''),) + ASSET_ENCODINGS:
+                path = os.path.join(self.dist_dir, name + suffix)
+                if os.path.exists(path):
+                    with open(path, 'rb') as f:
+                        variants[encoding] = f.read()
+            if 'identity' in variants:
+                digest = hashlib.sha256(variants['identity']).hexdigest()[:32]
+                assets[name] = (mimetypes.guess_type(name)[0] or 'application/octet-stream', digest, variants)
+        return assets
+
+    def _get_assets(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._assets = self._load()
+                    self._loaded = True
+        return self._assets
+
+    def response(self, path):
+        """回傳靜態資源；不在允許清單或 manifest 中的路徑回傳 None"""
+        assets = self._get_assets()
+        if assets is None:
+            # 未建置（開發環境）：直接讀原始檔，每次重新驗證，修改後重新整理即可看到
+            if path not in self.files:
+                return None
+            return send_from_directory(self.source_dir, path, max_age=0)
+        
+        asset = assets.get(path)
+        if asset is None:
+            return None
+        mimetype, digest, variants = asset
+        encoding = next((name for name, _ in ASSET_ENCODINGS
+                         if name in variants and request.accept_encodings[name] > 0), None)
+        # 每種編碼是不同的表示法，需要不同的 ETag
+        etag = f"{digest}-{encoding}" if encoding else digest
+        if etag_matches(etag):
+            response = app.response_class(status=304)
+        else:
+            response = app.response_class(variants[encoding or 'identity'], mimetype=mimetype)
+        response.set_etag(etag)
+        response.vary.add('Accept-Encoding')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        if path == self.entry:
+            response.headers['Cache-Control'] = 'no-cache'
+        else:
+            # 檔名含內容雜湊，內容變更時網址也會變，可以永久快取
+            response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
+
+static_assets = StaticAssets(**ASSET_CONFIG)
+
+app.wsgi_app = MetricsMiddleware(app.wsgi_app)
+
+@app.before_request
+def remember_route():
+    """記下路由樣板供指標使用（以實際網址當標籤會讓時間序列數量爆增）"""
+    request.environ['pos.route'] = request.url_rule.rule if request.url_rule else 'unmatched'
 
 # 提供靜態文件
 @app.route('/')
 def index():
     """提供主頁"""
-    return send_from_directory('.', 'index.html')
+    return static_assets.response(static_assets.entry) or (jsonify({'error': '找不到頁面'}), 404)
 
 @app.route('/<path:path>')
 def serve_static(path):
-    """提供靜態文件（CSS、JS等）"""
-    return send_from_directory('.', path)
+    """提供允許清單內的靜態文件（CSS、JS等），其餘路徑一律 404"""
+    return static_assets.response(path) or (jsonify({'error': '找不到檔案'}), 404)
 
 # 工具函數：密碼哈希
 def hash_password(password):
-    """對密碼進行SHA256哈希"""
-    return hashlib.sha256(password.encode()).hexdigest()
+    """以目前的 KDF 設定產生加鹽雜湊（同步計算，供初始化與工具程式使用）"""
+    return password_hasher.hash_sync(password)
+
+# 工具函數：目前登入者
+def current_user():
+    """目前登入的用戶；未登入或帳號已不存在時為 None（角色以資料庫為準，經短 TTL 快取）"""
+    user_id = session.get('user_id')
+    if user_id is None:
+        return None
+    return user_cache.get(user_id)
 
 # 工具函數：檢查登入狀態
 def check_login():
     """檢查用戶是否已登入"""
-    return 'user_id' in session
+    return current_user() is not None
 
 # 工具函數：檢查管理員權限
 def check_admin():
     """檢查用戶是否為管理員"""
-    return check_login() and session.get('role') == 'admin'
+    user = current_user()
+    return user is not None and user['role'] == 'admin'
+
+# 工具函數：HTTP 條件請求（ETag / If-None-Match）
+def make_etag(*parts):
+    """由資料版本組成強 ETag"""
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+def etag_matches(etag):
+    """檢查請求的 If-None-Match 是否符合目前的 ETag"""
+    return request.if_none_match.contains_weak(etag)
+
+def with_etag(response, etag, private=False):
+    """附加 ETag，並要求用戶端每次使用前重新驗證"""
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache' if private else 'no-cache'
+    return response
+
+def not_modified(etag, private=False):
+    """回傳 304 Not Modified"""
+    return with_etag(app.response_class(status=304), etag, private)
+
+def stats_etag(cursor):
+    """統計資料的 ETag 與資料庫的今天日期：各取一次索引端點（MAX），成本與訂單筆數無關，不必執行統計查詢"""
+    # 新增、更改與刪除訂單（含非同步結帳的批次寫入）都會在同一交易內異動彙總表列，
+    # 彙總表的最後異動時間即可涵蓋訂單刪除，不需要 COUNT(*) 掃描整個索引；
+    # 員工統計回傳用戶名稱與角色：以 users 的最後異動時間涵蓋更名與角色變更，用戶數（資料表很小）涵蓋刪除
+    cursor.execute("""
+        SELECT
+            (SELECT MAX(id) FROM orders) AS max_order_id,
+            (SELECT MAX(updated_at) FROM orders) AS orders_updated_at,
+            (SELECT MAX(updated_at) FROM sales_daily_product) AS product_rollup_updated_at,
+            (SELECT MAX(updated_at) FROM sales_daily_user) AS user_rollup_updated_at,
+            (SELECT MAX(updated_at) FROM products) AS products_updated_at,
+            (SELECT MAX(id) FROM users) AS max_user_id,
+            (SELECT MAX(updated_at) FROM users) AS users_updated_at,
+            (SELECT COUNT(*) FROM users) AS user_count,
+            CURRENT_DATE AS today
+    """)
+    version = cursor.fetchone()
+    # 「今天」以資料庫的時區為準（訂單 created_at 與彙總表 sale_date 都由資料庫產生），不用應用程式主機的時區
+    return make_etag(request.full_path, sorted(version.items())), version['today']
 
 # API路由 - 用戶認證
 
@@ -314,49 +2062,50 @@ def register():
     if len(password) < 6:
         return jsonify({'error': '密碼至少需要6個字符'}), 400
     
-    connection = get_db_connection()
-    if not connection:
-        return jsonify({'error': '資料庫連接失敗'}), 500
-    
+    # 先在 KDF 執行緒池計算雜湊，計算期間不占用資料庫連接
     try:
-        cursor = connection.cursor()
-        
-        # 檢查用戶名是否已存在
-        cursor.execute("SELECT id FROM users WHERE username = %s", (username,))
-        if cursor.fetchone():
-            cursor.close()
-            connection.close()
-            return jsonify({'error': '用戶名已存在'}), 400
-        
-        # 創建新用戶
-        hashed_password = hash_password(password)
-        cursor.execute("""
-            INSERT INTO users (username, password, name, role)
-            VALUES (%s, %s, %s, %s)
-        """, (username, hashed_password, name or username, 'user'))
-        
-        user_id = cursor.lastrowid
-        connection.commit()
-        cursor.close()
-        connection.close()
-        
-        # 自動登入
-        session['user_id'] = user_id
-        session['username'] = username
-        session['name'] = name or username
-        session['role'] = 'user'
+        hashed_password, _ = password_hasher.hash(password)
+    except KdfBusyError:
+        return jsonify({'error': '系統忙碌中，請稍後再試'}), 503
+    
+    with db_connection() as connection:
+        if not connection:
+            return jsonify({'error': '資料庫連接失敗'}), 500
         
-        return jsonify({
-            'message': '註冊成功',
-            'user': {
-                'id': user_id,
-                'username': username,
-                'name': name or username,
-                'role': 'user'
-            }
-        }), 201
-    except Error as e:
-        return jsonify({'error': str(e)}), 500
+        try:
+            cursor = connection.cursor()
+            
+            # 檢查用戶名是否已存在
+            cursor.execute("SELECT id FROM users WHERE username = %s", (username,))
+            if cursor.fetchone():
+                return jsonify({'error': '用戶名已存在'}), 400
+            
+            # 創建新用戶
+            cursor.execute("""
+                INSERT INTO users (username, password, name, role)
+                VALUES (%s, %s, %s, %s)
+            """, (username, hashed_password, name or username, 'user'))
+            
+            user_id = cursor.lastrowid
+            connection.commit()
+            
+            # 自動登入
+            session['user_id'] = user_id
+            session['username'] = username
+            session['name'] = name or username
+            session['role'] = 'user'
+            
+            return jsonify({
+                'message': '註冊成功',
+                'user': {
+                    'id': user_id,
+                    'username': username,
+                    'name': name or username,
+                    'role': 'user'
+                }
+            }), 201
+        except Error as e:
+            return jsonify({'error': str(e)}), 500
 
 @app.route('/api/auth/login', methods=['POST'])
 def login():
@@ -368,44 +2117,66 @@ def login():
     
     username = data['username'].strip()
     password = data['password']
+    started = time.perf_counter()
     
-    connection = get_db_connection()
-    if not connection:
-        return jsonify({'error': '資料庫連接失敗'}), 500
+    with db_connection() as connection:
+        if not connection:
+            return jsonify({'error': '資料庫連接失敗'}), 500
+        
+        try:
+            cursor = connection.cursor(dictionary=True)
+            cursor.execute("""
+                SELECT id, username, name, role, password FROM users
+                WHERE username = %s
+            """, (username,))
+            user = cursor.fetchone()
+        except Error as e:
+            return jsonify({'error': str(e)}), 500
     
+    # 連接已歸還後才在 KDF 執行緒池驗證密碼
     try:
-        cursor = connection.cursor(dictionary=True)
-        hashed_password = hash_password(password)
-        
-        cursor.execute("""
-            SELECT id, username, name, role FROM users
-            WHERE username = %s AND password = %s
-        """, (username, hashed_password))
-        
-        user = cursor.fetchone()
-        cursor.close()
-        connection.close()
-        
-        if not user:
-            return jsonify({'error': '用戶名或密碼錯誤'}), 401
-        
-        # 設置session
-        session['user_id'] = user['id']
-        session['username'] = user['username']
-        session['name'] = user['name'] or user['username']
-        session['role'] = user['role']
-        
-        return jsonify({
-            'message': '登入成功',
-            'user': {
-                'id': user['id'],
-                'username': user['username'],
-                'name': user['name'] or user['username'],
-                'role': user['role']
-            }
-        })
-    except Error as e:
-        return jsonify({'error': str(e)}), 500
+        ok, needs_rehash, cpu_seconds, cache_hit = password_hasher.verify(password, user['password'] if user else None)
+    except KdfBusyError:
+        login_metrics.record('busy', time.perf_counter() - started)
+        return jsonify({'error': '登入人數過多，請稍後再試'}), 503
+    
+    if not ok:
+        login_metrics.record('failure', time.perf_counter() - started, cpu_seconds)
+        return jsonify({'error': '用戶名或密碼錯誤'}), 401
+    
+    # 舊版 SHA256 或成本參數已調整：以目前設定重新雜湊（只在密碼未被同時修改時寫入）
+    rehashed = False
+    if needs_rehash:
+        try:
+            new_hash, rehash_cpu = password_hasher.hash(password)
+            cpu_seconds += rehash_cpu
+            with db_connection() as connection:
+                if connection:
+                    cursor = connection.cursor()
+                    cursor.execute("UPDATE users SET password = %s WHERE id = %s AND password = %s",
+                                   (new_hash, user['id'], user['password']))
+                    connection.commit()
+                    rehashed = cursor.rowcount == 1
+        except (KdfBusyError, Error) as e:
+            # 重新雜湊失敗不影響這次登入，下次登入再試
+            print(f"密碼重新雜湊失敗: {e}")
+    
+    # 設置session
+    session['user_id'] = user['id']
+    session['username'] = user['username']
+    session['name'] = user['name'] or user['username']
+    session['role'] = user['role']
+    login_metrics.record('success', time.perf_counter() - started, cpu_seconds, cache_hit, rehashed)
+    
+    return jsonify({
+        'message': '登入成功',
+        'user': {
+            'id': user['id'],
+            'username': user['username'],
+            'name': user['name'] or user['username'],
+            'role': user['role']
+        }
+    })
 
 @app.route('/api/auth/logout', methods=['POST'])
 def logout():
@@ -416,14 +2187,15 @@ def logout():
 @app.route('/api/auth/status', methods=['GET'])
 def auth_status():
     """檢查登入狀態"""
-    if check_login():
+    user = current_user()
+    if user:
         return jsonify({
             'logged_in': True,
             'user': {
-                'id': session.get('user_id'),
-                'username': session.get('username'),
-                'name': session.get('name'),
-                'role': session.get('role')
+                'id': user['id'],
+                'username': user['username'],
+                'name': user['name'] or user['username'],
+                'role': user['role']
             }
         })
     else:
@@ -440,152 +2212,258 @@ def update_profile():
         return jsonify({'error': '缺少資料'}), 400
     
     user_id = session.get('user_id')
-    connection = get_db_connection()
-    if not connection:
-        return jsonify({'error': '資料庫連接失敗'}), 500
+    updates = []
+    params = []
     
-    try:
-        cursor = connection.cursor()
+    # 更新用戶名（如果提供；是否重複在寫入前檢查）
+    new_username = None
+    if 'username' in data and data['username']:
+        new_username = data['username'].strip()
+        if len(new_username) < 3:
+            return jsonify({'error': '用戶名至少需要3個字符'}), 400
+        updates.append("username = %s")
+        params.append(new_username)
+    
+    # 更新密碼（如果提供）
+    stored_hash = None
+    if 'password' in data and data['password']:
+        new_password = data['password']
+        if len(new_password) < 6:
+            return jsonify({'error': '密碼至少需要6個字符'}), 400
         
-        # 獲取當前用戶信息
-        cursor.execute("SELECT username, password FROM users WHERE id = %s", (user_id,))
-        current_user = cursor.fetchone()
-        if not current_user:
-            cursor.close()
-            connection.close()
+        # 先讀出目前的密碼雜湊並歸還連接，KDF 計算期間不占用連接池（與登入相同）
+        with db_connection() as connection:
+            if not connection:
+                return jsonify({'error': '資料庫連接失敗'}), 500
+            try:
+                cursor = connection.cursor()
+                cursor.execute("SELECT password FROM users WHERE id = %s", (user_id,))
+                row = cursor.fetchone()
+            except Error as e:
+                return jsonify({'error': str(e)}), 500
+        if not row:
             return jsonify({'error': '用戶不存在'}), 404
+        stored_hash = row[0]
         
-        updates = []
-        params = []
+        try:
+            # 驗證舊密碼（如果提供）
+            if 'old_password' in data and data['old_password']:
+                ok, _, _, _ = password_hasher.verify(data['old_password'], stored_hash)
+                if not ok:
+                    return jsonify({'error': '舊密碼錯誤'}), 400
+            
+            hashed_password, _ = password_hasher.hash(new_password)
+        except KdfBusyError:
+            return jsonify({'error': '系統忙碌中，請稍後再試'}), 503
+        updates.append("password = %s")
+        params.append(hashed_password)
+    
+    # 更新姓名（如果提供）
+    if 'name' in data:
+        new_name = data['name'].strip() if data['name'] else None
+        updates.append("name = %s")
+        params.append(new_name)
+    
+    if not updates:
+        return jsonify({'error': '沒有需要更新的資料'}), 400
+    
+    with db_connection() as connection:
+        if not connection:
+            return jsonify({'error': '資料庫連接失敗'}), 500
         
-        # 更新用戶名（如果提供）
-        if 'username' in data and data['username']:
-            new_username = data['username'].strip()
-            if len(new_username) < 3:
-                cursor.close()
-                connection.close()
-                return jsonify({'error': '用戶名至少需要3個字符'}), 400
+        try:
+            cursor = connection.cursor()
+            
+            # 確認用戶存在
+            cursor.execute("SELECT id FROM users WHERE id = %s", (user_id,))
+            if not cursor.fetchone():
+                return jsonify({'error': '用戶不存在'}), 404
             
             # 檢查新用戶名是否已被其他用戶使用
-            cursor.execute("SELECT id FROM users WHERE username = %s AND id != %s", (new_username, user_id))
-            if cursor.fetchone():
-                cursor.close()
-                connection.close()
-                return jsonify({'error': '用戶名已被使用'}), 400
+            if new_username:
+                cursor.execute("SELECT id FROM users WHERE username = %s AND id != %s", (new_username, user_id))
+                if cursor.fetchone():
+                    return jsonify({'error': '用戶名已被使用'}), 400
             
-            updates.append("username = %s")
-            params.append(new_username)
-        
-        # 更新密碼（如果提供）
-        if 'password' in data and data['password']:
-            new_password = data['password']
-            if len(new_password) < 6:
-                cursor.close()
-                connection.close()
-                return jsonify({'error': '密碼至少需要6個字符'}), 400
+            # 執行更新；更改密碼時只在密碼雜湊仍是驗證時讀到的值才寫入，避免覆蓋期間被同時修改的密碼
+            params.append(user_id)
+            query = f"UPDATE users SET {', '.join(updates)} WHERE id = %s"
+            if stored_hash is not None:
+                query += " AND password = %s"
+                params.append(stored_hash)
+            cursor.execute(query, params)
+            if stored_hash is not None and cursor.rowcount == 0:
+                connection.rollback()
+                return jsonify({'error': '密碼已被變更，請重新操作'}), 409
+            connection.commit()
             
-            # 驗證舊密碼（如果提供）
-            if 'old_password' in data and data['old_password']:
-                old_password_hash = hash_password(data['old_password'])
-                if current_user[1] != old_password_hash:
-                    cursor.close()
-                    connection.close()
-                    return jsonify({'error': '舊密碼錯誤'}), 400
+            # 獲取更新後的用戶信息
+            cursor.execute("SELECT id, username, name, role FROM users WHERE id = %s", (user_id,))
+            updated_user = cursor.fetchone()
             
-            hashed_password = hash_password(new_password)
-            updates.append("password = %s")
-            params.append(hashed_password)
-        
-        # 更新姓名（如果提供）
-        if 'name' in data:
-            new_name = data['name'].strip() if data['name'] else None
-            updates.append("name = %s")
-            params.append(new_name)
-        
-        if not updates:
-            cursor.close()
-            connection.close()
-            return jsonify({'error': '沒有需要更新的資料'}), 400
-        
-        # 執行更新
-        params.append(user_id)
-        query = f"UPDATE users SET {', '.join(updates)} WHERE id = %s"
-        cursor.execute(query, params)
-        connection.commit()
-        
-        # 獲取更新後的用戶信息
-        cursor.execute("SELECT id, username, name, role FROM users WHERE id = %s", (user_id,))
-        updated_user = cursor.fetchone()
-        
-        # 更新session
-        if 'username' in data and data['username']:
-            session['username'] = updated_user[1]
-        if 'name' in data:
-            session['name'] = updated_user[2] or updated_user[1]
-        
-        cursor.close()
-        connection.close()
-        
-        return jsonify({
-            'message': '資料更新成功',
-            'user': {
-                'id': updated_user[0],
-                'username': updated_user[1],
-                'name': updated_user[2] or updated_user[1],
-                'role': updated_user[3]
-            }
-        })
-    except Error as e:
-        return jsonify({'error': str(e)}), 500
+            # 更新session與用戶快取
+            user_cache.invalidate(user_id)
+            if 'username' in data and data['username']:
+                session['username'] = updated_user[1]
+            if 'name' in data:
+                session['name'] = updated_user[2] or updated_user[1]
+            
+            
+            return jsonify({
+                'message': '資料更新成功',
+                'user': {
+                    'id': updated_user[0],
+                    'username': updated_user[1],
+                    'name': updated_user[2] or updated_user[1],
+                    'role': updated_user[3]
+                }
+            })
+        except Error as e:
+            return jsonify({'error': str(e)}), 500
 
 # API路由 - 商品管理
 
+# 商品可投影的欄位（?fields=）
+PRODUCT_FIELDS = ('id', 'sku', 'name', 'price', 'stock', 'description', 'created_at', 'updated_at')
+
+# ngram 全文索引的最小詞長（MySQL 預設 ngram_token_size=2），更短的關鍵字改用前綴比對
+NGRAM_TOKEN_SIZE = 2
+
+_product_fulltext = None
+
+def parse_product_fields(value):
+    """解析 ?fields= 欄位投影，id 一定會包含"""
+    if not value:
+        return list(PRODUCT_FIELDS)
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in PRODUCT_FIELDS]
+    if unknown:
+        raise ValueError(f"不支援的欄位: {', '.join(unknown)}")
+    if 'id' not in fields:
+        fields.insert(0, 'id')
+    return fields
+
+def has_product_fulltext(cursor):
+    """檢查商品名稱全文索引是否存在（結果快取於行程內）"""
+    global _product_fulltext
+    if _product_fulltext is None:
+        cursor.execute("""
+            SELECT COUNT(*) AS count FROM information_schema.STATISTICS
+            WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'products' AND INDEX_NAME = 'ft_name'
+        """, (DB_CONFIG['database'],))
+        _product_fulltext = cursor.fetchone()['count'] > 0
+    return _product_fulltext
+
+def product_search_condition(cursor, q):
+    """商品名稱搜尋條件：走 ngram 全文索引，關鍵字過短或無全文索引時走名稱前綴索引"""
+    term = q.replace('"', ' ').strip()
+    if not term:
+        return None, []
+    if len(term) >= NGRAM_TOKEN_SIZE and has_product_fulltext(cursor):
+        return 'MATCH(name) AGAINST (%s IN BOOLEAN MODE)', [f'"{term}"']
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return 'name LIKE %s', [escaped + '%']
+
+def fetch_product_page(cursor, q, after, limit):
+    """從資料庫查詢一頁完整商品資料，回傳 (商品列表, 下一頁游標)"""
+    conditions = ['is_active = 1']
+    params = []
+    search_condition, search_params = product_search_condition(cursor, q)
+    if search_condition:
+        conditions.append(search_condition)
+        params.extend(search_params)
+    if after is not None:
+        conditions.append('id < %s')
+        params.append(after)
+    where = f"WHERE {' AND '.join(conditions)}"
+    
+    # 多取一筆用來判斷是否還有下一頁；取完整欄位以便快取後依投影回傳
+    cursor.execute(f"""
+        SELECT {', '.join(PRODUCT_FIELDS)} FROM products
+        {where}
+        ORDER BY id DESC
+        LIMIT %s
+    """, (*params, limit + 1))
+    products = cursor.fetchall()
+    
+    next_cursor = None
+    if len(products) > limit:
+        products = products[:limit]
+        next_cursor = str(products[-1]['id'])
+    
+    # 轉換Decimal為float以便JSON序列化
+    for product in products:
+        product['price'] = float(product['price'])
+        product['stock'] = int(product['stock'])
+    return products, next_cursor
+
 @app.route('/api/products', methods=['GET'])
 def get_products():
-    """獲取所有商品"""
-    connection = get_db_connection()
-    if not connection:
-        return jsonify({'error': '資料庫連接失敗'}), 500
-    
+    """獲取商品（支援 ?q= 搜尋、?limit= / ?after= 游標分頁、?fields= 欄位投影）"""
     try:
-        cursor = connection.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM products ORDER BY id DESC")
-        products = cursor.fetchall()
-        
-        # 轉換Decimal為float以便JSON序列化
-        for product in products:
-            product['price'] = float(product['price'])
-            product['stock'] = int(product['stock'])
-        
-        cursor.close()
-        connection.close()
-        return jsonify(products)
-    except Error as e:
-        return jsonify({'error': str(e)}), 500
+        limit = parse_limit(request.args.get('limit'))
+        fields = parse_product_fields(request.args.get('fields'))
+        after = int(request.args['after']) if request.args.get('after') else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    q = request.args.get('q', '').strip()
+    
+    # 先查目錄快取，未命中才讀資料庫
+    page_key = (q, after, limit)
+    page = catalog_cache.get_page(page_key)
+    if page is None:
+        with db_connection() as connection:
+            if not connection:
+                return jsonify({'error': '資料庫連接失敗'}), 500
+            
+            try:
+                generation = catalog_cache.generation()
+                cursor = connection.cursor(dictionary=True)
+                page = fetch_product_page(cursor, q, after, limit)
+                catalog_cache.put_page(page_key, *page, generation)
+            except Error as e:
+                return jsonify({'error': str(e)}), 500
+    
+    products, next_cursor = page
+    rows = [{field: product[field] for field in fields} for product in products]
+    # ETag 由本頁商品列（含 updated_at 與庫存）計算，快取命中時不需查詢資料庫即可回 304
+    etag = make_etag(fields, next_cursor, products)
+    if etag_matches(etag):
+        response = not_modified(etag)
+    else:
+        response = with_etag(jsonify(rows), etag)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
 
 @app.route('/api/products/<int:product_id>', methods=['GET'])
 def get_product(product_id):
     """獲取單一商品"""
-    connection = get_db_connection()
-    if not connection:
-        return jsonify({'error': '資料庫連接失敗'}), 500
+    product = catalog_cache.get_item(product_id)
+    if product is None:
+        with db_connection() as connection:
+            if not connection:
+                return jsonify({'error': '資料庫連接失敗'}), 500
+            
+            try:
+                generation = catalog_cache.generation()
+                cursor = connection.cursor(dictionary=True)
+                cursor.execute(f"SELECT {', '.join(PRODUCT_FIELDS)} FROM products WHERE id = %s AND is_active = 1", (product_id,))
+                product = cursor.fetchone()
+                
+                if not product:
+                    return jsonify({'error': '商品不存在'}), 404
+                
+                product['price'] = float(product['price'])
+                product['stock'] = int(product['stock'])
+                catalog_cache.put_item(product, generation)
+            except Error as e:
+                return jsonify({'error': str(e)}), 500
     
-    try:
-        cursor = connection.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM products WHERE id = %s", (product_id,))
-        product = cursor.fetchone()
-        
-        if not product:
-            return jsonify({'error': '商品不存在'}), 404
-        
-        product['price'] = float(product['price'])
-        product['stock'] = int(product['stock'])
-        
-        cursor.close()
-        connection.close()
-        return jsonify(product)
-    except Error as e:
-        return jsonify({'error': str(e)}), 500
+    etag = make_etag(product)
+    if etag_matches(etag):
+        return not_modified(etag)
+    return with_etag(jsonify(product), etag)
 
 @app.route('/api/products', methods=['POST'])
 def create_product():
@@ -595,29 +2473,31 @@ def create_product():
     if not data or not data.get('name') or not data.get('price') or not data.get('stock'):
         return jsonify({'error': '缺少必要欄位'}), 400
     
-    connection = get_db_connection()
-    if not connection:
-        return jsonify({'error': '資料庫連接失敗'}), 500
-    
-    try:
-        cursor = connection.cursor()
-        cursor.execute("""
-            INSERT INTO products (name, price, stock, description)
-            VALUES (%s, %s, %s, %s)
-        """, (
-            data['name'],
-            data['price'],
-            data['stock'],
-            data.get('description', '')
-        ))
-        connection.commit()
-        product_id = cursor.lastrowid
-        cursor.close()
-        connection.close()
+    with db_connection() as connection:
+        if not connection:
+            return jsonify({'error': '資料庫連接失敗'}), 500
         
-        return jsonify({'id': product_id, 'message': '商品創建成功'}), 201
-    except Error as e:
-        return jsonify({'error': str(e)}), 500
+        try:
+            cursor = connection.cursor()
+            cursor.execute("""
+                INSERT INTO products (sku, name, price, stock, description)
+                VALUES (%s, %s, %s, %s, %s)
+            """, (
+                (data.get('sku') or '').strip() or None,
+                data['name'],
+                data['price'],
+                data['stock'],
+                data.get('description', '')
+            ))
+            connection.commit()
+            product_id = cursor.lastrowid
+            catalog_cache.invalidate_pages()
+            
+            return jsonify({'id': product_id, 'message': '商品創建成功'}), 201
+        except IntegrityError:
+            return jsonify({'error': '商品貨號已存在'}), 400
+        except Error as e:
+            return jsonify({'error': str(e)}), 500
 
 @app.route('/api/products/<int:product_id>', methods=['PUT'])
 def update_product(product_id):
@@ -627,80 +2507,971 @@ def update_product(product_id):
     if not data:
         return jsonify({'error': '缺少資料'}), 400
     
-    connection = get_db_connection()
-    if not connection:
-        return jsonify({'error': '資料庫連接失敗'}), 500
-    
-    try:
-        cursor = connection.cursor()
-        
-        # 檢查商品是否存在
-        cursor.execute("SELECT id FROM products WHERE id = %s", (product_id,))
-        if not cursor.fetchone():
-            cursor.close()
-            connection.close()
-            return jsonify({'error': '商品不存在'}), 404
-        
-        # 更新商品
-        cursor.execute("""
-            UPDATE products
-            SET name = %s, price = %s, stock = %s, description = %s
-            WHERE id = %s
-        """, (
-            data.get('name'),
-            data.get('price'),
-            data.get('stock'),
-            data.get('description', ''),
-            product_id
-        ))
-        connection.commit()
-        cursor.close()
-        connection.close()
+    with db_connection() as connection:
+        if not connection:
+            return jsonify({'error': '資料庫連接失敗'}), 500
         
-        return jsonify({'message': '商品更新成功'})
-    except Error as e:
-        return jsonify({'error': str(e)}), 500
+        try:
+            cursor = connection.cursor()
+            
+            # 檢查商品是否存在
+            cursor.execute("SELECT id FROM products WHERE id = %s AND is_active = 1", (product_id,))
+            if not cursor.fetchone():
+                return jsonify({'error': '商品不存在'}), 404
+            
+            # 更新商品（有傳 sku 時才更新貨號）
+            sku_assignment = ", sku = %s" if 'sku' in data else ""
+            sku_params = ((data.get('sku') or '').strip() or None,) if 'sku' in data else ()
+            cursor.execute(f"""
+                UPDATE products
+                SET name = %s, price = %s, stock = %s, description = %s{sku_assignment}
+                WHERE id = %s
+            """, (
+                data.get('name'),
+                data.get('price'),
+                data.get('stock'),
+                data.get('description', ''),
+                *sku_params,
+                product_id
+            ))
+            connection.commit()
+            catalog_cache.invalidate_items([product_id])
+            catalog_cache.invalidate_pages()
+            
+            return jsonify({'message': '商品更新成功'})
+        except IntegrityError:
+            return jsonify({'error': '商品貨號已存在'}), 400
+        except Error as e:
+            return jsonify({'error': str(e)}), 500
 
 @app.route('/api/products/<int:product_id>', methods=['DELETE'])
 def delete_product(product_id):
-    """刪除商品"""
-    connection = get_db_connection()
-    if not connection:
-        return jsonify({'error': '資料庫連接失敗'}), 500
-    
+    """刪除商品（軟刪除：下架但保留歷史訂單項目）"""
+    with db_connection() as connection:
+        if not connection:
+            return jsonify({'error': '資料庫連接失敗'}), 500
+        
+        try:
+            cursor = connection.cursor()
+            
+            # 只更新單一商品列，不鎖定 order_items，營業時間也可安全執行
+            cursor.execute("UPDATE products SET is_active = 0 WHERE id = %s AND is_active = 1", (product_id,))
+            if cursor.rowcount == 0:
+                return jsonify({'error': '商品不存在'}), 404
+            
+            connection.commit()
+            catalog_cache.invalidate_items([product_id])
+            catalog_cache.invalidate_pages()
+            
+            return jsonify({'message': '商品刪除成功'})
+        except Error as e:
+            return jsonify({'error': str(e)}), 500
+
+# 商品批次匯入：每批寫入列數、單次上傳列數上限、回報的錯誤筆數上限
+PRODUCT_IMPORT_CHUNK = 1000
+PRODUCT_IMPORT_LIMIT = 200000
+PRODUCT_IMPORT_MAX_ERRORS = 1000
+
+def iter_import_rows():
+    """依 Content-Type 逐筆產生 (列號, 資料)：CSV 與 NDJSON 邊讀邊解析，JSON 陣列整份解析"""
+    mimetype = request.mimetype
+    if mimetype == 'application/json':
+        data = request.get_json(silent=True)
+        if not isinstance(data, list):
+            raise ValueError('JSON 內容必須為商品陣列')
+        yield from enumerate(data, 1)
+    elif mimetype == 'application/x-ndjson':
+        stream = io.TextIOWrapper(request.stream, encoding='utf-8-sig')
+        row_number = 0
+        for line in stream:
+            if not line.strip():
+                continue
+            row_number += 1
+            try:
+                yield row_number, json.loads(line)
+            except ValueError:
+                yield row_number, None
+    elif mimetype in ('text/csv', 'multipart/form-data'):
+        # multipart 上傳時讀取 file 欄位；utf-8-sig 可接受 Excel 匯出的 BOM
+        upload = request.files.get('file') if mimetype == 'multipart/form-data' else None
+        if mimetype == 'multipart/form-data' and upload is None:
+            raise ValueError('缺少上傳檔案（file 欄位）')
+        stream = io.TextIOWrapper(upload.stream if upload else request.stream, encoding='utf-8-sig', newline='')
+        yield from enumerate(csv.DictReader(stream), 1)
+    else:
+        raise ValueError('僅支援 text/csv、application/json、application/x-ndjson 或 multipart 上傳 CSV')
+
+def parse_import_row(row):
+    """驗證一筆匯入資料，回傳 (sku, name, price, stock, description)"""
+    if not isinstance(row, dict):
+        raise ValueError('資料格式錯誤')
+    sku = str(row.get('sku') or '').strip()
+    name = str(row.get('name') or '').strip()
+    if not sku or len(sku) > 64:
+        raise ValueError('sku 必填且不可超過 64 字元')
+    if not name or len(name) > 255:
+        raise ValueError('name 必填且不可超過 255 字元')
     try:
-        # 設置為手動提交模式（禁用自動提交）
-        connection.autocommit = False
+        price = Decimal(str(row.get('price')).strip()).quantize(CENT, rounding=ROUND_HALF_UP)
+        stock = int(str(row.get('stock', 0) or 0).strip())
+    except (ArithmeticError, ValueError):
+        raise ValueError('price 或 stock 格式錯誤')
+    if not price.is_finite() or price < 0 or price >= Decimal('100000000'):
+        raise ValueError('price 超出範圍')
+    if stock < 0:
+        raise ValueError('stock 不可為負數')
+    return sku, name, price, stock, str(row.get('description') or '')
+
+def upsert_products(cursor, rows):
+    """以單一多列 INSERT ... ON DUPLICATE KEY UPDATE 依 sku 新增或更新一批商品，回傳新增的筆數"""
+    # 同一批內重複的 sku 以最後一筆為準
+    rows = list({row[0]: row for row in rows}.values())
+    placeholders = ', '.join(['%s'] * len(rows))
+    cursor.execute(f"SELECT COUNT(*) FROM products WHERE sku IN ({placeholders})", tuple(row[0] for row in rows))
+    existing = cursor.fetchone()[0]
+    cursor.executemany("""
+        INSERT INTO products (sku, name, price, stock, description)
+        VALUES (%s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            name = VALUES(name),
+            price = VALUES(price),
+            stock = VALUES(stock),
+            description = VALUES(description),
+            is_active = 1
+    """, rows)
+    return len(rows) - existing
+
+@app.route('/api/products/bulk', methods=['POST'])
+def bulk_import_products():
+    """批次匯入商品（管理員）：CSV 或 JSON，依 sku 新增或更新，回傳逐列錯誤報告"""
+    if not check_admin():
+        return jsonify({'error': '需要管理員權限'}), 403
+    
+    with db_connection() as connection:
+        if not connection:
+            return jsonify({'error': '資料庫連接失敗'}), 500
+        
         cursor = connection.cursor()
+        total = imported = created = failed = 0
+        errors = []
         
-        # 檢查商品是否存在
-        cursor.execute("SELECT id FROM products WHERE id = %s", (product_id,))
-        if not cursor.fetchone():
-            cursor.close()
-            connection.close()
-            return jsonify({'error': '商品不存在'}), 404
+        def report(row_number, sku, message):
+            nonlocal failed
+            failed += 1
+            if len(errors) < PRODUCT_IMPORT_MAX_ERRORS:
+                errors.append({'row': row_number, 'sku': sku, 'error': message})
         
-        # 先刪除所有相關的訂單項目（因為外鍵約束）
-        cursor.execute("DELETE FROM order_items WHERE product_id = %s", (product_id,))
+        def flush(chunk):
+            nonlocal imported, created
+            # 每批一個語句、自動提交；資料庫拒絕時整批記為失敗，其餘批次繼續
+            try:
+                created += upsert_products(cursor, [row for _, row in chunk])
+                imported += len(chunk)
+            except Error as e:
+                for row_number, row in chunk:
+                    report(row_number, row[0], str(e))
         
-        # 然後刪除商品
-        cursor.execute("DELETE FROM products WHERE id = %s", (product_id,))
+        try:
+            chunk = []
+            for row_number, row in iter_import_rows():
+                total += 1
+                if total > PRODUCT_IMPORT_LIMIT:
+                    report(row_number, None, f'超過單次匯入上限 {PRODUCT_IMPORT_LIMIT} 筆，其餘資料未處理')
+                    break
+                try:
+                    chunk.append((row_number, parse_import_row(row)))
+                except ValueError as e:
+                    report(row_number, row.get('sku') if isinstance(row, dict) else None, str(e))
+                    continue
+                if len(chunk) >= PRODUCT_IMPORT_CHUNK:
+                    flush(chunk)
+                    chunk = []
+            if chunk:
+                flush(chunk)
+        except (ValueError, UnicodeDecodeError, csv.Error) as e:
+            if not total:
+                return jsonify({'error': str(e)}), 400
+            report(total, None, f'解析中止: {e}')
+        finally:
+            if imported:
+                catalog_cache.invalidate_all()
         
-        # 提交事務
+        return jsonify({
+            'total': total,
+            'imported': imported,
+            'created': created,
+            'updated': imported - created,
+            'failed': failed,
+            'errors': errors,
+            'message': f'已匯入 {imported} 筆商品，{failed} 筆失敗'
+        })
+
+# 工具函數：庫存鎖定與批次更新
+def parse_item_int(value):
+    """請求內容中的整數欄位（訂單項目、訂單ID）：只接受 JSON 整數或純數字字串（2.9、true 等不會被截斷成整數）"""
+    if isinstance(value, bool):
+        raise ValueError(value)
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.isascii() and value.isdigit():
+        return int(value)
+    raise ValueError(value)
+
+def sum_item_quantities(items):
+    """驗證訂單項目並合併同一商品的數量，回傳 {商品ID: 數量}"""
+    quantities = {}
+    for item in items:
+        try:
+            product_id = parse_item_int(item['product_id'])
+            quantity = parse_item_int(item['quantity'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('訂單項目格式錯誤')
+        if quantity <= 0:
+            raise ValueError(f'商品 ID {product_id} 數量必須大於 0')
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+    return quantities
+
+def lock_products(connection, product_ids):
+    """以單一 SELECT ... FOR UPDATE 鎖定商品列，回傳 {商品ID: {'id', 'stock', 'price', 'is_active'}}"""
+    # 所有寫入庫存的交易都依商品ID遞增順序上鎖，彼此只會排隊而不會死結
+    product_ids = sorted(product_ids)
+    if not product_ids:
+        return {}
+    cursor = connection.cursor(dictionary=True)
+    placeholders = ', '.join(['%s'] * len(product_ids))
+    cursor.execute(f"""
+        SELECT id, stock, price, is_active FROM products
+        WHERE id IN ({placeholders})
+        ORDER BY id
+        FOR UPDATE
+    """, tuple(product_ids))
+    return {row['id']: row for row in cursor.fetchall()}
+
+# 營業稅率與金額精度
+TAX_RATE = Decimal('0.05')
+CENT = Decimal('0.01')
+
+# 工具函數：訂單計價
+def price_order(quantities, prices):
+    """以 Decimal 在伺服器端計算訂單金額，回傳各行明細與小計、5% 稅額、總計"""
+    # 整個購物籃一次走訪：各行金額為精確的 單價 × 數量，只在稅額四捨五入到分一次
+    lines = [
+        {
+            'product_id': product_id,
+            'quantity': quantity,
+            'price': Decimal(str(prices[product_id])),
+            'line_total': Decimal(str(prices[product_id])) * quantity
+        }
+        for product_id, quantity in quantities.items()
+    ]
+    subtotal = sum((line['line_total'] for line in lines), Decimal('0'))
+    tax = (subtotal * TAX_RATE).quantize(CENT, rounding=ROUND_HALF_UP)
+    return {'items': lines, 'subtotal': subtotal, 'tax': tax, 'total': subtotal + tax}
+
+def apply_stock_deltas(cursor, deltas):
+    """以單一 UPDATE ... CASE 套用多個商品的庫存增減（{商品ID: 增減量}）"""
+    deltas = {product_id: delta for product_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    product_ids = sorted(deltas)
+    cases = ' '.join(['WHEN %s THEN %s'] * len(product_ids))
+    placeholders = ', '.join(['%s'] * len(product_ids))
+    params = [value for product_id in product_ids for value in (product_id, deltas[product_id])]
+    cursor.execute(f"""
+        UPDATE products
+        SET stock = stock + CASE id {cases} END
+        WHERE id IN ({placeholders})
+    """, (*params, *product_ids))
+
+# 工具函數：每日銷售彙總表（rollup）
+def new_rollup_deltas():
+    """建立彙總表增減量：products 為 {(日期, 商品ID): [數量, 金額]}，users 為 {(日期, 用戶ID): [訂單數, 金額, 件數]}"""
+    return {'products': {}, 'users': {}}
+
+def rollup_order(deltas, order, lines, sign=1):
+    """將一筆訂單（created_at、user_id、total）與其明細 [(商品ID, 數量, 單價)] 計入增減量，sign=-1 表示扣除"""
+    sale_date = order['created_at'].date()
+    for product_id, quantity, price in lines:
+        entry = deltas['products'].setdefault((sale_date, product_id), [0, Decimal('0')])
+        entry[0] += sign * quantity
+        entry[1] += sign * quantity * Decimal(str(price))
+    if order['user_id'] is not None:
+        entry = deltas['users'].setdefault((sale_date, order['user_id']), [0, Decimal('0'), 0])
+        entry[0] += sign
+        entry[1] += sign * Decimal(str(order['total']))
+        entry[2] += sign * sum(quantity for _, quantity, _ in lines)
+
+def apply_rollup_deltas(cursor, deltas):
+    """以 INSERT ... ON DUPLICATE KEY UPDATE 累加彙總表，略過淨變化為零的列"""
+    # 依主鍵順序寫入；呼叫前已鎖定相關商品列，同一商品的彙總列不會交錯上鎖
+    product_rows = [
+        (sale_date, product_id, quantity, revenue)
+        for (sale_date, product_id), (quantity, revenue) in sorted(deltas['products'].items())
+        if quantity or revenue
+    ]
+    if product_rows:
+        cursor.executemany("""
+            INSERT INTO sales_daily_product (sale_date, product_id, quantity_sold, revenue)
+            VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                quantity_sold = quantity_sold + VALUES(quantity_sold),
+                revenue = revenue + VALUES(revenue)
+        """, product_rows)
+
+    user_rows = [
+        (sale_date, user_id, order_count, total_sales, items_sold)
+        for (sale_date, user_id), (order_count, total_sales, items_sold) in sorted(deltas['users'].items())
+        if order_count or total_sales or items_sold
+    ]
+    if user_rows:
+        cursor.executemany("""
+            INSERT INTO sales_daily_user (sale_date, user_id, order_count, total_sales, items_sold)
+            VALUES (%s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                order_count = order_count + VALUES(order_count),
+                total_sales = total_sales + VALUES(total_sales),
+                items_sold = items_sold + VALUES(items_sold)
+        """, user_rows)
+
+def user_sales_query(windowed=False):
+    """由訂單計算各用戶的訂單數、金額與件數；windowed 時需依序傳入兩組 (起, 迄) 的 created_at 參數"""
+    # 明細先在衍生資料表中逐單加總（沿涵蓋索引的 order_id 順序），再與訂單一對一連接並只分組一次；
+    # 訂單金額不會被明細列數放大，也不需要逐用戶的相關子查詢
+    items_filter = "WHERE order_id IN (SELECT id FROM orders WHERE created_at >= %s AND created_at < %s)" if windowed else ""
+    orders_filter = "AND o.created_at >= %s AND o.created_at < %s" if windowed else ""
+    return f"""
+        SELECT
+            o.user_id,
+            COUNT(*) AS order_count,
+            SUM(o.total) AS total_sales,
+            COALESCE(SUM(item_count.items_sold), 0) AS items_sold
+        FROM orders o
+        LEFT JOIN (
+            SELECT order_id, SUM(quantity) AS items_sold
+            FROM order_items
+            {items_filter}
+            GROUP BY order_id
+        ) item_count ON item_count.order_id = o.id
+        WHERE o.user_id IS NOT NULL {orders_filter}
+        GROUP BY o.user_id
+    """
+
+def rebuild_rollups(start=None, end=None):
+    """由訂單明細重建每日銷售彙總表（start/end 為含頭含尾的日期，預設涵蓋所有訂單與既有彙總）"""
+    with db_connection() as connection:
+        if not connection:
+            return False
+
+        try:
+            cursor = connection.cursor()
+            if start is None or end is None:
+                cursor.execute("""
+                    SELECT
+                        (SELECT DATE(MIN(created_at)) FROM orders),
+                        (SELECT DATE(MAX(created_at)) FROM orders),
+                        (SELECT MIN(sale_date) FROM sales_daily_product),
+                        (SELECT MAX(sale_date) FROM sales_daily_product),
+                        (SELECT MIN(sale_date) FROM sales_daily_user),
+                        (SELECT MAX(sale_date) FROM sales_daily_user)
+                """)
+                bounds = cursor.fetchone()
+                known = [day for day in bounds if day is not None]
+                if not known:
+                    return True
+                start = start or min(known)
+                end = end or max(known)
+
+            # 每天一個交易，只鎖定當天的訂單範圍，重建期間結帳僅短暫等待
+            connection.autocommit = False
+            day = start
+            while day <= end:
+                day_start = datetime(day.year, day.month, day.day)
+                day_end = day_start + timedelta(days=1)
+                cursor.execute("DELETE FROM sales_daily_product WHERE sale_date = %s", (day,))
+                cursor.execute("DELETE FROM sales_daily_user WHERE sale_date = %s", (day,))
+                cursor.execute("""
+                    INSERT INTO sales_daily_product (sale_date, product_id, quantity_sold, revenue)
+                    SELECT %s, oi.product_id, SUM(oi.quantity), SUM(oi.quantity * oi.price)
+                    FROM orders o
+                    JOIN order_items oi ON oi.order_id = o.id
+                    WHERE o.created_at >= %s AND o.created_at < %s
+                    GROUP BY oi.product_id
+                """, (day, day_start, day_end))
+                cursor.execute(f"""
+                    INSERT INTO sales_daily_user (sale_date, user_id, order_count, total_sales, items_sold)
+                    SELECT %s, user_id, order_count, total_sales, items_sold
+                    FROM ({user_sales_query(windowed=True)}) user_sales
+                """, (day, day_start, day_end, day_start, day_end))
+                connection.commit()
+                day += timedelta(days=1)
+
+            print(f"彙總表已重建：{start} ~ {end}")
+            return True
+        except Error as e:
+            connection.rollback()
+            print(f"重建彙總表時發生錯誤: {e}")
+            return False
+
+def reserve_stock(connection, quantities):
+    """鎖定商品並扣除庫存（尚未提交），回傳以鎖定列上目前售價計算的金額；商品不存在或庫存不足時拋出 ValueError"""
+    # 依商品ID固定順序一次鎖定所有相關商品，檢查與扣庫存之間不會被其他結帳插隊
+    locked = lock_products(connection, quantities)
+    for product_id in sorted(quantities):
+        if product_id not in locked or not locked[product_id]['is_active']:
+            raise ValueError(f'商品 ID {product_id} 不存在')
+        if locked[product_id]['stock'] < quantities[product_id]:
+            raise ValueError(f'商品 ID {product_id} 庫存不足')
+    
+    # 單一語句扣除所有商品庫存
+    apply_stock_deltas(connection.cursor(), {product_id: -quantity for product_id, quantity in quantities.items()})
+    
+    # 以鎖定列上的目前售價在伺服器端計價，不採用用戶端傳來的金額
+    return price_order(quantities, {product_id: locked[product_id]['price'] for product_id in quantities})
+
+def release_stock(quantities, token=None):
+    """歸還已扣除但訂單未能寫入的庫存（{商品ID: 數量}），成功時回傳 True；
+    指定 token 時與刪除預留列同一交易，預留不存在（扣庫存交易未提交或已歸還）時不歸還"""
+    with db_connection() as connection:
+        if not connection:
+            return False
+        try:
+            connection.autocommit = False
+            cursor = connection.cursor()
+            if token is not None:
+                cursor.execute("DELETE FROM stock_reservations WHERE token = %s", (token,))
+                if cursor.rowcount == 0:
+                    connection.commit()
+                    return True
+            apply_stock_deltas(cursor, quantities)
+            connection.commit()
+        except Error as e:
+            connection.rollback()
+            print(f"歸還庫存失敗: {e}")
+            return False
+    catalog_cache.invalidate_items(quantities)
+    return True
+
+def commit_order_batch(connection, orders):
+    """把佇列中已扣庫存的訂單（token、user_id、items、subtotal、tax、total、reserved）以單一交易寫入，
+    回傳 {代碼: 訂單ID}；扣庫存交易沒有提交的訂單作廢，訂單ID為 None"""
+    cursor = connection.cursor()
+    tokens = [order['token'] for order in orders]
+    placeholders = ', '.join(['%s'] * len(tokens))
+    # 上次已寫入但行程在回報佇列前中斷的訂單，不再重複寫入
+    cursor.execute(f"SELECT ingest_token, id FROM orders WHERE ingest_token IN ({placeholders})", tuple(tokens))
+    order_ids = dict(cursor.fetchall())
+    pending = [order for order in orders if order['token'] not in order_ids]
+    
+    # 結帳先寫入佇列才提交扣庫存交易：鎖定讀取會等待尚未提交的預留列，
+    # 讀不到代表扣庫存交易已回滾（例如行程在提交前中斷），庫存沒有被扣，訂單作廢
+    reserved_tokens = [order['token'] for order in pending if order['reserved']]
+    if reserved_tokens:
+        placeholders = ', '.join(['%s'] * len(reserved_tokens))
+        cursor.execute(f"SELECT token FROM stock_reservations WHERE token IN ({placeholders}) FOR UPDATE",
+                       tuple(reserved_tokens))
+        found = {row[0] for row in cursor.fetchall()}
+        for token in reserved_tokens:
+            if token not in found:
+                order_ids[token] = None
+        pending = [order for order in pending if order['token'] not in order_ids]
+        if found:
+            # 預留與訂單寫入同一交易結束
+            cursor.execute(f"DELETE FROM stock_reservations WHERE token IN ({', '.join(['%s'] * len(found))})",
+                           tuple(sorted(found)))
+    if not pending:
         connection.commit()
-        cursor.close()
-        connection.close()
+        return order_ids
+    
+    # executemany 會合併為單一多列 INSERT；訂單ID與實際寫入的 created_at 依代碼讀回
+    cursor.executemany("""
+        INSERT INTO orders (user_id, subtotal, tax, total, ingest_token)
+        VALUES (%s, %s, %s, %s, %s)
+    """, [(order['user_id'], order['subtotal'], order['tax'], order['total'], order['token']) for order in pending])
+    pending_tokens = [order['token'] for order in pending]
+    cursor.execute(f"""
+        SELECT ingest_token, id, created_at FROM orders
+        WHERE ingest_token IN ({', '.join(['%s'] * len(pending_tokens))})
+    """, tuple(pending_tokens))
+    created = {token: (order_id, created_at) for token, order_id, created_at in cursor.fetchall()}
+    
+    cursor.executemany("""
+        INSERT INTO order_items (order_id, product_id, quantity, price)
+        VALUES (%s, %s, %s, %s)
+    """, [
+        (created[order['token']][0], product_id, quantity, price)
+        for order in pending
+        for product_id, quantity, price in order['items']
+    ])
+    
+    # 整批訂單的彙總表增減量合併後一次寫入（依主鍵順序上鎖，與結帳交易不會互相死結）
+    deltas = new_rollup_deltas()
+    for order in pending:
+        order_id, created_at = created[order['token']]
+        order_ids[order['token']] = order_id
+        rollup_order(deltas, {'created_at': created_at, 'user_id': order['user_id'], 'total': order['total']}, order['items'])
+    apply_rollup_deltas(cursor, deltas)
+    connection.commit()
+    return order_ids
+
+class OrderQueue:
+    """非同步結帳的本機持久佇列（SQLite WAL）與批次寫入 MySQL 的背景執行緒"""
+
+    def __init__(self, enabled=False, path='order_queue.sqlite3', workers=2, batch_size=100, poll_interval=0.05,
+                 max_depth=5000, max_attempts=5, retention=86400):
+        self.enabled = enabled
+        self.path = path
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_depth = max_depth
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._pid = None
+        self._maintained_at = 0.0
+
+    def _connection(self):
+        # sqlite3 連接不能跨執行緒或跨 fork 共用，依執行緒與行程各自建立
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # 回應 202 之前訂單必須已落盤
+            connection.execute("PRAGMA synchronous=FULL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS order_queue (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    token TEXT NOT NULL UNIQUE,
+                    user_id INTEGER,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    claimed_by INTEGER,
+                    order_id INTEGER,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            connection.execute("CREATE INDEX IF NOT EXISTS idx_status_seq ON order_queue (status, seq)")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def depth(self):
+        """尚未寫入 MySQL 的訂單數（所有行程合計）"""
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM order_queue WHERE status IN ('queued', 'processing')"
+        ).fetchone()[0]
+
+    def enqueue(self, token, user_id, pricing):
+        """寫入一筆已扣庫存的訂單（金額以字串保存，不經浮點數）"""
+        payload = json.dumps({
+            'items': [[line['product_id'], line['quantity'], str(line['price'])] for line in pricing['items']],
+            'subtotal': str(pricing['subtotal']),
+            'tax': str(pricing['tax']),
+            'total': str(pricing['total']),
+            'reserved': True
+        })
+        now = time.time()
+        self._connection().execute("""
+            INSERT INTO order_queue (token, user_id, payload, status, created_at, updated_at)
+            VALUES (?, ?, ?, 'queued', ?, ?)
+        """, (token, user_id, payload, now, now))
+        self._wakeup.set()
+
+    def status(self, token):
+        """查詢訂單代碼的狀態，不存在時回傳 None"""
+        row = self._connection().execute("""
+            SELECT user_id, payload, status, order_id, error, created_at
+            FROM order_queue WHERE token = ?
+        """, (token,)).fetchone()
+        if row is None:
+            return None
+        user_id, payload, status, order_id, error, created_at = row
+        payload = json.loads(payload)
+        return {
+            'token': token,
+            'user_id': user_id,
+            'status': status,
+            'order_id': order_id,
+            'error': error,
+            'subtotal': float(payload['subtotal']),
+            'tax': float(payload['tax']),
+            'total': float(payload['total']),
+            'queued_at': datetime.fromtimestamp(created_at).isoformat(timespec='seconds')
+        }
+
+    def _claim(self):
+        """取出最早的一批待寫入訂單並標記為本行程處理中"""
+        connection = self._connection()
+        # BEGIN IMMEDIATE 先取得寫入鎖，多個行程不會取到同一筆
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = connection.execute("""
+                SELECT seq, token, user_id, payload, attempts, created_at FROM order_queue
+                WHERE status = 'queued' ORDER BY seq LIMIT ?
+            """, (self.batch_size,)).fetchall()
+            if rows:
+                connection.execute(f"""
+                    UPDATE order_queue SET status = 'processing', claimed_by = ?, updated_at = ?
+                    WHERE seq IN ({', '.join(['?'] * len(rows))})
+                """, (os.getpid(), time.time(), *[row[0] for row in rows]))
+            connection.execute("COMMIT")
+        except sqlite3.Error:
+            connection.execute("ROLLBACK")
+            raise
+        batch = []
+        for seq, token, user_id, payload, attempts, created_at in rows:
+            payload = json.loads(payload)
+            batch.append({
+                'token': token,
+                'user_id': user_id,
+                'items': [(product_id, quantity, Decimal(price)) for product_id, quantity, price in payload['items']],
+                'subtotal': Decimal(payload['subtotal']),
+                'tax': Decimal(payload['tax']),
+                'total': Decimal(payload['total']),
+                'attempts': attempts,
+                'created_at': created_at,
+                # 舊版佇列的訂單沒有預留列，直接寫入
+                'reserved': payload.get('reserved', False)
+            })
+        return batch
+
+    def _update(self, token, status, order_id=None, error=None, attempt=False):
+        self._connection().execute("""
+            UPDATE order_queue
+            SET status = ?, order_id = ?, error = ?, attempts = attempts + ?, claimed_by = NULL, updated_at = ?
+            WHERE token = ?
+        """, (status, order_id, error, 1 if attempt else 0, time.time(), token))
+
+    def _maintain(self):
+        """把已結束行程或卡住超過 5 分鐘的處理中訂單放回佇列，並清除超過保留期限的記錄"""
+        # 重送已寫入的訂單是安全的：commit_order_batch 依代碼略過 MySQL 中已存在的訂單
+        connection = self._connection()
+        now = time.time()
+        claimers = connection.execute(
+            "SELECT DISTINCT claimed_by FROM order_queue WHERE status = 'processing'"
+        ).fetchall()
+        for (pid,) in claimers:
+            if pid is not None and pid != os.getpid() and not pid_alive(pid):
+                connection.execute("""
+                    UPDATE order_queue SET status = 'queued', claimed_by = NULL, updated_at = ?
+                    WHERE status = 'processing' AND claimed_by = ?
+                """, (now, pid))
+        connection.execute("""
+            UPDATE order_queue SET status = 'queued', claimed_by = NULL, updated_at = ?
+            WHERE status = 'processing' AND updated_at < ?
+        """, (now, now - 300))
+        connection.execute(
+            "DELETE FROM order_queue WHERE status IN ('committed', 'failed') AND updated_at < ?",
+            (now - self.retention,)
+        )
+
+    def _write(self, batch):
+        """寫入一批訂單；整批失敗時逐筆重試，找出有問題的訂單"""
+        with db_connection() as connection:
+            if not connection:
+                # 資料庫無法連線：不計入失敗次數，等下一輪
+                for order in batch:
+                    self._update(order['token'], 'queued')
+                time.sleep(1)
+                return
+            try:
+                connection.autocommit = False
+                order_ids = commit_order_batch(connection, batch)
+            except Error as e:
+                connection.rollback()
+                order_ids = None
+                error = str(e)
         
-        return jsonify({'message': '商品刪除成功'})
-    except Error as e:
-        # 如果發生錯誤，回滾事務
-        if connection:
-            connection.rollback()
-            cursor.close()
-            connection.close()
-        return jsonify({'error': str(e)}), 500
+        if order_ids is not None:
+            now = time.time()
+            committed = 0
+            for order in batch:
+                order_id = order_ids[order['token']]
+                if order_id is None:
+                    self._update(order['token'], 'failed', error='扣庫存交易未完成，訂單未成立')
+                    metrics.inc('pos_order_queue_orders_total', 'result="voided"')
+                    continue
+                self._update(order['token'], 'committed', order_id)
+                metrics.observe('pos_order_queue_lag_seconds', '', now - order['created_at'])
+                committed += 1
+            metrics.observe('pos_order_queue_batch_size', '', len(batch))
+            if committed:
+                metrics.inc('pos_order_queue_orders_total', 'result="committed"', committed)
+            return
+        
+        if len(batch) > 1:
+            for order in batch:
+                self._write([order])
+            return
+        
+        order = batch[0]
+        print(f"非同步訂單 {order['token']} 寫入失敗（第 {order['attempts'] + 1} 次）: {error}")
+        if order['attempts'] + 1 < self.max_attempts:
+            self._update(order['token'], 'queued', error=error, attempt=True)
+            metrics.inc('pos_order_queue_orders_total', 'result="retried"')
+            return
+        # 放棄前先歸還庫存；歸還失敗時留在佇列，之後再試
+        quantities = {}
+        for product_id, quantity, _ in order['items']:
+            quantities[product_id] = quantities.get(product_id, 0) + quantity
+        if release_stock(quantities, order['token'] if order['reserved'] else None):
+            self._update(order['token'], 'failed', error=error, attempt=True)
+            metrics.inc('pos_order_queue_orders_total', 'result="failed"')
+        else:
+            self._update(order['token'], 'queued', error=error)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                now = time.monotonic()
+                if now - self._maintained_at >= 30:
+                    self._maintained_at = now
+                    self._maintain()
+                batch = self._claim()
+                if batch:
+                    self._write(batch)
+                    metrics.flush()
+                else:
+                    self._wakeup.wait(self.poll_interval)
+                    self._wakeup.clear()
+            except Exception as e:
+                # 寫入執行緒不可因單次錯誤結束，否則本行程不再消化佇列
+                print(f"訂單佇列錯誤: {e}")
+                time.sleep(1)
+
+    def start(self):
+        """在本行程啟動寫入執行緒（已啟動時不做事；fork 後的子行程會重新啟動）"""
+        if not self.enabled or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._stopping.clear()
+            self._maintained_at = 0.0
+            self._threads = [
+                threading.Thread(target=self._run, name=f'order-queue-{index}', daemon=True)
+                for index in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+            self._pid = os.getpid()
+
+    def stop(self, timeout=5):
+        """停止寫入執行緒（等待進行中的批次完成；未寫入的訂單留在佇列，下次啟動時繼續）"""
+        if self._pid != os.getpid():
+            return
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        self._pid = None
+
+order_queue = OrderQueue(**ORDER_QUEUE_CONFIG)
+atexit.register(lambda: order_queue.stop())
+
+@app.before_request
+def start_order_queue():
+    """啟用非同步結帳時，由每個 worker 的第一個請求啟動寫入執行緒（避免在 fork 前的主行程啟動）"""
+    order_queue.start()
+
+def queued_order_response(token, pricing):
+    """非同步結帳的 202 回應（訂單代碼與狀態查詢網址）"""
+    response = jsonify({
+        'token': token,
+        'status': 'queued',
+        'subtotal': float(pricing['subtotal']),
+        'tax': float(pricing['tax']),
+        'total': float(pricing['total']),
+        'message': '訂單已受理'
+    })
+    response.status_code = 202
+    response.headers['Location'] = f'/api/orders/queue/{token}'
+    return response
+
+# 冪等鍵：Idempotency-Key 最長字元數
+IDEMPOTENCY_KEY_MAX_LENGTH = 64
+# 與回應內容一起保存、重送時原樣回傳的標頭（例如非同步結帳 202 的狀態查詢網址）
+IDEMPOTENT_REPLAY_HEADERS = ('Content-Type', 'Location')
+
+class IdempotencyStore:
+    """冪等鍵與其回應：MySQL idempotency_keys 資料表（所有 worker 與機器共用），到期記錄定期清除"""
+
+    def __init__(self, ttl=86400, lease=60):
+        self.ttl = ttl
+        self.lease = lease
+
+    def begin(self, user_id, key, fingerprint):
+        """佔用冪等鍵，回傳 (狀態, 資料)；狀態為 new（資料為佔用代碼）、replay（資料為已保存的 (狀態碼, 內容, 標頭)）、
+        in_progress、mismatch 或 unavailable"""
+        now = int(time.time())
+        claim = secrets.token_hex(16)
+        with db_connection() as connection:
+            if not connection:
+                return 'unavailable', None
+            try:
+                cursor = connection.cursor()
+                try:
+                    cursor.execute("""
+                        INSERT INTO idempotency_keys (user_id, idempotency_key, fingerprint, claim, locked_until, expires_at)
+                        VALUES (%s, %s, %s, %s, %s, %s)
+                    """, (user_id, key, fingerprint, claim, now + self.lease, now + self.ttl))
+                    return 'new', claim
+                except IntegrityError:
+                    pass
+                
+                cursor.execute("""
+                    SELECT fingerprint, status_code, response_body, response_headers, locked_until, expires_at
+                    FROM idempotency_keys WHERE user_id = %s AND idempotency_key = %s
+                """, (user_id, key))
+                row = cursor.fetchone()
+                if row is None:
+                    # 剛被清除或釋放，請用戶端再送一次
+                    return 'in_progress', None
+                stored_fingerprint, status_code, body, headers, locked_until, expires_at = row
+                
+                if expires_at <= now or (status_code is None and locked_until <= now):
+                    # 記錄已過期，或處理中的請求逾時未完成（行程中斷或仍在執行）；換上新的佔用代碼，
+                    # 原請求之後保存回應時代碼不符，會回滾自己的交易而不會與重送的請求重複提交
+                    cursor.execute("""
+                        UPDATE idempotency_keys
+                        SET fingerprint = %s, claim = %s, status_code = NULL, response_body = NULL, response_headers = NULL,
+                            locked_until = %s, expires_at = %s
+                        WHERE user_id = %s AND idempotency_key = %s AND locked_until = %s AND expires_at = %s
+                    """, (fingerprint, claim, now + self.lease, now + self.ttl, user_id, key, locked_until, expires_at))
+                    return ('new', claim) if cursor.rowcount == 1 else ('in_progress', None)
+                if stored_fingerprint != fingerprint:
+                    return 'mismatch', None
+                if status_code is None:
+                    return 'in_progress', None
+                return 'replay', (status_code, body, json.loads(headers) if headers else [])
+            except Error as e:
+                print(f"讀取冪等鍵失敗: {e}")
+                return 'unavailable', None
+
+    def record(self, cursor, user_id, key, claim, status_code, body, headers):
+        """在呼叫端的交易內保存回應（headers 為 [[名稱, 值], ...]）；佔用已被其他請求接手時回傳 False，呼叫端應回滾"""
+        cursor.execute("""
+            UPDATE idempotency_keys SET status_code = %s, response_body = %s, response_headers = %s
+            WHERE user_id = %s AND idempotency_key = %s AND claim = %s AND status_code IS NULL
+        """, (status_code, body, json.dumps(headers) if headers else None, user_id, key, claim))
+        return cursor.rowcount == 1
+
+    def finish(self, user_id, key, claim, status_code, body, headers):
+        """以獨立的連接保存回應（請求本身沒有資料庫交易時）"""
+        with db_connection() as connection:
+            if not connection:
+                return
+            try:
+                if not self.record(connection.cursor(), user_id, key, claim, status_code, body, headers):
+                    print("保存冪等鍵回應失敗: 鍵已被其他請求接手")
+            except Error as e:
+                print(f"保存冪等鍵回應失敗: {e}")
+
+    def release(self, user_id, key, claim):
+        """放棄佔用（請求失敗且沒有副作用，重送時重新執行）；已被其他請求接手時不動作"""
+        with db_connection() as connection:
+            if not connection:
+                return
+            try:
+                connection.cursor().execute("""
+                    DELETE FROM idempotency_keys
+                    WHERE user_id = %s AND idempotency_key = %s AND claim = %s AND status_code IS NULL
+                """, (user_id, key, claim))
+            except Error as e:
+                print(f"釋放冪等鍵失敗: {e}")
+
+    def purge(self):
+        """清除到期的記錄（每次最多 1000 筆，避免長時間鎖表）"""
+        with db_connection() as connection:
+            if not connection:
+                return
+            try:
+                connection.cursor().execute("DELETE FROM idempotency_keys WHERE expires_at <= %s LIMIT 1000", (int(time.time()),))
+            except Error as e:
+                print(f"清除過期冪等鍵失敗: {e}")
+
+idempotency_store = IdempotencyStore(**IDEMPOTENCY_CONFIG)
+
+def idempotent(view):
+    """帶 Idempotency-Key 標頭的請求：同一用戶以同一個鍵重送時直接回傳保存的回應，不再執行"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        user_id = session.get('user_id')
+        if key is None or user_id is None:
+            return view(*args, **kwargs)
+        if not 0 < len(key) <= IDEMPOTENCY_KEY_MAX_LENGTH or not key.isascii() or not key.isprintable():
+            return jsonify({'error': f'Idempotency-Key 須為 1～{IDEMPOTENCY_KEY_MAX_LENGTH} 個可見 ASCII 字元'}), 400
+        
+        # 同一個鍵只能用於同一個請求（方法、路徑與內容都相同）
+        fingerprint = hashlib.sha256(f'{request.method} {request.path}\n'.encode() + request.get_data()).hexdigest()
+        state, stored = idempotency_store.begin(user_id, key, fingerprint)
+        if state == 'replay':
+            status_code, body, headers = stored
+            response = app.response_class(body, status=status_code, mimetype='application/json')
+            for name, value in headers:
+                response.headers[name] = value
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        if state == 'mismatch':
+            return jsonify({'error': '此 Idempotency-Key 已用於內容不同的請求'}), 422
+        if state == 'in_progress':
+            return idempotency_in_progress()
+        if state == 'unavailable':
+            return jsonify({'error': '資料庫連接失敗'}), 503
+        
+        claim = stored
+        g.idempotency = {'user_id': user_id, 'key': key, 'claim': claim, 'recorded': False}
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except Exception:
+            idempotency_store.release(user_id, key, claim)
+            raise
+        if 200 <= response.status_code < 300:
+            # 回應通常已在訂單交易內保存；沒有時在此補存
+            if not g.idempotency['recorded']:
+                idempotency_store.finish(user_id, key, claim, response.status_code, response.get_data(as_text=True),
+                                         replay_headers(response))
+        else:
+            # 失敗的請求沒有副作用（交易已回滾），釋放後重送會重新執行
+            idempotency_store.release(user_id, key, claim)
+        if random.random() < 0.01:
+            idempotency_store.purge()
+        return response
+    return wrapper
+
+def idempotency_in_progress():
+    """同一個鍵的另一個請求正在處理（或已接手）時的 409 回應"""
+    response = jsonify({'error': '相同的請求正在處理中，請稍後再試'})
+    response.headers['Retry-After'] = '1'
+    return response, 409
+
+def replay_headers(response):
+    """回應中需要在重送時一併回傳的標頭"""
+    return [[name, response.headers[name]] for name in IDEMPOTENT_REPLAY_HEADERS if name in response.headers]
+
+def record_idempotent_response(cursor, response, status_code):
+    """在訂單交易內保存冪等鍵的回應（與訂單異動一起提交，不會出現訂單已寫入但重送時又執行一次）；
+    回傳 False 表示租約已被重送的請求接手，呼叫端必須回滾交易並回傳 idempotency_in_progress()"""
+    claim = g.get('idempotency')
+    if claim is None:
+        return True
+    if not idempotency_store.record(cursor, claim['user_id'], claim['key'], claim['claim'], status_code,
+                                    response.get_data(as_text=True), replay_headers(response)):
+        return False
+    claim['recorded'] = True
+    return True
 
 @app.route('/api/orders', methods=['POST'])
+@idempotent
 def create_order():
     """創建訂單"""
     # 檢查登入狀態
@@ -712,140 +3483,362 @@ def create_order():
     if not data or not data.get('items'):
         return jsonify({'error': '缺少訂單項目'}), 400
     
-    connection = get_db_connection()
-    if not connection:
-        return jsonify({'error': '資料庫連接失敗'}), 500
-    
     try:
-        # 設置為手動提交模式（禁用自動提交）
-        connection.autocommit = False
-        cursor = connection.cursor()
+        quantities = sum_item_quantities(data['items'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # 背壓：佇列積壓過多時請終端稍後重試，不再扣庫存
+    if order_queue.enabled:
+        try:
+            depth = order_queue.depth()
+        except sqlite3.Error as e:
+            print(f"讀取訂單佇列失敗: {e}")
+            return jsonify({'error': '訂單佇列無法使用，請稍後再試'}), 503
+        if depth >= order_queue.max_depth:
+            metrics.inc('pos_order_queue_rejected_total')
+            response = jsonify({'error': '結帳量過大，請稍後再試'})
+            response.headers['Retry-After'] = '1'
+            return response, 503
+    
+    # 獲取當前登入用戶ID
+    user_id = session.get('user_id') if 'user_id' in session else None
+    
+    with db_connection() as connection:
+        if not connection:
+            return jsonify({'error': '資料庫連接失敗'}), 500
         
-        # 檢查庫存並更新
-        for item in data['items']:
-            product_id = item['product_id']
-            quantity = item['quantity']
-            
-            cursor.execute("SELECT stock FROM products WHERE id = %s", (product_id,))
-            result = cursor.fetchone()
+        try:
+            # 設置為手動提交模式（禁用自動提交）
+            connection.autocommit = False
+            cursor = connection.cursor()
             
-            if not result:
+            try:
+                pricing = reserve_stock(connection, quantities)
+            except ValueError as e:
                 connection.rollback()
-                cursor.close()
-                connection.close()
-                return jsonify({'error': f'商品 ID {product_id} 不存在'}), 400
+                return jsonify({'error': str(e)}), 400
             
-            current_stock = result[0]
-            if current_stock < quantity:
-                connection.rollback()
-                cursor.close()
-                connection.close()
-                return jsonify({'error': f'商品 ID {product_id} 庫存不足'}), 400
+            if order_queue.enabled:
+                # 非同步模式：只提交扣庫存、預留列與冪等回應的短交易，訂單交由背景執行緒批次寫入。
+                # 提交前先寫入本機佇列：提交成功的扣庫存一定有佇列訂單負責寫入或歸還；
+                # 佇列寫入後、提交前中斷時交易回滾，寫入執行緒讀不到預留列即作廢該訂單
+                token = secrets.token_hex(16)
+                cursor.execute("INSERT INTO stock_reservations (token, user_id) VALUES (%s, %s)", (token, user_id))
+                response = queued_order_response(token, pricing)
+                if not record_idempotent_response(cursor, response, 202):
+                    connection.rollback()
+                    return idempotency_in_progress()
+                try:
+                    order_queue.enqueue(token, user_id, pricing)
+                except sqlite3.Error as e:
+                    connection.rollback()
+                    print(f"寫入訂單佇列失敗: {e}")
+                    return jsonify({'error': '訂單佇列無法寫入，請稍後再試'}), 503
+                connection.commit()
+            else:
+                # 創建訂單
+                cursor.execute("""
+                    INSERT INTO orders (user_id, subtotal, tax, total)
+                    VALUES (%s, %s, %s, %s)
+                """, (
+                    user_id,
+                    pricing['subtotal'],
+                    pricing['tax'],
+                    pricing['total']
+                ))
+                order_id = cursor.lastrowid
             
-            # 更新庫存
-            cursor.execute("""
-                UPDATE products SET stock = stock - %s WHERE id = %s
-            """, (quantity, product_id))
-        
-        # 獲取當前登入用戶ID
-        user_id = session.get('user_id') if 'user_id' in session else None
-        
-        # 創建訂單
-        cursor.execute("""
-            INSERT INTO orders (user_id, subtotal, tax, total)
-            VALUES (%s, %s, %s, %s)
-        """, (
-            user_id,
-            data['subtotal'],
-            data['tax'],
-            data['total']
-        ))
-        order_id = cursor.lastrowid
-        
-        # 創建訂單項目
-        for item in data['items']:
-            cursor.execute("""
-                INSERT INTO order_items (order_id, product_id, quantity, price)
-                VALUES (%s, %s, %s, %s)
-            """, (
-                order_id,
-                item['product_id'],
-                item['quantity'],
-                item['price']
-            ))
-        
-        # 提交事務
-        connection.commit()
-        cursor.close()
-        connection.close()
-        
-        return jsonify({'order_id': order_id, 'message': '訂單創建成功'}), 201
-    except Error as e:
-        # 如果發生錯誤，回滾事務
-        if connection:
+                # 創建訂單項目（executemany 會合併為單一多列 INSERT）
+                cursor.executemany("""
+                    INSERT INTO order_items (order_id, product_id, quantity, price)
+                    VALUES (%s, %s, %s, %s)
+                """, [
+                    (order_id, line['product_id'], line['quantity'], line['price'])
+                    for line in pricing['items']
+                ])
+
+                # 同一交易內累加每日彙總表（銷售日期取訂單實際寫入的 created_at）
+                cursor.execute("SELECT created_at FROM orders WHERE id = %s", (order_id,))
+                deltas = new_rollup_deltas()
+                rollup_order(
+                    deltas,
+                    {'created_at': cursor.fetchone()[0], 'user_id': user_id, 'total': pricing['total']},
+                    [(line['product_id'], line['quantity'], line['price']) for line in pricing['items']]
+                )
+                apply_rollup_deltas(cursor, deltas)
+
+                response = jsonify({
+                    'order_id': order_id,
+                    'subtotal': float(pricing['subtotal']),
+                    'tax': float(pricing['tax']),
+                    'total': float(pricing['total']),
+                    'message': '訂單創建成功'
+                })
+                if not record_idempotent_response(cursor, response, 201):
+                    connection.rollback()
+                    return idempotency_in_progress()
+
+                # 提交事務
+                connection.commit()
+                # 庫存已變更，失效快取中的相關商品
+                catalog_cache.invalidate_items(quantities)
+            
+                return response, 201
+        except Error as e:
+            # 如果發生錯誤，回滾事務
             connection.rollback()
-            cursor.close()
-            connection.close()
+            return jsonify({'error': str(e)}), 500
+    
+    # 庫存已變更，失效快取中的相關商品
+    catalog_cache.invalidate_items(quantities)
+    return response
+
+@app.route('/api/orders/queue/<token>', methods=['GET'])
+def get_queued_order(token):
+    """以代碼查詢非同步結帳的狀態（queued、processing、committed 或 failed）"""
+    if not check_login():
+        return jsonify({'error': '請先登入'}), 401
+    if not order_queue.enabled:
+        return jsonify({'error': '未啟用非同步結帳'}), 404
+    
+    try:
+        entry = order_queue.status(token)
+    except sqlite3.Error as e:
         return jsonify({'error': str(e)}), 500
+    # 只有下單者與管理員能查詢
+    if entry is None or (entry['user_id'] != session.get('user_id') and not check_admin()):
+        return jsonify({'error': '訂單代碼不存在'}), 404
+    return jsonify(entry)
+
+# 一次批次刪除訂單的上限
+BULK_DELETE_LIMIT = 500
+
+def void_orders(cursor, orders):
+    """刪除多筆已鎖定的訂單（id、user_id、total、created_at）：依商品彙總歸還量後以單一語句更新庫存並扣除彙總表，回傳有歸還的商品ID"""
+    order_ids = [order['id'] for order in orders]
+    placeholders = ', '.join(['%s'] * len(order_ids))
+    cursor.execute(f"""
+        SELECT order_id, product_id, quantity, price
+        FROM order_items
+        WHERE order_id IN ({placeholders})
+    """, tuple(order_ids))
+    restock = {}
+    lines = {}
+    for row in cursor.fetchall():
+        restock[row['product_id']] = restock.get(row['product_id'], 0) + row['quantity']
+        lines.setdefault(row['order_id'], []).append((row['product_id'], row['quantity'], row['price']))
+    
+    deltas = new_rollup_deltas()
+    for order in orders:
+        rollup_order(deltas, order, lines.get(order['id'], []), sign=-1)
+    
+    # 與結帳相同：先更新（鎖定）商品列，再寫彙總表
+    apply_stock_deltas(cursor, restock)
+    apply_rollup_deltas(cursor, deltas)
+    cursor.execute(f"DELETE FROM order_items WHERE order_id IN ({placeholders})", tuple(order_ids))
+    cursor.execute(f"DELETE FROM orders WHERE id IN ({placeholders})", tuple(order_ids))
+    return list(restock)
+
+# 工具函數：解析查詢參數
+def parse_datetime_param(value, end_of_day=False):
+    """解析 YYYY-MM-DD 或 YYYY-MM-DD HH:MM:SS；end_of_day 時純日期代表隔日 00:00（不含）"""
+    value = value.strip().replace('T', ' ')
+    try:
+        if len(value) == 10:
+            parsed = datetime.strptime(value, '%Y-%m-%d')
+            return parsed + timedelta(days=1) if end_of_day else parsed
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'日期格式錯誤: {value}')
+
+def is_whole_day(value):
+    """是否剛好為某日 00:00:00"""
+    return value == datetime.combine(value.date(), datetime.min.time())
+
+def parse_limit(value, default=50, maximum=200):
+    """解析分頁筆數，限制在 1 到 maximum 之間"""
+    if value is None or value == '':
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError('limit 必須為整數')
+    return max(1, min(limit, maximum))
+
+# 訂單金額欄位 DECIMAL(10, 2) 的最大值，金額篩選條件限制在此範圍內
+ORDER_AMOUNT_MAX = Decimal('99999999.99')
+
+def parse_amount_param(value, name):
+    """解析金額篩選條件；nan、inf 等非有限數值視為格式錯誤，超出欄位範圍的值收斂到範圍邊界"""
+    try:
+        amount = Decimal(value)
+    except InvalidOperation:
+        raise ValueError(f'{name} 必須為數字')
+    if not amount.is_finite():
+        raise ValueError(f'{name} 必須為有限的數字')
+    return max(-ORDER_AMOUNT_MAX, min(amount, ORDER_AMOUNT_MAX))
+
+def parse_order_cursor(value):
+    """解析訂單游標 "<created_at>,<id>" """
+    created_at, _, order_id = value.rpartition(',')
+    try:
+        return parse_datetime_param(created_at), int(order_id)
+    except ValueError:
+        raise ValueError('after 游標格式錯誤')
+
+def make_order_cursor(order):
+    """以最後一筆訂單產生下一頁游標"""
+    return f"{order['created_at'].strftime('%Y-%m-%d %H:%M:%S')},{order['id']}"
+
+# 工具函數：批次載入訂單項目
+def attach_order_items(cursor, orders):
+    """以單一 IN 查詢取得多筆訂單的項目，並組裝 items 與 items_display 欄位"""
+    items_by_order = {order['id']: [] for order in orders}
+    if items_by_order:
+        placeholders = ', '.join(['%s'] * len(items_by_order))
+        cursor.execute(f"""
+            SELECT oi.*, p.name
+            FROM order_items oi
+            JOIN products p ON oi.product_id = p.id
+            WHERE oi.order_id IN ({placeholders})
+            ORDER BY oi.order_id, oi.id
+        """, tuple(items_by_order))
+        for item in cursor.fetchall():
+            items_by_order[item['order_id']].append(item)
+    
+    for order in orders:
+        items = items_by_order[order['id']]
+        # 與原本 GROUP_CONCAT 相同的顯示格式（價格保留資料庫的兩位小數）
+        order['items_display'] = ', '.join(
+            f"{item['quantity']}x {item['name']} (NT${item['price']})" for item in items
+        ) or None
+        for item in items:
+            item['price'] = float(item['price'])
+            item['quantity'] = int(item['quantity'])
+        order['items'] = items
+    return orders
 
 @app.route('/api/orders', methods=['GET'])
 def get_orders():
-    """獲取當前登入用戶的訂單"""
+    """獲取當前登入用戶的訂單（游標分頁，下一頁游標在 X-Next-Cursor 標頭）"""
     # 檢查登入狀態
     if not check_login():
         return jsonify({'error': '請先登入'}), 401
     
     user_id = session.get('user_id')
     
-    connection = get_db_connection()
-    if not connection:
-        return jsonify({'error': '資料庫連接失敗'}), 500
-    
+    # 游標分頁與篩選條件：?after=<created_at,id>&limit=&from=&to=&min_total=&max_total=
+    conditions = ['o.user_id = %s']
+    params = [user_id]
     try:
-        cursor = connection.cursor(dictionary=True)
-        
-        # 只獲取當前用戶的訂單
-        cursor.execute("""
-            SELECT o.*, 
-                   GROUP_CONCAT(
-                       CONCAT(oi.quantity, 'x ', p.name, ' (NT$', oi.price, ')')
-                       SEPARATOR ', '
-                   ) as items_display
-            FROM orders o
-            LEFT JOIN order_items oi ON o.id = oi.order_id
-            LEFT JOIN products p ON oi.product_id = p.id
-            WHERE o.user_id = %s
-            GROUP BY o.id
-            ORDER BY o.created_at DESC
-        """, (user_id,))
-        orders = cursor.fetchall()
+        limit = parse_limit(request.args.get('limit'))
+        if request.args.get('after'):
+            after_created_at, after_id = parse_order_cursor(request.args['after'])
+            conditions.append('(o.created_at < %s OR (o.created_at = %s AND o.id < %s))')
+            params.extend([after_created_at, after_created_at, after_id])
+        if request.args.get('from'):
+            conditions.append('o.created_at >= %s')
+            params.append(parse_datetime_param(request.args['from']))
+        if request.args.get('to'):
+            conditions.append('o.created_at < %s')
+            params.append(parse_datetime_param(request.args['to'], end_of_day=True))
+        if request.args.get('min_total'):
+            conditions.append('o.total >= %s')
+            params.append(parse_amount_param(request.args['min_total'], 'min_total'))
+        if request.args.get('max_total'):
+            conditions.append('o.total <= %s')
+            params.append(parse_amount_param(request.args['max_total'], 'max_total'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    with db_connection() as connection:
+        if not connection:
+            return jsonify({'error': '資料庫連接失敗'}), 500
         
-        # 獲取每個訂單的詳細項目
-        for order in orders:
-            order['total'] = float(order['total'])
-            order['subtotal'] = float(order['subtotal'])
-            order['tax'] = float(order['tax'])
+        try:
+            cursor = connection.cursor(dictionary=True)
             
-            # 獲取訂單項目詳情
-            cursor.execute("""
-                SELECT oi.*, p.name
-                FROM order_items oi
-                JOIN products p ON oi.product_id = p.id
-                WHERE oi.order_id = %s
-            """, (order['id'],))
-            items = cursor.fetchall()
-            
-            for item in items:
-                item['price'] = float(item['price'])
-                item['quantity'] = int(item['quantity'])
-            
-            order['items'] = items
+            # 只獲取當前用戶的一頁訂單，走 idx_user_created 索引範圍掃描
+            # 多取一筆用來判斷是否還有下一頁
+            cursor.execute(f"""
+                SELECT o.*
+                FROM orders o
+                WHERE {' AND '.join(conditions)}
+                ORDER BY o.created_at DESC, o.id DESC
+                LIMIT %s
+            """, (*params, limit + 1))
+            orders = cursor.fetchall()
+            
+            next_cursor = None
+            if len(orders) > limit:
+                orders = orders[:limit]
+                next_cursor = make_order_cursor(orders[-1])
+            
+            for order in orders:
+                order['total'] = float(order['total'])
+                order['subtotal'] = float(order['subtotal'])
+                order['tax'] = float(order['tax'])
+            
+            # 一次批次取得本頁訂單的項目，查詢次數不隨訂單數增加
+            attach_order_items(cursor, orders)
+            
+            response = jsonify(orders)
+            if next_cursor:
+                response.headers['X-Next-Cursor'] = next_cursor
+            return response
+        except Error as e:
+            return jsonify({'error': str(e)}), 500
+
+@app.route('/api/orders/bulk-delete', methods=['POST'])
+def bulk_delete_orders():
+    """批次刪除訂單（管理員）：彙總各商品的歸還庫存後一次更新"""
+    if not check_admin():
+        return jsonify({'error': '需要管理員權限'}), 403
+    
+    data = request.json
+    if not data or not isinstance(data.get('order_ids'), list) or not data['order_ids']:
+        return jsonify({'error': '缺少訂單ID'}), 400
+    
+    try:
+        order_ids = sorted({parse_item_int(order_id) for order_id in data['order_ids']})
+    except (TypeError, ValueError):
+        return jsonify({'error': '訂單ID格式錯誤'}), 400
+    if len(order_ids) > BULK_DELETE_LIMIT:
+        return jsonify({'error': f'一次最多刪除 {BULK_DELETE_LIMIT} 筆訂單'}), 400
+    
+    with db_connection() as connection:
+        if not connection:
+            return jsonify({'error': '資料庫連接失敗'}), 500
         
-        cursor.close()
-        connection.close()
-        return jsonify(orders)
-    except Error as e:
-        return jsonify({'error': str(e)}), 500
+        try:
+            connection.autocommit = False
+            cursor = connection.cursor(dictionary=True)
+            
+            # 依訂單ID順序鎖定存在的訂單
+            placeholders = ', '.join(['%s'] * len(order_ids))
+            cursor.execute(f"""
+                SELECT id, user_id, total, created_at FROM orders
+                WHERE id IN ({placeholders})
+                ORDER BY id
+                FOR UPDATE
+            """, tuple(order_ids))
+            orders = cursor.fetchall()
+            found = [order['id'] for order in orders]
+            
+            restocked = void_orders(cursor, orders) if orders else []
+            
+            connection.commit()
+            catalog_cache.invalidate_items(restocked)
+            
+            return jsonify({
+                'deleted': found,
+                'not_found': sorted(set(order_ids) - set(found)),
+                'message': f'已刪除 {len(found)} 筆訂單'
+            })
+        except Error as e:
+            connection.rollback()
+            return jsonify({'error': str(e)}), 500
 
 @app.route('/api/orders/<int:order_id>', methods=['DELETE'])
 def delete_order(order_id):
@@ -856,61 +3849,37 @@ def delete_order(order_id):
     
     user_id = session.get('user_id')
     
-    connection = get_db_connection()
-    if not connection:
-        return jsonify({'error': '資料庫連接失敗'}), 500
-    
-    try:
-        # 設置為手動提交模式
-        connection.autocommit = False
-        cursor = connection.cursor(dictionary=True)
-        
-        # 檢查訂單是否存在且屬於當前用戶
-        cursor.execute("SELECT * FROM orders WHERE id = %s AND user_id = %s", (order_id, user_id))
-        order = cursor.fetchone()
-        
-        if not order:
-            cursor.close()
-            connection.close()
-            return jsonify({'error': '訂單不存在或無權限'}), 404
-        
-        # 獲取訂單項目以恢復庫存
-        cursor.execute("""
-            SELECT product_id, quantity 
-            FROM order_items 
-            WHERE order_id = %s
-        """, (order_id,))
-        order_items = cursor.fetchall()
-        
-        # 恢復商品庫存
-        for item in order_items:
-            cursor.execute("""
-                UPDATE products 
-                SET stock = stock + %s 
-                WHERE id = %s
-            """, (item['quantity'], item['product_id']))
-        
-        # 刪除訂單項目（外鍵約束會自動處理）
-        cursor.execute("DELETE FROM order_items WHERE order_id = %s", (order_id,))
-        
-        # 刪除訂單
-        cursor.execute("DELETE FROM orders WHERE id = %s", (order_id,))
-        
-        # 提交事務
-        connection.commit()
-        cursor.close()
-        connection.close()
+    with db_connection() as connection:
+        if not connection:
+            return jsonify({'error': '資料庫連接失敗'}), 500
         
-        return jsonify({'message': '訂單刪除成功'})
-    except Error as e:
-        # 如果發生錯誤，回滾事務
-        if connection:
+        try:
+            # 設置為手動提交模式
+            connection.autocommit = False
+            cursor = connection.cursor(dictionary=True)
+            
+            # 檢查訂單是否存在且屬於當前用戶
+            cursor.execute("SELECT * FROM orders WHERE id = %s AND user_id = %s FOR UPDATE", (order_id, user_id))
+            order = cursor.fetchone()
+            
+            if not order:
+                return jsonify({'error': '訂單不存在或無權限'}), 404
+            
+            # 恢復庫存並刪除訂單
+            restocked = void_orders(cursor, [order])
+            
+            # 提交事務
+            connection.commit()
+            catalog_cache.invalidate_items(restocked)
+            
+            return jsonify({'message': '訂單刪除成功'})
+        except Error as e:
+            # 如果發生錯誤，回滾事務
             connection.rollback()
-            cursor.close()
-            connection.close()
-        return jsonify({'error': str(e)}), 500
+            return jsonify({'error': str(e)}), 500
 
 @app.route('/api/orders/<int:order_id>', methods=['PUT'])
+@idempotent
 def update_order(order_id):
     """更新訂單"""
     # 檢查登入狀態
@@ -923,105 +3892,137 @@ def update_order(order_id):
     if not data or not data.get('items'):
         return jsonify({'error': '缺少訂單項目'}), 400
     
-    connection = get_db_connection()
-    if not connection:
-        return jsonify({'error': '資料庫連接失敗'}), 500
-    
     try:
-        # 設置為手動提交模式
-        connection.autocommit = False
-        cursor = connection.cursor(dictionary=True)
-        
-        # 檢查訂單是否存在且屬於當前用戶
-        cursor.execute("SELECT * FROM orders WHERE id = %s AND user_id = %s", (order_id, user_id))
-        order = cursor.fetchone()
-        
-        if not order:
-            cursor.close()
-            connection.close()
-            return jsonify({'error': '訂單不存在或無權限'}), 404
-        
-        # 獲取原訂單項目以恢復庫存
-        cursor.execute("""
-            SELECT product_id, quantity 
-            FROM order_items 
-            WHERE order_id = %s
-        """, (order_id,))
-        old_order_items = cursor.fetchall()
+        quantities = sum_item_quantities(data['items'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    with db_connection() as connection:
+        if not connection:
+            return jsonify({'error': '資料庫連接失敗'}), 500
         
-        # 恢復原商品庫存
-        for item in old_order_items:
+        try:
+            # 設置為手動提交模式
+            connection.autocommit = False
+            cursor = connection.cursor(dictionary=True)
+            
+            # 檢查訂單是否存在且屬於當前用戶，並鎖定訂單避免同時編輯
+            cursor.execute("SELECT * FROM orders WHERE id = %s AND user_id = %s FOR UPDATE", (order_id, user_id))
+            order = cursor.fetchone()
+            
+            if not order:
+                return jsonify({'error': '訂單不存在或無權限'}), 404
+            
+            # 獲取原訂單項目
             cursor.execute("""
-                UPDATE products 
-                SET stock = stock + %s 
-                WHERE id = %s
-            """, (item['quantity'], item['product_id']))
-        
-        # 檢查新庫存並更新
-        for item in data['items']:
-            product_id = item['product_id']
-            quantity = item['quantity']
+                SELECT product_id, quantity, price 
+                FROM order_items 
+                WHERE order_id = %s
+            """, (order_id,))
+            old_order_items = cursor.fetchall()
             
-            cursor.execute("SELECT stock FROM products WHERE id = %s", (product_id,))
-            result = cursor.fetchone()
+            old_quantities = {}
+            line_counts = {}
+            # 原有商品沿用下單時的歷史單價，新加入的商品使用目前售價
+            prices = {}
+            for item in old_order_items:
+                product_id = item['product_id']
+                old_quantities[product_id] = old_quantities.get(product_id, 0) + item['quantity']
+                line_counts[product_id] = line_counts.get(product_id, 0) + 1
+                prices.setdefault(product_id, item['price'])
             
-            if not result:
-                connection.rollback()
-                cursor.close()
-                connection.close()
-                return jsonify({'error': f'商品 ID {product_id} 不存在'}), 400
+            # 比對新舊項目，只計算淨庫存變化（正數為歸還，負數為再扣）
+            stock_deltas = {
+                product_id: old_quantities.get(product_id, 0) - quantities.get(product_id, 0)
+                for product_id in set(old_quantities) | set(quantities)
+            }
+            stock_deltas = {product_id: delta for product_id, delta in stock_deltas.items() if delta}
             
-            current_stock = result['stock']
-            if current_stock < quantity:
-                connection.rollback()
-                cursor.close()
-                connection.close()
-                return jsonify({'error': f'商品 ID {product_id} 庫存不足'}), 400
+            # 依商品ID固定順序鎖定庫存有變化或新加入的商品
+            locked = lock_products(connection, set(stock_deltas) | (set(quantities) - set(old_quantities)))
+            for product_id in sorted(quantities):
+                # 已下架的商品不能新增或加量，只能維持或減少
+                needs_stock = product_id not in old_quantities or stock_deltas.get(product_id, 0) < 0
+                if needs_stock and (product_id not in locked or not locked[product_id]['is_active']):
+                    connection.rollback()
+                    return jsonify({'error': f'商品 ID {product_id} 不存在'}), 400
+                if stock_deltas.get(product_id, 0) < 0 and locked[product_id]['stock'] < -stock_deltas[product_id]:
+                    connection.rollback()
+                    return jsonify({'error': f'商品 ID {product_id} 庫存不足'}), 400
+                if product_id not in prices:
+                    prices[product_id] = locked[product_id]['price']
             
-            # 更新庫存
-            cursor.execute("""
-                UPDATE products SET stock = stock - %s WHERE id = %s
-            """, (quantity, product_id))
-        
-        # 刪除舊的訂單項目
-        cursor.execute("DELETE FROM order_items WHERE order_id = %s", (order_id,))
-        
-        # 創建新的訂單項目
-        for item in data['items']:
+            # 單一語句套用所有淨庫存變化
+            apply_stock_deltas(cursor, stock_deltas)
+            
+            # 伺服器端以 Decimal 重新計價
+            pricing = price_order(quantities, prices)
+
+            # 彙總表扣除原內容、計入新內容；數量與單價都沒變的商品淨變化為零，不會寫入
+            deltas = new_rollup_deltas()
+            rollup_order(deltas, order, [(item['product_id'], item['quantity'], item['price']) for item in old_order_items], sign=-1)
+            rollup_order(deltas, dict(order, total=pricing['total']),
+                         [(line['product_id'], line['quantity'], line['price']) for line in pricing['items']])
+            apply_rollup_deltas(cursor, deltas)
+
+            # 只異動有變化的訂單項目；舊資料同一商品有多筆時整併為一筆
+            removed = [product_id for product_id in old_quantities
+                       if product_id not in quantities or line_counts[product_id] > 1]
+            changed = [product_id for product_id in quantities
+                       if product_id in old_quantities and line_counts[product_id] == 1
+                       and old_quantities[product_id] != quantities[product_id]]
+            added = [line for line in pricing['items']
+                     if line['product_id'] not in old_quantities or line_counts[line['product_id']] > 1]
+            
+            if removed:
+                placeholders = ', '.join(['%s'] * len(removed))
+                cursor.execute(f"""
+                    DELETE FROM order_items
+                    WHERE order_id = %s AND product_id IN ({placeholders})
+                """, (order_id, *removed))
+            
+            if changed:
+                cases = ' '.join(['WHEN %s THEN %s'] * len(changed))
+                placeholders = ', '.join(['%s'] * len(changed))
+                params = [value for product_id in changed for value in (product_id, quantities[product_id])]
+                cursor.execute(f"""
+                    UPDATE order_items
+                    SET quantity = CASE product_id {cases} END
+                    WHERE order_id = %s AND product_id IN ({placeholders})
+                """, (*params, order_id, *changed))
+            
+            if added:
+                cursor.executemany("""
+                    INSERT INTO order_items (order_id, product_id, quantity, price)
+                    VALUES (%s, %s, %s, %s)
+                """, [(order_id, line['product_id'], line['quantity'], line['price']) for line in added])
+            
+            # 更新訂單總額
             cursor.execute("""
-                INSERT INTO order_items (order_id, product_id, quantity, price)
-                VALUES (%s, %s, %s, %s)
-            """, (
-                order_id,
-                item['product_id'],
-                item['quantity'],
-                item['price']
-            ))
-        
-        # 更新訂單總額
-        subtotal = data.get('subtotal', sum(item['price'] * item['quantity'] for item in data['items']))
-        tax = data.get('tax', subtotal * 0.05)
-        total = data.get('total', subtotal + tax)
-        
-        cursor.execute("""
-            UPDATE orders 
-            SET subtotal = %s, tax = %s, total = %s
-            WHERE id = %s
-        """, (subtotal, tax, total, order_id))
-        
-        # 提交事務
-        connection.commit()
-        cursor.close()
-        connection.close()
-        
-        return jsonify({'message': '訂單更新成功'})
-    except Error as e:
-        # 如果發生錯誤，回滾事務
-        if connection:
+                UPDATE orders 
+                SET subtotal = %s, tax = %s, total = %s, updated_at = CURRENT_TIMESTAMP(6)
+                WHERE id = %s
+            """, (pricing['subtotal'], pricing['tax'], pricing['total'], order_id))
+            
+            response = jsonify({
+                'subtotal': float(pricing['subtotal']),
+                'tax': float(pricing['tax']),
+                'total': float(pricing['total']),
+                'message': '訂單更新成功'
+            })
+            if not record_idempotent_response(cursor, response, 200):
+                connection.rollback()
+                return idempotency_in_progress()
+            
+            # 提交事務
+            connection.commit()
+            catalog_cache.invalidate_items(stock_deltas)
+            
+            return response
+        except Error as e:
+            # 如果發生錯誤，回滾事務
             connection.rollback()
-            cursor.close()
-            connection.close()
-        return jsonify({'error': str(e)}), 500
+            return jsonify({'error': str(e)}), 500
 
 # 管理員統計API
 
@@ -1031,85 +4032,124 @@ def get_employee_sales():
     if not check_admin():
         return jsonify({'error': '需要管理員權限'}), 403
     
-    connection = get_db_connection()
-    if not connection:
-        return jsonify({'error': '資料庫連接失敗'}), 500
-    
-    try:
-        cursor = connection.cursor(dictionary=True)
-        
-        # 查詢每位員工的銷售數量（總金額和商品數量），包含管理員（如果有訂單）
-        cursor.execute("""
-            SELECT 
-                u.id,
-                u.username,
-                u.name,
-                u.role,
-                COALESCE(SUM(o.total), 0) as total_sales,
-                COALESCE(SUM(oi.quantity), 0) as total_items_sold
-            FROM users u
-            LEFT JOIN orders o ON u.id = o.user_id
-            LEFT JOIN order_items oi ON o.id = oi.order_id
-            WHERE u.role = 'user' OR (u.role = 'admin' AND EXISTS(SELECT 1 FROM orders WHERE user_id = u.id))
-            GROUP BY u.id, u.username, u.name, u.role
-            ORDER BY total_sales DESC
-        """)
-        
-        results = cursor.fetchall()
+    with db_connection() as connection:
+        if not connection:
+            return jsonify({'error': '資料庫連接失敗'}), 500
         
-        # 轉換數據類型
-        for result in results:
-            result['total_sales'] = float(result['total_sales'])
-            result['total_items_sold'] = int(result['total_items_sold'])
-        
-        cursor.close()
-        connection.close()
-        return jsonify(results)
-    except Error as e:
-        return jsonify({'error': str(e)}), 500
+        try:
+            cursor = connection.cursor(dictionary=True)
+            
+            # 資料未變更時直接回 304，不執行統計查詢
+            etag, _ = stats_etag(cursor)
+            if etag_matches(etag):
+                return not_modified(etag, private=True)
+            
+            # 查詢每位員工的銷售數量（總金額和商品數量），包含管理員（如果有訂單）
+            # 讀取每日員工彙總表，成本只與天數 × 員工數有關，與訂單筆數無關
+            cursor.execute("""
+                SELECT 
+                    u.id,
+                    u.username,
+                    u.name,
+                    u.role,
+                    COALESCE(r.total_sales, 0) as total_sales,
+                    COALESCE(r.items_sold, 0) as total_items_sold
+                FROM users u
+                LEFT JOIN (
+                    SELECT user_id, SUM(order_count) AS order_count, SUM(total_sales) AS total_sales, SUM(items_sold) AS items_sold
+                    FROM sales_daily_user
+                    GROUP BY user_id
+                ) r ON r.user_id = u.id
+                WHERE u.role = 'user' OR (u.role = 'admin' AND r.order_count > 0)
+                ORDER BY total_sales DESC
+            """)
+            
+            results = cursor.fetchall()
+            
+            # 轉換數據類型
+            for result in results:
+                result['total_sales'] = float(result['total_sales'])
+                result['total_items_sold'] = int(result['total_items_sold'])
+            
+            return with_etag(jsonify(results), etag, private=True)
+        except Error as e:
+            return jsonify({'error': str(e)}), 500
 
 @app.route('/api/admin/stats/daily-product-sales', methods=['GET'])
 def get_daily_product_sales():
-    """獲取當日產品銷售數量"""
+    """獲取產品銷售數量（?from=&to= 指定區間，預設為當日）"""
     if not check_admin():
         return jsonify({'error': '需要管理員權限'}), 403
     
-    connection = get_db_connection()
-    if not connection:
-        return jsonify({'error': '資料庫連接失敗'}), 500
-    
+    # 區間為 [from, to)；純日期的 to 包含當天；未指定時為資料庫的今天
     try:
-        cursor = connection.cursor(dictionary=True)
-        
-        # 查詢當日每種產品的銷售數量
-        cursor.execute("""
-            SELECT 
-                p.id,
-                p.name,
-                p.price,
-                COALESCE(SUM(oi.quantity), 0) as quantity_sold,
-                COALESCE(SUM(oi.quantity * oi.price), 0) as total_revenue
-            FROM products p
-            LEFT JOIN order_items oi ON p.id = oi.product_id
-            LEFT JOIN orders o ON oi.order_id = o.id
-            WHERE DATE(o.created_at) = CURDATE() OR o.created_at IS NULL
-            GROUP BY p.id, p.name, p.price
-            ORDER BY quantity_sold DESC
-        """)
-        
-        results = cursor.fetchall()
-        
-        # 轉換數據類型
-        for result in results:
-            result['price'] = float(result['price'])
-            result['quantity_sold'] = int(result['quantity_sold'])
-            result['total_revenue'] = float(result['total_revenue'])
+        start = parse_datetime_param(request.args['from']) if request.args.get('from') else None
+        end = parse_datetime_param(request.args['to'], end_of_day=True) if request.args.get('to') else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    with db_connection() as connection:
+        if not connection:
+            return jsonify({'error': '資料庫連接失敗'}), 500
         
-        cursor.close()
-        connection.close()
-        return jsonify(results)
-    except Error as e:
-        return jsonify({'error': str(e)}), 500
+        try:
+            cursor = connection.cursor(dictionary=True)
+            
+            # 資料未變更時直接回 304，不執行統計查詢（ETag 已包含資料庫的今天日期）
+            etag, today = stats_etag(cursor)
+            today = datetime.combine(today, datetime.min.time())
+            start = start or today
+            end = end or today + timedelta(days=1)
+            if start >= end:
+                return jsonify({'error': '起始時間必須早於結束時間'}), 400
+            if etag_matches(etag):
+                return not_modified(etag, private=True)
+            
+            if is_whole_day(start) and is_whole_day(end):
+                # 整日區間：以主鍵範圍讀取每日商品彙總表
+                sales_source = """
+                    SELECT product_id, SUM(quantity_sold) AS quantity_sold, SUM(revenue) AS total_revenue
+                    FROM sales_daily_product
+                    WHERE sale_date >= %s AND sale_date < %s
+                    GROUP BY product_id
+                """
+                params = (start.date(), end.date())
+            else:
+                # 非整日區間：orders(created_at) 索引範圍掃描，明細只讀涵蓋索引
+                sales_source = """
+                    SELECT oi.product_id, SUM(oi.quantity) AS quantity_sold, SUM(oi.quantity * oi.price) AS total_revenue
+                    FROM orders o
+                    JOIN order_items oi ON oi.order_id = o.id
+                    WHERE o.created_at >= %s AND o.created_at < %s
+                    GROUP BY oi.product_id
+                """
+                params = (start, end)
+            
+            # 先在衍生資料表彙總區間內的銷售，再接到商品上：未售出的上架商品為 0，已下架商品只在區間內有銷售時列出
+            cursor.execute(f"""
+                SELECT 
+                    p.id,
+                    p.name,
+                    p.price,
+                    COALESCE(s.quantity_sold, 0) as quantity_sold,
+                    COALESCE(s.total_revenue, 0) as total_revenue
+                FROM products p
+                LEFT JOIN ({sales_source}) s ON s.product_id = p.id
+                WHERE p.is_active = 1 OR s.product_id IS NOT NULL
+                ORDER BY quantity_sold DESC
+            """, params)
+            
+            results = cursor.fetchall()
+            
+            # 轉換數據類型
+            for result in results:
+                result['price'] = float(result['price'])
+                result['quantity_sold'] = int(result['quantity_sold'])
+                result['total_revenue'] = float(result['total_revenue'])
+            
+            return with_etag(jsonify(results), etag, private=True)
+        except Error as e:
+            return jsonify({'error': str(e)}), 500
 
 @app.route('/api/admin/stats/employee-average', methods=['GET'])
 def get_employee_average():
@@ -1117,70 +4157,517 @@ def get_employee_average():
     if not check_admin():
         return jsonify({'error': '需要管理員權限'}), 403
     
+    with db_connection() as connection:
+        if not connection:
+            return jsonify({'error': '資料庫連接失敗'}), 500
+        
+        try:
+            cursor = connection.cursor(dictionary=True)
+            
+            # 資料未變更時直接回 304，不執行統計查詢
+            etag, _ = stats_etag(cursor)
+            if etag_matches(etag):
+                return not_modified(etag, private=True)
+            
+            # 查詢每位員工的平均銷售數量（平均訂單金額、平均訂單商品數量），包含管理員（如果有訂單）
+            # 由每日員工彙總表的訂單數、金額與件數相除得到平均
+            cursor.execute("""
+                SELECT 
+                    u.id,
+                    u.username,
+                    u.name,
+                    u.role,
+                    COALESCE(r.order_count, 0) as order_count,
+                    CASE 
+                        WHEN r.order_count > 0 THEN r.total_sales / r.order_count
+                        ELSE 0
+                    END as avg_order_amount,
+                    CASE 
+                        WHEN r.order_count > 0 THEN r.items_sold / r.order_count
+                        ELSE 0
+                    END as avg_items_per_order
+                FROM users u
+                LEFT JOIN (
+                    SELECT user_id, SUM(order_count) AS order_count, SUM(total_sales) AS total_sales, SUM(items_sold) AS items_sold
+                    FROM sales_daily_user
+                    GROUP BY user_id
+                ) r ON r.user_id = u.id
+                WHERE u.role = 'user' OR (u.role = 'admin' AND r.order_count > 0)
+                ORDER BY avg_order_amount DESC
+            """)
+            
+            results = cursor.fetchall()
+            
+            # 轉換數據類型
+            for result in results:
+                result['order_count'] = int(result['order_count'])
+                result['avg_order_amount'] = float(result['avg_order_amount'])
+                result['avg_items_per_order'] = float(result['avg_items_per_order'])
+            
+            return with_etag(jsonify(results), etag, private=True)
+        except Error as e:
+            return jsonify({'error': str(e)}), 500
+
+# 訂單明細匯出
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+EXPORT_COLUMNS = ('order_id', 'created_at', 'user_id', 'username', 'product_id', 'product_name',
+                  'quantity', 'price', 'line_total', 'order_subtotal', 'order_tax', 'order_total')
+# 每次從伺服器端游標讀取並送出的列數
+EXPORT_BATCH_ROWS = 1000
+
+def format_export_value(value):
+    """匯出欄位值：時間固定格式、金額保留 Decimal 精度"""
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+def encode_export_rows(rows, export_format):
+    """將一批資料列編碼為 CSV 或 NDJSON 位元組"""
+    if export_format == 'ndjson':
+        return ''.join(
+            json.dumps(dict(zip(EXPORT_COLUMNS, map(format_export_value, row))), ensure_ascii=False) + '\n'
+            for row in rows
+        ).encode('utf-8')
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([format_export_value(value) for value in row] for row in rows)
+    return buffer.getvalue().encode('utf-8')
+
+@app.route('/api/admin/export/orders', methods=['GET'])
+def export_orders():
+    """匯出訂單明細（?from=&to=&format=csv|ndjson），以串流回應逐批送出"""
+    if not check_admin():
+        return jsonify({'error': '需要管理員權限'}), 403
+    
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': 'format 必須為 csv 或 ndjson'}), 400
+    
+    conditions = []
+    params = []
+    try:
+        if request.args.get('from'):
+            conditions.append("o.created_at >= %s")
+            params.append(parse_datetime_param(request.args['from']))
+        if request.args.get('to'):
+            conditions.append("o.created_at < %s")
+            params.append(parse_datetime_param(request.args['to'], end_of_day=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    
+    # 連接在回應關閉時才歸還（串流送完、用戶端中斷，或 HEAD 等根本沒有讀取內容的情況），因此不使用 with 區塊
     connection = get_db_connection()
     if not connection:
         return jsonify({'error': '資料庫連接失敗'}), 500
-    
     try:
-        cursor = connection.cursor(dictionary=True)
-        
-        # 查詢每位員工的平均銷售數量（平均訂單金額、平均訂單商品數量），包含管理員（如果有訂單）
-        cursor.execute("""
-            SELECT 
-                u.id,
-                u.username,
-                u.name,
-                u.role,
-                COUNT(o.id) as order_count,
-                CASE 
-                    WHEN COUNT(o.id) > 0 THEN COALESCE(AVG(o.total), 0)
-                    ELSE 0
-                END as avg_order_amount,
-                CASE 
-                    WHEN COUNT(o.id) > 0 THEN COALESCE(AVG(order_item_count.item_count), 0)
-                    ELSE 0
-                END as avg_items_per_order
-            FROM users u
-            LEFT JOIN orders o ON u.id = o.user_id
-            LEFT JOIN (
-                SELECT order_id, SUM(quantity) as item_count
-                FROM order_items
-                GROUP BY order_id
-            ) order_item_count ON o.id = order_item_count.order_id
-            WHERE u.role = 'user' OR (u.role = 'admin' AND EXISTS(SELECT 1 FROM orders WHERE user_id = u.id))
-            GROUP BY u.id, u.username, u.name, u.role
-            ORDER BY avg_order_amount DESC
-        """)
-        
-        results = cursor.fetchall()
-        
-        # 轉換數據類型
-        for result in results:
-            result['order_count'] = int(result['order_count'])
-            result['avg_order_amount'] = float(result['avg_order_amount'])
-            result['avg_items_per_order'] = float(result['avg_items_per_order'])
-        
-        cursor.close()
-        connection.close()
-        return jsonify(results)
+        # 非緩衝游標：結果留在伺服器端，逐批讀取，記憶體用量與匯出筆數無關
+        # 依 orders(created_at) 索引順序掃描，不需排序即可送出第一批
+        cursor = connection.cursor(buffered=False)
+        cursor.execute(f"""
+            SELECT
+                o.id, o.created_at, o.user_id, u.username,
+                oi.product_id, p.name, oi.quantity, oi.price, oi.quantity * oi.price,
+                o.subtotal, o.tax, o.total
+            FROM orders o
+            JOIN order_items oi ON oi.order_id = o.id
+            LEFT JOIN users u ON u.id = o.user_id
+            LEFT JOIN products p ON p.id = oi.product_id
+            {where}
+            ORDER BY o.created_at, o.id
+        """, tuple(params))
     except Error as e:
+        connection.close()
         return jsonify({'error': str(e)}), 500
+    
+    use_gzip = request.accept_encodings['gzip'] > 0
+    
+    def generate():
+        # wbits=31 產生 gzip 格式；每批同步清空一次，用戶端可以立即收到資料
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if use_gzip else None
+        
+        def emit(data):
+            return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH) if compressor else data
+        
+        try:
+            if export_format == 'csv':
+                # BOM 讓 Excel 以 UTF-8 開啟中文
+                yield emit('\ufeff'.encode('utf-8') + encode_export_rows([EXPORT_COLUMNS], 'csv'))
+            while True:
+                rows = cursor.fetchmany(EXPORT_BATCH_ROWS)
+                if not rows:
+                    break
+                yield emit(encode_export_rows(rows, export_format))
+            if compressor:
+                yield compressor.flush()
+        finally:
+            connection.close()
+    
+    # 檔名只保留日期時間中的數字與連字號
+    period = [''.join(ch for ch in request.args.get(name, default) if ch.isalnum() or ch == '-')
+              for name, default in (('from', 'all'), ('to', 'now'))]
+    filename = f"orders-{period[0]}-{period[1]}.{export_format}"
+    response = app.response_class(generate(), mimetype=EXPORT_FORMATS[export_format])
+    # 沒開始迭代的產生器關閉時不會執行 finally，由回應的 close 歸還連接（可重複呼叫）
+    response.call_on_close(connection.close)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.headers['Cache-Control'] = 'no-store'
+    response.vary.add('Accept-Encoding')
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+@app.route('/api/admin/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """獲取商品目錄快取命中統計"""
+    if not check_admin():
+        return jsonify({'error': '需要管理員權限'}), 403
+    
+    return jsonify({'catalog': catalog_cache.stats()})
+
+@app.route('/api/admin/auth/stats', methods=['GET'])
+def get_auth_stats():
+    """獲取登入延遲、每次登入 CPU 時間與 KDF 工作池狀態"""
+    if not check_admin():
+        return jsonify({'error': '需要管理員權限'}), 403
+    
+    return jsonify({'login': login_metrics.stats(), 'kdf': password_hasher.stats()})
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus 文字格式指標（所有 worker 加總）"""
+    token = METRICS_CONFIG['token']
+    authorized = token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    if not authorized and not check_admin():
+        return jsonify({'error': '需要管理員權限或 metrics token'}), 403
+    
+    return app.response_class(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/admin/metrics/slow-requests', methods=['GET'])
+def get_slow_requests():
+    """獲取最近的慢請求與其執行的 SQL（回應此請求的 worker）"""
+    if not check_admin():
+        return jsonify({'error': '需要管理員權限'}), 403
+    
+    return jsonify({'threshold_ms': METRICS_CONFIG['slow_request_ms'], 'requests': slow_requests.recent()})
+
+class DatabaseProbe:
+    """就緒檢查的資料庫探測：結果快取 interval 秒，同一時間只有一個執行緒實際查詢，其他請求沿用上次結果"""
+
+    def __init__(self, interval=2, timeout=1):
+        self.interval = interval
+        self.timeout = timeout
+        self._result = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _probe(self):
+        """SELECT 1 並順便取得結構版本、唯讀狀態與等待鎖的交易數"""
+        result = {'ok': False, 'latency_ms': None, 'schema_version': None, 'read_only': None, 'lock_waits': None}
+        started = time.perf_counter()
+        try:
+            connection = get_pool().acquire(timeout=self.timeout)
+        except Error as e:
+            result['error'] = str(e)
+            return result
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1, @@global.read_only")
+            _, read_only = cursor.fetchone()
+            result['latency_ms'] = round((time.perf_counter() - started) * 1000, 2)
+            result['read_only'] = bool(int(read_only))
+            result['schema_version'] = get_schema_version(cursor)
+            result['ok'] = True
+            try:
+                # 需要 PROCESS 權限；只作為提示，查不到不影響就緒判斷
+                cursor.execute("SELECT COUNT(*) FROM information_schema.INNODB_TRX WHERE trx_state = 'LOCK WAIT'")
+                result['lock_waits'] = cursor.fetchone()[0]
+            except Error:
+                pass
+        except Error as e:
+            result['error'] = str(e)
+        finally:
+            connection.close()
+        return result
+
+    def last(self):
+        """不探測，回傳上次的 (探測結果, 結果已存在的秒數)"""
+        return self._result, time.monotonic() - self._checked_at
+
+    def check(self):
+        """必要時探測，回傳 (探測結果, 結果已存在的秒數)"""
+        now = time.monotonic()
+        if self._result is None or now - self._checked_at >= self.interval:
+            # 已有結果時不排隊等待，由正在探測的執行緒更新
+            if self._lock.acquire(blocking=self._result is None):
+                try:
+                    if self._result is None or time.monotonic() - self._checked_at >= self.interval:
+                        self._result = self._probe()
+                        self._checked_at = time.monotonic()
+                finally:
+                    self._lock.release()
+        return self.last()
+
+database_probe = DatabaseProbe(HEALTH_CONFIG['probe_interval'], HEALTH_CONFIG['probe_timeout'])
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    """健康檢查"""
+    """健康檢查（相容舊版，等同 /api/health/live）"""
     return jsonify({'status': 'ok', 'message': 'POS系統API運行中'})
 
+@app.route('/api/health/live', methods=['GET'])
+def health_live():
+    """存活檢查：行程能處理請求即回 200，不接觸資料庫（失敗時應重啟 worker）"""
+    return jsonify({'status': 'ok', 'pid': os.getpid()})
+
+@app.route('/api/health/ready', methods=['GET'])
+def health_ready():
+    """就緒檢查：資料庫可連線、結構版本符合、非唯讀且連接池未飽和時回 200，否則回 503"""
+    reasons = []
+    
+    # 連接池飽和時不再借連接探測（探測本身也會排隊），直接回報未就緒
+    pool = get_pool().stats()
+    utilisation = pool['in_use'] / pool['max'] if pool['max'] else 1.0
+    saturated = pool['waiting'] > 0 or utilisation >= HEALTH_CONFIG['max_pool_utilisation']
+    if saturated:
+        reasons.append('連接池已飽和')
+        database, age = database_probe.last()
+    else:
+        database, age = database_probe.check()
+    
+    if database is None or not database['ok']:
+        reasons.append('資料庫無法連線')
+    elif database['read_only']:
+        reasons.append('資料庫為唯讀（可能已切換為備援機）')
+    elif database['schema_version'] < SCHEMA_VERSION:
+        reasons.append(f"資料庫結構版本 {database['schema_version']} 落後（需要 {SCHEMA_VERSION}）")
+    
+    queue = None
+    if order_queue.enabled:
+        try:
+            queue = {'depth': order_queue.depth(), 'max_depth': order_queue.max_depth}
+        except sqlite3.Error as e:
+            queue = {'error': str(e)}
+            reasons.append('訂單佇列無法使用')
+        else:
+            if queue['depth'] >= order_queue.max_depth:
+                reasons.append('訂單佇列已滿')
+    
+    ready = not reasons
+    return jsonify({
+        'status': 'ready' if ready else 'not_ready',
+        'reasons': reasons,
+        'pid': os.getpid(),
+        'pool': dict(pool, utilisation=round(utilisation, 3)),
+        'database': dict(database or {}, age_seconds=round(age, 2) if database else None),
+        'schema': {'version': database['schema_version'] if database else None, 'expected': SCHEMA_VERSION},
+        'order_queue': queue
+    }), 200 if ready else 503
+
+def parse_config_value(default, value):
+    """將環境變數字串轉成與預設值相同的型別"""
+    if isinstance(default, bool):
+        if value.lower() in ('1', 'true', 'yes', 'on'):
+            return True
+        if value.lower() in ('0', 'false', 'no', 'off', ''):
+            return False
+        raise ValueError(f'無效的布林值: {value}')
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    if isinstance(default, list):
+        return [item.strip() for item in value.split(',') if item.strip()]
+    return value
+
+def load_config(path=None, environ=None):
+    """讀取設定：程式內預設值 < JSON 設定檔（path 或環境變數 POS_CONFIG）< 環境變數 POS_<區段>_<項目>"""
+    environ = os.environ if environ is None else environ
+    config = {section: dict(values) for section, values in CONFIG_SECTIONS.items()}
+    
+    path = path or environ.get('POS_CONFIG')
+    if path:
+        with open(path, encoding='utf-8') as f:
+            overrides = json.load(f)
+        for section, values in overrides.items():
+            for key, value in values.items():
+                # 拼錯的項目直接報錯，不要默默使用預設值
+                if key not in config.get(section, {}):
+                    raise ValueError(f'未知的設定項目: {section}.{key}')
+                config[section][key] = value
+    
+    for section, values in config.items():
+        for key, default in values.items():
+            value = environ.get(f'POS_{section}_{key}'.upper())
+            if value is not None:
+                values[key] = parse_config_value(default, value)
+    return config
+
+def create_app(config=None):
+    """套用設定（預設由 load_config 讀取）並重建本行程的連接池、快取、KDF 工作池、session 儲存區與訂單佇列"""
+    global catalog_cache, password_hasher, user_cache, static_assets, metrics, slow_requests, database_probe, order_queue
+    global idempotency_store
+    for section, values in (load_config() if config is None else config).items():
+        CONFIG_SECTIONS[section].update(values)
+    
+    app.config['SESSION_COOKIE_SECURE'] = SERVER_CONFIG['cookie_secure']
+    close_pool()
+    catalog_cache = CatalogCache(**CACHE_CONFIG)
+    password_hasher = PasswordHasher(**PASSWORD_CONFIG)
+    user_cache = UserCache(ttl=SESSION_CONFIG['user_cache_ttl'])
+    app.session_interface = make_session_interface(SESSION_CONFIG)
+    static_assets = StaticAssets(**ASSET_CONFIG)
+    metrics = Metrics(METRICS_CONFIG['dir'])
+    slow_requests = SlowRequestLog(METRICS_CONFIG['slow_log_size'])
+    database_probe = DatabaseProbe(HEALTH_CONFIG['probe_interval'], HEALTH_CONFIG['probe_timeout'])
+    order_queue.stop()
+    order_queue = OrderQueue(**ORDER_QUEUE_CONFIG)
+    idempotency_store = IdempotencyStore(**IDEMPOTENCY_CONFIG)
+    return app
+
+def check_connection_budget():
+    """所有 worker 的連接池上限合計超過 MySQL 的 max_connections 時提出警告"""
+    needed = SERVER_CONFIG['workers'] * (POOL_CONFIG['pool_size'] + POOL_CONFIG['max_overflow'])
+    with db_connection() as connection:
+        if not connection:
+            return
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT @@max_connections")
+            limit = cursor.fetchone()[0]
+        except Error as e:
+            print(f"讀取 max_connections 失敗: {e}")
+            return
+    if needed > limit:
+        print(f"警告：{SERVER_CONFIG['workers']} 個 worker 最多會建立 {needed} 條連接，"
+              f"超過 MySQL 的 max_connections（{limit}），請調低 workers 或 POOL_CONFIG")
+
+def serve():
+    """以 gunicorn 啟動 workers 個行程 × 每行程 threads 個執行緒；主行程收到 HUP 時平順輪替 worker"""
+    # 結構遷移由 python main.py migrate 另外執行，啟動時只檢查版本（未安裝 gunicorn 的備援方式也一樣）
+    if not check_schema():
+        return 1
+    if not static_assets.is_built():
+        print("注意：尚未執行 python main.py build-assets，前端檔案將不壓縮也不長期快取")
+    
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        # gunicorn 不支援 Windows：改以單一行程多執行緒執行，無法使用多個核心
+        print("未安裝 gunicorn，改以單一行程多執行緒啟動")
+        app.run(host=SERVER_CONFIG['host'], port=SERVER_CONFIG['port'], threaded=True, debug=False)
+        return 0
+    
+    check_connection_budget()
+    # worker 由此行程 fork 而來，先關閉主行程的連接
+    close_pool()
+    # 各 worker 把指標快照寫到同一個目錄，/api/metrics 由回應的 worker 加總
+    if METRICS_CONFIG['dir']:
+        os.makedirs(METRICS_CONFIG['dir'], exist_ok=True)
+        for name in os.listdir(METRICS_CONFIG['dir']):
+            if name.endswith('.json'):
+                os.remove(os.path.join(METRICS_CONFIG['dir'], name))
+    else:
+        METRICS_CONFIG['dir'] = tempfile.mkdtemp(prefix='pos-metrics-')
+    os.environ['POS_METRICS_DIR'] = METRICS_CONFIG['dir']
+    metrics.directory = METRICS_CONFIG['dir']
+    
+    options = {
+        'bind': f"{SERVER_CONFIG['host']}:{SERVER_CONFIG['port']}",
+        'workers': SERVER_CONFIG['workers'],
+        'worker_class': 'gthread',
+        'threads': SERVER_CONFIG['threads'],
+        'timeout': SERVER_CONFIG['timeout'],
+        'graceful_timeout': SERVER_CONFIG['graceful_timeout'],
+        'max_requests': SERVER_CONFIG['max_requests'],
+        'max_requests_jitter': SERVER_CONFIG['max_requests'] // 10,
+        'preload_app': SERVER_CONFIG['preload'],
+        'pidfile': SERVER_CONFIG['pidfile'] or None,
+        'proc_name': 'pos'
+    }
+    
+    class PosServer(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+        
+        def load(self):
+            if SERVER_CONFIG['preload']:
+                return create_app()
+            # 在 worker 內重新匯入 main 模組（本行程執行的是 __main__），HUP 重新載入時會讀到新的程式碼與設定
+            import wsgi
+            return wsgi.app
+    
+    print(f"POS系統以 {options['workers']} 個 worker × {options['threads']} 個執行緒啟動於 http://{options['bind']}")
+    PosServer().run()
+    return 0
+
+def reload_server():
+    """通知執行中的 serve 主行程平順重新載入（送出 HUP：啟動新 worker 後，舊 worker 處理完進行中的請求才結束）"""
+    try:
+        with open(SERVER_CONFIG['pidfile']) as f:
+            pid = int(f.read().strip())
+        os.kill(pid, signal.SIGHUP)
+    except (OSError, ValueError, AttributeError) as e:
+        print(f"重新載入失敗: {e}")
+        return 1
+    print(f"已通知主行程 {pid} 重新載入")
+    return 0
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='POS系統')
+    parser.add_argument('--config', help='JSON 設定檔（預設讀取環境變數 POS_CONFIG 指定的檔案）')
+    subparsers = parser.add_subparsers(dest='command')
+    serve_parser = subparsers.add_parser('serve', help='以多個 worker 行程 × 多執行緒提供服務')
+    serve_parser.add_argument('--host', help='監聽位址')
+    serve_parser.add_argument('--port', type=int, help='監聽埠號')
+    serve_parser.add_argument('--workers', type=int, help='worker 行程數（預設為 CPU 核心數）')
+    serve_parser.add_argument('--threads', type=int, help='每個 worker 的執行緒數')
+    subparsers.add_parser('build-assets', help='產生內容雜湊檔名與預先壓縮的前端靜態資源（dist/）')
+    subparsers.add_parser('reload', help='平順重新載入執行中的服務（重新讀取設定與程式碼）')
+    migrate_parser = subparsers.add_parser('migrate', help='建立資料庫並執行尚未套用的結構遷移')
+    migrate_parser.add_argument('--status', action='store_true', help='只顯示目前與最新的結構版本')
+    rebuild_parser = subparsers.add_parser('rebuild-rollups', help='由訂單明細重建每日銷售彙總表')
+    rebuild_parser.add_argument('--from', dest='start', type=date.fromisoformat, help='起始日期 YYYY-MM-DD（預設為最早的訂單）')
+    rebuild_parser.add_argument('--to', dest='end', type=date.fromisoformat, help='結束日期 YYYY-MM-DD（含當天，預設為最後的訂單）')
+    args = parser.parse_args()
+    
+    if args.config:
+        # worker 行程由環境變數讀取同一份設定檔
+        os.environ['POS_CONFIG'] = os.path.abspath(args.config)
+    create_app()
+    
+    if args.command == 'serve':
+        for key in ('host', 'port', 'workers', 'threads'):
+            if getattr(args, key) is not None:
+                SERVER_CONFIG[key] = getattr(args, key)
+        sys.exit(serve())
+    
+    if args.command == 'reload':
+        sys.exit(reload_server())
+    
+    if args.command == 'build-assets':
+        sys.exit(0 if build_assets() else 1)
+    
+    if args.command == 'migrate':
+        if args.status:
+            sys.exit(0 if check_schema() else 1)
+        sys.exit(0 if migrate_database() else 1)
+    
+    if args.command == 'rebuild-rollups':
+        print("正在重建每日銷售彙總表...")
+        sys.exit(0 if rebuild_rollups(args.start, args.end) else 1)
+    
+    # 開發伺服器：順便套用尚未執行的遷移（已是最新版本時只讀取一次版本）
     print("正在初始化資料庫...")
-    if init_database():
+    if migrate_database():
         print("資料庫初始化完成！")
         print("啟動Flask伺服器...")
         print("=" * 50)
-        print("POS系統已啟動！")
-        print("請在瀏覽器中訪問: http://localhost:5000")
+        print("POS系統已啟動！（開發伺服器，正式環境請使用 python main.py serve）")
+        print(f"請在瀏覽器中訪問: http://localhost:{SERVER_CONFIG['port']}")
         print("=" * 50)
-        app.run(debug=True, host='0.0.0.0', port=5000)
+        app.run(debug=SERVER_CONFIG['debug'], host=SERVER_CONFIG['host'], port=SERVER_CONFIG['port'], threaded=True)
     else:
         print("資料庫初始化失敗，請檢查XAMPP是否運行並確認資料庫配置")
-
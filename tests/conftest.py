@@ -0,0 +1,112 @@
+"""測試共用設定：以假的 MySQL 連接取代實際資料庫，連接池、session 與路由都使用正式程式碼"""
+import copy
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+# 匯入時的預設設定，每個測試結束後還原（create_app 會修改模組層級的配置字典）
+DEFAULT_CONFIG = main.load_config(environ={})
+
+class FakeDatabase:
+    """依 SQL 片段回傳預先設定的結果列（dict），並記錄執行過的 SQL"""
+
+    def __init__(self):
+        self.handlers = []
+        self.executed = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.users = {1: {'id': 1, 'username': 'admin', 'name': '系統管理員', 'role': 'admin'}}
+
+    def on(self, fragment, rows):
+        """SQL 含有 fragment 時回傳 rows（可為函式 (sql, params) -> rows）；後設定的優先，且優先於內建的用戶查詢"""
+        self.handlers.insert(0, (fragment, rows))
+
+    def query(self, sql, params):
+        self.executed.append(sql)
+        for fragment, rows in self.handlers:
+            if fragment in sql:
+                return rows(sql, params) if callable(rows) else rows
+        if 'FROM users WHERE id = %s' in sql:
+            user = self.users.get(params[0])
+            return [user] if user else []
+        return []
+
+class FakeCursor:
+    def __init__(self, database, dictionary=False):
+        self.database = database
+        self.dictionary = dictionary
+        self.rows = []
+        self.rowcount = 0
+        self.lastrowid = None
+
+    def execute(self, sql, params=()):
+        rows = self.database.query(' '.join(sql.split()), tuple(params or ()))
+        self.rows = [dict(row) if self.dictionary else tuple(row.values()) for row in rows]
+        self.rowcount = len(self.rows)
+
+    def executemany(self, sql, rows):
+        for params in rows:
+            self.execute(sql, params)
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchmany(self, size=1):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self, database):
+        self.database = database
+        self.autocommit = True
+        self.unread_result = False
+        self.in_transaction = False
+
+    def cursor(self, dictionary=False, buffered=None):
+        return FakeCursor(self.database, dictionary)
+
+    def commit(self):
+        self.database.commits += 1
+
+    def rollback(self):
+        self.database.rollbacks += 1
+
+    def ping(self, reconnect=False):
+        pass
+
+    def close(self):
+        pass
+
+    shutdown = close
+
+@pytest.fixture
+def fake_db(monkeypatch, tmp_path):
+    database = FakeDatabase()
+    monkeypatch.setattr(main.mysql.connector, 'connect', lambda **kwargs: FakeConnection(database))
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    config['session'].update(backend='sqlite', sqlite_path=str(tmp_path / 'sessions.sqlite3'))
+    config['metrics']['dir'] = ''
+    main.create_app(config)
+    yield database
+    main.close_pool()
+    main.create_app(copy.deepcopy(DEFAULT_CONFIG))
+
+@pytest.fixture
+def admin_client(fake_db):
+    client = main.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+        session['username'] = 'admin'
+    return client
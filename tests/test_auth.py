@@ -0,0 +1,51 @@
+import pytest
+
+import main
+
+MALFORMED_HASHES = [
+    'scrypt$abc$8$1$AAAA$AAAA',
+    'scrypt$3$8$1$AAAA$AAAA',
+    'scrypt$16384$8$1$@@@$AAAA',
+    'pbkdf2_sha256$0$AAAA$AAAA',
+    'pbkdf2_sha256$x$AAAA$AAAA',
+    '密碼',
+]
+
+@pytest.mark.parametrize('stored', MALFORMED_HASHES)
+def test_verify_treats_malformed_hash_as_wrong_password(stored):
+    hasher = main.PasswordHasher(scheme='pbkdf2_sha256', pbkdf2_iterations=1000)
+    assert hasher.verify_sync('secret', stored) == (False, False)
+    assert hasher.verify('secret', stored)[:2] == (False, False)
+
+def test_login_with_malformed_hash_returns_401(fake_db):
+    fake_db.on('WHERE username = %s', [{
+        'id': 2, 'username': 'clerk', 'name': None, 'role': 'user', 'password': 'scrypt$abc$8$1$AAAA$AAAA'
+    }])
+    response = main.app.test_client().post('/api/auth/login', json={'username': 'clerk', 'password': 'secret'})
+    assert response.status_code == 401
+
+def test_update_profile_verifies_password_without_holding_connection(fake_db, admin_client, monkeypatch):
+    hasher = main.PasswordHasher(scheme='pbkdf2_sha256', pbkdf2_iterations=1000)
+    stored = hasher.hash_sync('old-secret')
+    fake_db.on('SELECT password FROM users', [{'password': stored}])
+    fake_db.on('UPDATE users SET', [{}])  # rowcount 1
+    in_use = []
+    verify = main.password_hasher.verify
+    
+    def tracking_verify(password, stored_hash):
+        in_use.append(main.get_pool().stats()['in_use'])
+        return verify(password, stored_hash)
+    
+    monkeypatch.setattr(main.password_hasher, 'verify', tracking_verify)
+    response = admin_client.put('/api/auth/profile', json={'password': 'new-secret', 'old_password': 'old-secret'})
+    assert response.status_code == 200
+    assert in_use == [0]
+    update = [sql for sql in fake_db.executed if sql.startswith('UPDATE users SET')]
+    assert update and update[-1].endswith('AND password = %s')
+
+def test_update_profile_conflicts_when_password_changed_meanwhile(fake_db, admin_client):
+    hasher = main.PasswordHasher(scheme='pbkdf2_sha256', pbkdf2_iterations=1000)
+    fake_db.on('SELECT password FROM users', [{'password': hasher.hash_sync('old-secret')}])
+    # UPDATE ... AND password = %s 沒有符合的列：驗證後密碼已被其他請求修改
+    response = admin_client.put('/api/auth/profile', json={'password': 'new-secret', 'old_password': 'old-secret'})
+    assert response.status_code == 409
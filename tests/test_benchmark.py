@@ -0,0 +1,20 @@
+import types
+
+import benchmark
+
+class FailingLoginContext:
+    users = [(1, 'bench_user_1'), (2, 'bench_user_2')]
+    admin_id = 9
+
+    def client(self, user_id, username, password):
+        if user_id == 2:
+            raise RuntimeError('登入失敗 401')
+        return object()
+
+def test_run_load_reports_workers_that_cannot_start():
+    args = types.SimpleNamespace(admin_password='x', warmup=0, duration=5, seed=1, concurrency=2)
+    weights = {'checkout': 1}
+    samples, _, setup_errors = benchmark.run_load(args, FailingLoginContext(), weights)
+    assert len(setup_errors) == 1 and 'bench_user_2' in setup_errors[0]
+    # 其他執行緒隨即停止，不會跑滿整段量測時間
+    assert set(samples) == {'checkout'}
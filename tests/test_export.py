@@ -0,0 +1,62 @@
+import time
+
+import conftest
+import main
+
+def pool_in_use():
+    return main.get_pool().stats()['in_use']
+
+def test_head_returns_connection_to_pool(fake_db, admin_client):
+    for _ in range(3):
+        response = admin_client.head('/api/admin/export/orders')
+        assert response.status_code == 200
+        response.close()
+    assert pool_in_use() == 0
+
+def test_unread_response_returns_connection_to_pool(fake_db, admin_client):
+    response = admin_client.get('/api/admin/export/orders', buffered=False)
+    assert response.status_code == 200
+    assert pool_in_use() == 1
+    response.close()
+    assert pool_in_use() == 0
+
+def test_streamed_export_returns_connection_to_pool(fake_db, admin_client):
+    fake_db.on('FROM orders o', [{
+        'id': 7, 'created_at': '2024-01-02 10:00:00', 'user_id': 1, 'username': 'admin',
+        'product_id': 3, 'name': '可樂', 'quantity': 2, 'price': '30.00', 'line_total': '60.00',
+        'subtotal': '60.00', 'tax': '3.00', 'total': '63.00'
+    }])
+    response = admin_client.get('/api/admin/export/orders?format=ndjson')
+    assert response.status_code == 200
+    assert b'"order_id": 7' in response.data or b'"order_id":7' in response.data
+    assert pool_in_use() == 0
+
+def test_streamed_fetch_time_counts_against_request(fake_db, admin_client, monkeypatch):
+    fake_db.on('FROM orders o', [{
+        'id': 7, 'created_at': '2024-01-02 10:00:00', 'user_id': 1, 'username': 'admin',
+        'product_id': 3, 'name': '可樂', 'quantity': 2, 'price': '30.00', 'line_total': '60.00',
+        'subtotal': '60.00', 'tax': '3.00', 'total': '63.00'
+    }])
+    fetchmany = conftest.FakeCursor.fetchmany
+    
+    def slow_fetchmany(self, size=1):
+        time.sleep(0.05)
+        return fetchmany(self, size)
+    
+    monkeypatch.setattr(conftest.FakeCursor, 'fetchmany', slow_fetchmany)
+    finished = []
+    finish_request = main.finish_request
+    
+    def capture(environ, *args):
+        finished.append(environ.get('pos.query_log'))
+        finish_request(environ, *args)
+    
+    monkeypatch.setattr(main, 'finish_request', capture)
+    response = admin_client.get('/api/admin/export/orders?format=ndjson')
+    assert response.status_code == 200
+    response.get_data()
+    response.close()
+    # 產生器在請求結束後才讀取結果，讀取時間仍計入這個請求
+    query_log = [log for log in finished if log is not None][-1]
+    assert query_log.queries >= 1
+    assert query_log.seconds >= 0.1
@@ -0,0 +1,51 @@
+from datetime import datetime
+from decimal import Decimal
+import json
+
+import main
+
+def test_replay_restores_stored_headers(fake_db, admin_client, monkeypatch):
+    body = json.dumps({'token': 'abc', 'status': 'queued'})
+    stored = (202, body, [['Content-Type', 'application/json'], ['Location', '/api/orders/queue/abc']])
+    monkeypatch.setattr(main.idempotency_store, 'begin', lambda user_id, key, fingerprint: ('replay', stored))
+    response = admin_client.post('/api/orders', json={'items': [{'product_id': 1, 'quantity': 1}]},
+                                 headers={'Idempotency-Key': 'key-1'})
+    assert response.status_code == 202
+    assert response.headers['Location'] == '/api/orders/queue/abc'
+    assert response.headers['Idempotent-Replayed'] == 'true'
+    assert response.get_json()['token'] == 'abc'
+
+def test_record_saves_replay_headers(fake_db):
+    saved = []
+    fake_db.on('UPDATE idempotency_keys SET status_code', lambda sql, params: saved.append(params) or [])
+    pricing = {'subtotal': 100, 'tax': 5, 'total': 105}
+    with main.app.test_request_context():
+        response = main.queued_order_response('abc', pricing)
+        connection = main.get_db_connection()
+        try:
+            main.idempotency_store.record(connection.cursor(), 1, 'key-1', 'claim-1', 202,
+                                          response.get_data(as_text=True), main.replay_headers(response))
+        finally:
+            connection.close()
+    status_code, body, headers, user_id, key, claim = saved[0]
+    assert status_code == 202
+    assert ['Location', '/api/orders/queue/abc'] in json.loads(headers)
+    assert claim == 'claim-1'
+
+
+def test_order_rolls_back_when_lease_was_taken_over(fake_db, admin_client, monkeypatch):
+    # 租約逾時後重送的請求已換上新的佔用代碼：原請求保存回應時沒有符合的列，必須回滾而不是提交第二筆訂單
+    monkeypatch.setattr(main.idempotency_store, 'begin', lambda user_id, key, fingerprint: ('new', 'stale-claim'))
+    fake_db.on('FOR UPDATE', [{'id': 1, 'stock': 10, 'price': Decimal('10.00'), 'is_active': 1}])
+    fake_db.on('SELECT created_at FROM orders', [{'created_at': datetime(2024, 1, 2, 10, 0)}])
+    recorded = []
+    fake_db.on('UPDATE idempotency_keys SET status_code', lambda sql, params: recorded.append(params) or [])
+    released = []
+    fake_db.on('DELETE FROM idempotency_keys', lambda sql, params: released.append(params) or [])
+    response = admin_client.post('/api/orders', json={'items': [{'product_id': 1, 'quantity': 1}]},
+                                 headers={'Idempotency-Key': 'key-1'})
+    assert response.status_code == 409
+    assert recorded and recorded[0][-1] == 'stale-claim'
+    assert fake_db.commits == 0 and fake_db.rollbacks >= 1
+    # 釋放時也帶著自己的代碼，不會刪掉接手者的佔用
+    assert released and released[0][-1] == 'stale-claim'
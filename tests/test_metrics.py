@@ -0,0 +1,21 @@
+import main
+
+def bucket_bounds(text, name, labels):
+    prefix = f'{name}_bucket{{{labels},le="'
+    return [line[len(prefix):].split('"', 1)[0] for line in text.splitlines() if line.startswith(prefix)]
+
+def test_histogram_buckets_render_in_le_order(fake_db):
+    metrics = main.Metrics('')
+    name = 'pos_http_request_duration_seconds'
+    for labels, seconds in (('route="b",method="GET"', 0.3), ('route="a",method="GET"', 7)):
+        metrics.observe(name, labels, seconds)
+    text = metrics.render()
+    expected = [str(bound) for bound in main.HISTOGRAM_BUCKETS[name]] + ['+Inf']
+    for labels in ('route="a",method="GET"', 'route="b",method="GET"'):
+        assert bucket_bounds(text, name, labels) == expected
+    lines = text.splitlines()
+    # 每組標籤的 +Inf 之後緊接 _sum 與 _count，各組依標籤排序
+    inf = lines.index(f'{name}_bucket{{route="a",method="GET",le="+Inf"}} 1')
+    assert lines[inf + 1] == f'{name}_sum{{route="a",method="GET"}} 7'
+    assert lines[inf + 2] == f'{name}_count{{route="a",method="GET"}} 1'
+    assert lines[inf + 3].startswith(f'{name}_bucket{{route="b",method="GET",le="0.005"}}')
@@ -0,0 +1,75 @@
+import copy
+import json
+from decimal import Decimal
+
+import pytest
+
+import conftest
+import main
+
+@pytest.fixture
+def queue_app(fake_db, tmp_path, monkeypatch):
+    config = copy.deepcopy(conftest.DEFAULT_CONFIG)
+    config['session'].update(backend='sqlite', sqlite_path=str(tmp_path / 'sessions.sqlite3'))
+    config['metrics']['dir'] = ''
+    config['queue'].update(enabled=True, path=str(tmp_path / 'order_queue.sqlite3'))
+    main.create_app(config)
+    # 不啟動背景寫入執行緒，由測試直接檢查佇列內容
+    monkeypatch.setattr(main.order_queue, 'start', lambda: None)
+    fake_db.on('FOR UPDATE', [{'id': 1, 'stock': 10, 'price': Decimal('10.00'), 'is_active': 1}])
+    return fake_db
+
+def test_async_checkout_enqueues_before_committing_reservation(queue_app, admin_client, monkeypatch):
+    enqueue = main.order_queue.enqueue
+    commits_at_enqueue = []
+    
+    def tracking_enqueue(token, user_id, pricing):
+        commits_at_enqueue.append(queue_app.commits)
+        enqueue(token, user_id, pricing)
+    
+    monkeypatch.setattr(main.order_queue, 'enqueue', tracking_enqueue)
+    response = admin_client.post('/api/orders', json={'items': [{'product_id': 1, 'quantity': 2}]})
+    assert response.status_code == 202
+    token = response.get_json()['token']
+    # 佇列寫入時扣庫存交易尚未提交，之後才提交
+    assert commits_at_enqueue == [0] and queue_app.commits == 1
+    assert any(sql.startswith('INSERT INTO stock_reservations') for sql in queue_app.executed)
+    assert main.order_queue.status(token)['status'] == 'queued'
+
+def test_async_checkout_rolls_back_when_queue_write_fails(queue_app, admin_client, monkeypatch):
+    def failing_enqueue(token, user_id, pricing):
+        raise main.sqlite3.OperationalError('disk I/O error')
+    
+    monkeypatch.setattr(main.order_queue, 'enqueue', failing_enqueue)
+    response = admin_client.post('/api/orders', json={'items': [{'product_id': 1, 'quantity': 2}]})
+    assert response.status_code == 503
+    assert queue_app.commits == 0 and queue_app.rollbacks >= 1
+
+def queued_order(token, reserved=True):
+    return {'token': token, 'user_id': 1, 'items': [(1, 2, Decimal('10.00'))], 'subtotal': Decimal('20.00'),
+            'tax': Decimal('1.00'), 'total': Decimal('21.00'), 'reserved': reserved}
+
+def test_batch_voids_orders_whose_reservation_was_rolled_back(fake_db):
+    fake_db.on('FROM stock_reservations WHERE token IN', [{'token': 'a' * 32}])
+    fake_db.on('SELECT ingest_token, id, created_at FROM orders', [{'ingest_token': 'a' * 32, 'id': 7, 'created_at': main.datetime(2024, 1, 2)}])
+    inserted = []
+    fake_db.on('INSERT INTO orders', lambda sql, params: inserted.append(params) or [])
+    connection = main.get_db_connection()
+    try:
+        order_ids = main.commit_order_batch(connection, [queued_order('a' * 32), queued_order('b' * 32)])
+    finally:
+        connection.close()
+    assert order_ids == {'a' * 32: 7, 'b' * 32: None}
+    assert [params[-1] for params in inserted] == ['a' * 32]
+    assert any(sql.startswith('DELETE FROM stock_reservations') for sql in fake_db.executed)
+
+def test_release_without_reservation_keeps_stock(fake_db):
+    # 預留列不存在（扣庫存交易未提交或已歸還）：不可再加回庫存
+    assert main.release_stock({1: 2}, 'b' * 32)
+    assert not any(sql.startswith('UPDATE products') for sql in fake_db.executed)
+
+def test_enqueued_payload_marks_reservation(queue_app):
+    main.order_queue.enqueue('c' * 32, 1, main.price_order({1: 2}, {1: Decimal('10.00')}))
+    payload = main.order_queue._connection().execute(
+        "SELECT payload FROM order_queue WHERE token = ?", ('c' * 32,)).fetchone()[0]
+    assert json.loads(payload)['reserved'] is True
@@ -0,0 +1,42 @@
+import pytest
+
+import main
+
+@pytest.mark.parametrize('quantity', [2.9, 1.0, True, False, '2.5', ' 2', None])
+def test_create_order_rejects_non_integer_quantity(fake_db, admin_client, quantity):
+    response = admin_client.post('/api/orders', json={'items': [{'product_id': 1, 'quantity': quantity}]})
+    assert response.status_code == 400
+    assert response.get_json()['error'] == '訂單項目格式錯誤'
+    # 驗證失敗時不借資料庫連接、不鎖商品
+    assert not any('FOR UPDATE' in sql for sql in fake_db.executed)
+
+@pytest.mark.parametrize('quantity', [2.9, True])
+def test_update_order_rejects_non_integer_quantity(fake_db, admin_client, quantity):
+    response = admin_client.put('/api/orders/1', json={'items': [{'product_id': 1, 'quantity': quantity}]})
+    assert response.status_code == 400
+
+def test_create_order_rejects_non_integer_product_id(fake_db, admin_client):
+    response = admin_client.post('/api/orders', json={'items': [{'product_id': 1.5, 'quantity': 1}]})
+    assert response.status_code == 400
+
+@pytest.mark.parametrize('order_id', [1.9, True, '1.0', None])
+def test_bulk_delete_rejects_non_integer_order_ids(fake_db, admin_client, order_id):
+    response = admin_client.post('/api/orders/bulk-delete', json={'order_ids': [2, order_id]})
+    assert response.status_code == 400
+    assert response.get_json()['error'] == '訂單ID格式錯誤'
+    # 不會鎖定或刪除任何訂單
+    assert not any('FROM orders' in sql for sql in fake_db.executed)
+
+@pytest.mark.parametrize('value', ['nan', 'NaN', 'inf', '-Infinity', 'abc'])
+def test_order_amount_filter_rejects_non_finite_values(fake_db, admin_client, value):
+    for name in ('min_total', 'max_total'):
+        response = admin_client.get(f'/api/orders?{name}={value}')
+        assert response.status_code == 400
+        assert name in response.get_json()['error']
+
+def test_order_amount_filter_clamps_huge_values(fake_db, admin_client):
+    filters = []
+    fake_db.on('FROM orders o', lambda sql, params: filters.append(params) or [])
+    response = admin_client.get('/api/orders?min_total=-1e999&max_total=1e999')
+    assert response.status_code == 200
+    assert filters[0][-3:-1] == (-main.ORDER_AMOUNT_MAX, main.ORDER_AMOUNT_MAX)
@@ -0,0 +1,19 @@
+import builtins
+
+import main
+
+def test_serve_without_gunicorn_checks_schema_first(monkeypatch):
+    real_import = builtins.__import__
+    
+    def import_without_gunicorn(name, *args, **kwargs):
+        if name.startswith('gunicorn'):
+            raise ImportError(name)
+        return real_import(name, *args, **kwargs)
+    
+    started = []
+    monkeypatch.setattr(builtins, '__import__', import_without_gunicorn)
+    monkeypatch.setattr(main, 'check_schema', lambda: False)
+    monkeypatch.setattr(main.app, 'run', lambda **kwargs: started.append(kwargs))
+    # 結構版本落後時不啟動備援的開發伺服器
+    assert main.serve() == 1
+    assert started == []
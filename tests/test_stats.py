@@ -0,0 +1,30 @@
+from datetime import date
+
+def test_daily_product_sales_defaults_to_database_today(fake_db, admin_client):
+    fake_db.on('CURRENT_DATE AS today', [{'max_order_id': 1, 'today': date(2024, 3, 5)}])
+    ranges = []
+    fake_db.on('FROM products p', lambda sql, params: ranges.append(params) or [])
+    response = admin_client.get('/api/admin/stats/daily-product-sales')
+    assert response.status_code == 200
+    # 預設區間取自資料庫的 CURRENT_DATE，不是應用程式主機的 date.today()
+    assert ranges == [(date(2024, 3, 5), date(2024, 3, 6))]
+
+def test_daily_product_sales_rejects_empty_range(fake_db, admin_client):
+    fake_db.on('CURRENT_DATE AS today', [{'max_order_id': 1, 'today': date(2024, 3, 5)}])
+    response = admin_client.get('/api/admin/stats/daily-product-sales?from=2024-03-06')
+    assert response.status_code == 400
+
+def test_employee_stats_etag_changes_when_users_change(fake_db, admin_client):
+    version = {'max_order_id': 1, 'users_updated_at': '2024-03-05 10:00:00.000000', 'user_count': 3,
+               'today': date(2024, 3, 5)}
+    fake_db.on('CURRENT_DATE AS today', lambda sql, params: [dict(version)])
+    first = admin_client.get('/api/admin/stats/employee-sales')
+    assert first.status_code == 200
+    assert admin_client.get('/api/admin/stats/employee-sales', headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+    # 更名或角色變更（users.updated_at）與刪除用戶（用戶數）都要讓快取失效
+    for column, value in (('users_updated_at', '2024-03-05 11:00:00.000000'), ('user_count', 2)):
+        version[column] = value
+        response = admin_client.get('/api/admin/stats/employee-sales', headers={'If-None-Match': first.headers['ETag']})
+        assert response.status_code == 200
+    probe = next(sql for sql in fake_db.executed if 'CURRENT_DATE AS today' in sql)
+    assert 'MAX(updated_at) FROM users' in probe and 'COUNT(*) FROM users' in probe
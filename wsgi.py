@@ -0,0 +1,8 @@
+"""WSGI 進入點：gunicorn、uWSGI、mod_wsgi 等伺服器載入 wsgi:app
+
+設定由環境變數 POS_CONFIG 指定的 JSON 設定檔與 POS_<區段>_<項目> 環境變數提供；
+資料庫結構由 python main.py（或 python main.py serve）啟動時初始化。
+"""
+from main import create_app
+
+app = create_app()